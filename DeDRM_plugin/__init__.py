@@ -7,7 +7,7 @@ from __future__ import with_statement
 # Copyright © 2008-2019 Apprentice Harper et al.
 
 __license__   = 'GPL v3'
-__version__ = '6.7.0'
+__version__ = '6.7.1'
 __docformat__ = 'restructuredtext en'
 
 
@@ -70,6 +70,8 @@ __docformat__ = 'restructuredtext en'
 #   6.6.2 - revamp of folders to get Mac OS X app working. Updated to 64-bit app. Various fixes.
 #   6.6.3 - More cleanup of kindle book names and start of support for .kinf2018
 #   6.7.0 - Handle new library in calibre.
+#   6.7.1 - Try keys in order of past success, remembered in dedrm_keystats.json
+#           Parse Adobe PDFs once and try all keys against them
 
 
 """
@@ -77,7 +79,7 @@ Decrypt DRMed ebooks.
 """
 
 PLUGIN_NAME = u"DeDRM"
-PLUGIN_VERSION_TUPLE = (6, 7, 0)
+PLUGIN_VERSION_TUPLE = (6, 7, 1)
 PLUGIN_VERSION = u".".join([unicode(str(x)) for x in PLUGIN_VERSION_TUPLE])
 # Include an html helpfile in the plugin's zipfile with the following name.
 RESOURCE_NAME = PLUGIN_NAME + '_Help.htm'
@@ -208,6 +210,11 @@ class DeDRM(FileTypePlugin):
         # import the decryption keys
         import calibre_plugins.dedrm.prefs as prefs
         dedrmprefs = prefs.DeDRM_Prefs()
+        keystats = prefs.DeDRM_KeyStats()
+
+        # keys that opened books from the same publisher get tried first
+        from calibre_plugins.dedrm.epubtest import publisher
+        bookgroup = publisher(inf.name)
 
         # import the Barnes & Noble ePub handler
         import calibre_plugins.dedrm.ignobleepub as ignobleepub
@@ -218,7 +225,7 @@ class DeDRM(FileTypePlugin):
             print u"{0} v{1}: “{2}” is a secure Barnes & Noble ePub".format(PLUGIN_NAME, PLUGIN_VERSION, os.path.basename(path_to_ebook))
 
             # Attempt to decrypt epub with each encryption key (generated or provided).
-            for keyname, userkey in dedrmprefs['bandnkeys'].items():
+            for keyname, userkey in keystats.rankkeys(u"epub_bandn", dedrmprefs['bandnkeys'].items(), bookgroup):
                 keyname_masked = u"".join((u'X' if (x.isdigit()) else x) for x in keyname)
                 print u"{0} v{1}: Trying Encryption key {2:s}".format(PLUGIN_NAME, PLUGIN_VERSION, keyname_masked)
                 of = self.temporary_file(u".epub")
@@ -235,6 +242,7 @@ class DeDRM(FileTypePlugin):
 
                 if  result == 0:
                     # Decryption was successful.
+                    keystats.addsuccess(u"epub_bandn", keyname, bookgroup)
                     # Return the modified PersistentTemporary file to calibre.
                     return of.name
 
@@ -288,8 +296,10 @@ class DeDRM(FileTypePlugin):
                             # Store the new successful key in the defaults
                             print u"{0} v{1}: Saving a new default key".format(PLUGIN_NAME, PLUGIN_VERSION)
                             try:
-                                dedrmprefs.addnamedvaluetoprefs('bandnkeys','nook_Study_key',keyvalue)
+                                added, newname = dedrmprefs.addnamedvaluetoprefs('bandnkeys','nook_Study_key',keyvalue)
                                 dedrmprefs.writeprefs()
+                                if added:
+                                    keystats.addsuccess(u"epub_bandn", newname, bookgroup)
                                 print u"{0} v{1}: Saved a new default key after {2:.1f} seconds".format(PLUGIN_NAME, PLUGIN_VERSION,time.time()-self.starttime)
                             except:
                                 print u"{0} v{1}: Exception saving a new default key after {2:.1f} seconds".format(PLUGIN_NAME, PLUGIN_VERSION, time.time()-self.starttime)
@@ -311,7 +321,7 @@ class DeDRM(FileTypePlugin):
             print u"{0} v{1}: {2} is a secure Adobe Adept ePub".format(PLUGIN_NAME, PLUGIN_VERSION, os.path.basename(path_to_ebook))
 
             # Attempt to decrypt epub with each encryption key (generated or provided).
-            for keyname, userkeyhex in dedrmprefs['adeptkeys'].items():
+            for keyname, userkeyhex in keystats.rankkeys(u"epub_adept", dedrmprefs['adeptkeys'].items(), bookgroup):
                 userkey = userkeyhex.decode('hex')
                 print u"{0} v{1}: Trying Encryption key {2:s}".format(PLUGIN_NAME, PLUGIN_VERSION, keyname)
                 of = self.temporary_file(u".epub")
@@ -331,6 +341,7 @@ class DeDRM(FileTypePlugin):
 
                 if  result == 0:
                     # Decryption was successful.
+                    keystats.addsuccess(u"epub_adept", keyname, bookgroup)
                     # Return the modified PersistentTemporary file to calibre.
                     print u"{0} v{1}: Decrypted with key {2:s} after {3:.1f} seconds".format(PLUGIN_NAME, PLUGIN_VERSION,keyname,time.time()-self.starttime)
                     return of.name
@@ -386,8 +397,10 @@ class DeDRM(FileTypePlugin):
                             # Store the new successful key in the defaults
                             print u"{0} v{1}: Saving a new default key".format(PLUGIN_NAME, PLUGIN_VERSION)
                             try:
-                                dedrmprefs.addnamedvaluetoprefs('adeptkeys','default_key',keyvalue.encode('hex'))
+                                added, newname = dedrmprefs.addnamedvaluetoprefs('adeptkeys','default_key',keyvalue.encode('hex'))
                                 dedrmprefs.writeprefs()
+                                if added:
+                                    keystats.addsuccess(u"epub_adept", newname, bookgroup)
                                 print u"{0} v{1}: Saved a new default key after {2:.1f} seconds".format(PLUGIN_NAME, PLUGIN_VERSION,time.time()-self.starttime)
                             except:
                                 print u"{0} v{1}: Exception when saving a new default key after {2:.1f} seconds".format(PLUGIN_NAME, PLUGIN_VERSION, time.time()-self.starttime)
@@ -416,29 +429,33 @@ class DeDRM(FileTypePlugin):
         import calibre_plugins.dedrm.ineptpdf
 
         dedrmprefs = prefs.DeDRM_Prefs()
+        keystats = prefs.DeDRM_KeyStats()
         # Attempt to decrypt epub with each encryption key (generated or provided).
         print u"{0} v{1}: {2} is a PDF ebook".format(PLUGIN_NAME, PLUGIN_VERSION, os.path.basename(path_to_ebook))
-        for keyname, userkeyhex in dedrmprefs['adeptkeys'].items():
-            userkey = userkeyhex.decode('hex')
-            print u"{0} v{1}: Trying Encryption key {2:s}".format(PLUGIN_NAME, PLUGIN_VERSION, keyname)
+        userkeys = [(keyname, userkeyhex.decode('hex')) for keyname, userkeyhex in keystats.rankkeys(u"pdf_adept", dedrmprefs['adeptkeys'].items())]
+        if len(userkeys) > 0:
+            print u"{0} v{1}: Trying {2:d} Encryption keys".format(PLUGIN_NAME, PLUGIN_VERSION, len(userkeys))
             of = self.temporary_file(u".pdf")
 
-            # Give the user key, ebook and TemporaryPersistent file to the decryption function.
+            # Give the user keys, ebook and TemporaryPersistent file to the decryption function.
+            # The PDF is only parsed once, whichever key fits.
             try:
-                result = ineptpdf.decryptBook(userkey, path_to_ebook, of.name)
+                keyname = ineptpdf.decryptBookKeys(userkeys, path_to_ebook, of.name)
             except:
                 print u"{0} v{1}: Exception when decrypting after {2:.1f} seconds".format(PLUGIN_NAME, PLUGIN_VERSION, time.time()-self.starttime)
                 traceback.print_exc()
-                result = 1
+                keyname = None
 
             of.close()
 
-            if  result == 0:
+            if keyname is not None:
                 # Decryption was successful.
+                print u"{0} v{1}: Decrypted with key {2:s} after {3:.1f} seconds".format(PLUGIN_NAME, PLUGIN_VERSION,keyname,time.time()-self.starttime)
+                keystats.addsuccess(u"pdf_adept", keyname)
                 # Return the modified PersistentTemporary file to calibre.
                 return of.name
 
-            print u"{0} v{1}: Failed to decrypt with key {2:s} after {3:.1f} seconds".format(PLUGIN_NAME, PLUGIN_VERSION,keyname,time.time()-self.starttime)
+            print u"{0} v{1}: Failed to decrypt with any stored key after {2:.1f} seconds".format(PLUGIN_NAME, PLUGIN_VERSION,time.time()-self.starttime)
 
         # perhaps we need to get a new default ADE key
         print u"{0} v{1}: Looking for new default Adobe Digital Editions Keys after {2:.1f} seconds".format(PLUGIN_NAME, PLUGIN_VERSION, time.time()-self.starttime)
@@ -470,35 +487,36 @@ class DeDRM(FileTypePlugin):
 
         if len(newkeys) > 0:
             try:
-                for i,userkey in enumerate(newkeys):
-                    print u"{0} v{1}: Trying a new default key".format(PLUGIN_NAME, PLUGIN_VERSION)
-                    of = self.temporary_file(u".pdf")
+                print u"{0} v{1}: Trying {2:d} new default keys".format(PLUGIN_NAME, PLUGIN_VERSION, len(newkeys))
+                of = self.temporary_file(u".pdf")
+
+                # Give the user keys, ebook and TemporaryPersistent file to the decryption function.
+                try:
+                    keyindex = ineptpdf.decryptBookKeys(list(enumerate(newkeys)), path_to_ebook, of.name)
+                except:
+                    print u"{0} v{1}: Exception when decrypting after {2:.1f} seconds".format(PLUGIN_NAME, PLUGIN_VERSION, time.time()-self.starttime)
+                    traceback.print_exc()
+                    keyindex = None
+
+                of.close()
 
-                    # Give the user key, ebook and TemporaryPersistent file to the decryption function.
+                if keyindex is not None:
+                    # Decryption was a success
+                    # Store the new successful key in the defaults
+                    print u"{0} v{1}: Saving a new default key".format(PLUGIN_NAME, PLUGIN_VERSION)
                     try:
-                        result = ineptpdf.decryptBook(userkey, path_to_ebook, of.name)
+                        added, newname = dedrmprefs.addnamedvaluetoprefs('adeptkeys','default_key',newkeys[keyindex].encode('hex'))
+                        dedrmprefs.writeprefs()
+                        if added:
+                            keystats.addsuccess(u"pdf_adept", newname)
+                        print u"{0} v{1}: Saved a new default key after {2:.1f} seconds".format(PLUGIN_NAME, PLUGIN_VERSION,time.time()-self.starttime)
                     except:
-                        print u"{0} v{1}: Exception when decrypting after {2:.1f} seconds".format(PLUGIN_NAME, PLUGIN_VERSION, time.time()-self.starttime)
+                        print u"{0} v{1}: Exception when saving a new default key after {2:.1f} seconds".format(PLUGIN_NAME, PLUGIN_VERSION, time.time()-self.starttime)
                         traceback.print_exc()
-                        result = 1
-
-                    of.close()
-
-                    if  result == 0:
-                        # Decryption was a success
-                        # Store the new successful key in the defaults
-                        print u"{0} v{1}: Saving a new default key".format(PLUGIN_NAME, PLUGIN_VERSION)
-                        try:
-                            dedrmprefs.addnamedvaluetoprefs('adeptkeys','default_key',keyvalue.encode('hex'))
-                            dedrmprefs.writeprefs()
-                            print u"{0} v{1}: Saved a new default key after {2:.1f} seconds".format(PLUGIN_NAME, PLUGIN_VERSION,time.time()-self.starttime)
-                        except:
-                            print u"{0} v{1}: Exception when saving a new default key after {2:.1f} seconds".format(PLUGIN_NAME, PLUGIN_VERSION, time.time()-self.starttime)
-                            traceback.print_exc()
-                        # Return the modified PersistentTemporary file to calibre.
-                        return of.name
+                    # Return the modified PersistentTemporary file to calibre.
+                    return of.name
 
-                    print u"{0} v{1}: Failed to decrypt with new default key after {2:.1f} seconds".format(PLUGIN_NAME, PLUGIN_VERSION,time.time()-self.starttime)
+                print u"{0} v{1}: Failed to decrypt with new default keys after {2:.1f} seconds".format(PLUGIN_NAME, PLUGIN_VERSION,time.time()-self.starttime)
             except Exception, e:
                 pass
 
@@ -519,8 +537,16 @@ class DeDRM(FileTypePlugin):
         import calibre_plugins.dedrm.k4mobidedrm
 
         dedrmprefs = prefs.DeDRM_Prefs()
-        pids = dedrmprefs['pids']
-        serials = dedrmprefs['serials']
+        keystats = prefs.DeDRM_KeyStats()
+
+        # keys that opened books with a similar ASIN get tried first
+        bookgroup = None
+        asin = re.match('^B[A-Z0-9]{9}', os.path.basename(path_to_ebook))
+        if asin:
+            bookgroup = asin.group(0)[:4]
+
+        pids = list(dedrmprefs['pids'])
+        serials = list(dedrmprefs['serials'])
         for android_serials_list in dedrmprefs['androidkeys'].values():
             #print android_serials_list
             serials.extend(android_serials_list)
@@ -528,8 +554,18 @@ class DeDRM(FileTypePlugin):
         androidFiles = []
         kindleDatabases = dedrmprefs['kindlekeys'].items()
 
+        # rank the keys of all kinds together, by the name their
+        # successes are recorded under
+        candidates = [(pid, ('pid', pid)) for pid in pids]
+        candidates.extend((keyname, ('kDatabase', (keyname, kindleDatabase))) for keyname, kindleDatabase in kindleDatabases)
+        candidates.extend((serial, ('serial', serial)) for serial in serials)
+        rankedkeys = [key for name, key in keystats.rankkeys(u"kindle", candidates, bookgroup)]
+
         try:
-            book = k4mobidedrm.GetDecryptedBook(path_to_ebook,kindleDatabases,androidFiles,serials,pids,self.starttime)
+            book = k4mobidedrm.GetDecryptedBook(path_to_ebook,kindleDatabases,androidFiles,serials,pids,self.starttime,rankedkeys=rankedkeys)
+            keyname = self.kindleKeyName(book,kindleDatabases,serials,pids)
+            if keyname is not None:
+                keystats.addsuccess(u"kindle", keyname, bookgroup)
         except Exception, e:
             decoded = False
             # perhaps we need to get a new default Kindle for Mac/PC key
@@ -562,10 +598,13 @@ class DeDRM(FileTypePlugin):
                 try:
                     book = k4mobidedrm.GetDecryptedBook(path_to_ebook,newkeys.items(),[],[],[],self.starttime)
                     decoded = True
+                    winner = self.kindleKeyName(book,newkeys.items(),[],[])
                     # store the new successful keys in the defaults
                     print u"{0} v{1}: Saving {2} new {3}".format(PLUGIN_NAME, PLUGIN_VERSION, len(newkeys), u"key" if len(newkeys)==1 else u"keys")
-                    for keyvalue in newkeys.values():
-                        dedrmprefs.addnamedvaluetoprefs('kindlekeys','default_key',keyvalue)
+                    for keyname, keyvalue in newkeys.items():
+                        added, newname = dedrmprefs.addnamedvaluetoprefs('kindlekeys','default_key',keyvalue)
+                        if added and keyname == winner:
+                            keystats.addsuccess(u"kindle", newname, bookgroup)
                     dedrmprefs.writeprefs()
                 except Exception, e:
                     pass
@@ -581,14 +620,34 @@ class DeDRM(FileTypePlugin):
         return of.name
 
 
+    def kindleKeyName(self,book,kindleDatabases,serials,pids):
+        # work out which stored key gave the PID that opened the book
+        import calibre_plugins.dedrm.kgenpids as kgenpids
+
+        foundpid = book.getFoundPID()
+        if foundpid is None:
+            return None
+        if foundpid in pids:
+            return foundpid
+        md1, md2 = book.getPIDMetaInfo()
+        for keyname, kindleDatabase in kindleDatabases:
+            if foundpid in kgenpids.getPidList(md1, md2, [], [(keyname, kindleDatabase)]):
+                return keyname
+        for serial in serials:
+            if foundpid in kgenpids.getPidList(md1, md2, [serial], []):
+                return serial
+        return None
+
+
     def eReaderDecrypt(self,path_to_ebook):
 
         import calibre_plugins.dedrm.prefs as prefs
         import calibre_plugins.dedrm.erdr2pml
 
         dedrmprefs = prefs.DeDRM_Prefs()
+        keystats = prefs.DeDRM_KeyStats()
         # Attempt to decrypt epub with each encryption key (generated or provided).
-        for keyname, userkey in dedrmprefs['ereaderkeys'].items():
+        for keyname, userkey in keystats.rankkeys(u"pdb_ereader", dedrmprefs['ereaderkeys'].items()):
             keyname_masked = u"".join((u'X' if (x.isdigit()) else x) for x in keyname)
             print u"{0} v{1}: Trying Encryption key {2:s}".format(PLUGIN_NAME, PLUGIN_VERSION, keyname_masked)
             of = self.temporary_file(u".pmlz")
@@ -601,6 +660,7 @@ class DeDRM(FileTypePlugin):
             # Decryption was successful return the modified PersistentTemporary
             # file to Calibre's import process.
             if  result == 0:
+                keystats.addsuccess(u"pdb_ereader", keyname)
                 print u"{0} v{1}: Successfully decrypted with key {2:s} after {3:.1f} seconds".format(PLUGIN_NAME, PLUGIN_VERSION,keyname_masked,time.time()-self.starttime)
                 return of.name
 
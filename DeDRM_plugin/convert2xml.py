@@ -17,7 +17,9 @@ sys.stdout=Unbuffered(sys.stdout)
 
 import csv
 import os
+import re
 import getopt
+from cStringIO import StringIO
 from struct import pack
 from struct import unpack
 
@@ -86,6 +88,32 @@ def encodeNumber(number):
 
 
 
+# one complete encoded number, as a string
+ENCODED_NUMBER = re.compile(r'[\x80-\xff]*[\x00-\x7f]')
+
+def decodeNumber(data):
+    flag = False
+    if data[0] == '\xff':
+        flag = True
+        data = data[1:]
+    value = 0
+    for c in data:
+        value = (value << 7) + (ord(c) & 0x7F)
+    if flag:
+        value = -value
+    return value
+
+# the value of each encoded number seen, for the short ones
+class NumberCache(dict):
+    def __missing__(self, data):
+        value = decodeNumber(data)
+        if len(data) <= 2:
+            self[data] = value
+        return value
+
+numberCache = NumberCache()
+
+
 # create / read  a length prefixed string from the file
 
 def lengthPrefixString(data):
@@ -118,10 +146,13 @@ def convert(i):
 # as well as the xml tokens and values that make sense out of it
 
 class Dictionary(object):
-    def __init__(self, dictFile):
+    def __init__(self, dictFile, data=None):
         self.filename = dictFile
         self.size = 0
-        self.fo = file(dictFile,'rb')
+        if data is None:
+            self.fo = file(dictFile,'rb')
+        else:
+            self.fo = StringIO(data)
         self.stable = []
         self.size = readEncodedNumber(self.fo)
         for i in xrange(self.size):
@@ -159,9 +190,18 @@ class Dictionary(object):
 # also parses the other0.dat file - the main stylesheet
 # and information used to inject the xml snippets into page*.dat files
 
+# The whole page is decoded from one buffer with an integer read position,
+# instead of a file read for every byte.
+
 class PageParser(object):
-    def __init__(self, filename, dict, debug, flat_xml):
-        self.fo = file(filename,'rb')
+    def __init__(self, filename, dict, debug, flat_xml, data=None):
+        # data, when given, is the content of filename already in memory
+        if data is None:
+            data = file(filename,'rb').read()
+        self.data = data
+        self.buf = bytearray(data)
+        self.end = len(data)
+        self.pos = 0
         self.id = os.path.basename(filename).replace('.dat','')
         self.dict = dict
         self.debug = debug
@@ -410,19 +450,35 @@ class PageParser(object):
 
 
     # full tag path record keeping routines
+    # each entry of tagpath is the whole path down to that tag, as a tuple
     def tag_push(self, token):
-        self.tagpath.append(token)
+        if len(self.tagpath) > 0 :
+            self.tagpath.append(self.tagpath[-1] + (token,))
+        else :
+            self.tagpath.append((token,))
     def tag_pop(self):
         if len(self.tagpath) > 0 :
             self.tagpath.pop()
     def tagpath_len(self):
         return len(self.tagpath)
     def get_tagpath(self, i):
-        cnt = len(self.tagpath)
-        if i < cnt : result = self.tagpath[i]
-        for j in xrange(i+1, cnt) :
-            result += '.' + self.tagpath[j]
-        return result
+        return '.'.join(self.tagpath[-1][i:])
+
+    # the full name and token_tags entry for a tag path, found by trying
+    # the longest suffix of the path first. Tag paths repeat on every page,
+    # so the answers are kept for all parsers.
+    tag_cache = {}
+
+    def lookupTag(self, path):
+        found = self.tag_cache.get(path)
+        if found is None:
+            for j in xrange(len(path)):
+                tkn = '.'.join(path[j:])
+                if tkn in self.token_tags :
+                    found = ('.'.join(path), self.token_tags[tkn])
+                    self.tag_cache[path] = found
+                    break
+        return found
 
 
     # list of absolute command byte values values that indicate
@@ -432,21 +488,72 @@ class PageParser(object):
 
     # peek at and return 1 byte that is ahead by i bytes
     def peek(self, aheadi):
-        c = self.fo.read(aheadi)
-        if (len(c) == 0):
+        if self.pos >= self.end:
+            return None
+        return self.buf[min(self.pos + aheadi, self.end) - 1]
+
+
+    # read a 7 bit encoded number, as readEncodedNumber does from a file
+    def readNumber(self):
+        buf = self.buf
+        pos = self.pos
+        end = self.end
+        if pos >= end:
             return None
-        self.fo.seek(-aheadi,1)
-        c = c[-1:]
-        return ord(c)
+        data = buf[pos]
+        pos += 1
+        if data < 0x80:
+            self.pos = pos
+            return data
+        flag = False
+        if data == 0xFF:
+            flag = True
+            if pos >= end:
+                self.pos = pos
+                return None
+            data = buf[pos]
+            pos += 1
+        if data >= 0x80:
+            datax = (data & 0x7F)
+            while data >= 0x80 :
+                if pos >= end:
+                    self.pos = pos
+                    return None
+                data = buf[pos]
+                pos += 1
+                datax = (datax <<7) + (data & 0x7F)
+            data = datax
+        self.pos = pos
+        if flag:
+            data = -data
+        return data
+
+
+    # read cnt encoded numbers, all together, less adj
+    def readNumbers(self, cnt, adj=0):
+        if cnt <= 0:
+            return []
+        pos = self.pos
+        # most numbers in a vector take one or two bytes
+        size = 2*cnt + 8
+        while True:
+            found = ENCODED_NUMBER.findall(self.data, pos, pos + size)
+            if len(found) >= cnt or pos + size >= self.end:
+                break
+            size *= 2
+        if len(found) < cnt:
+            # the vector runs off the end of the data, read it as before
+            return [self.readNumber() - adj for i in xrange(cnt)]
+        del found[cnt:]
+        self.pos = pos + len(''.join(found))
+        if adj:
+            return [numberCache[data] - adj for data in found]
+        return [numberCache[data] for data in found]
 
 
     # get the next value from the file being processed
     def getNext(self):
-        nbyte = self.peek(1);
-        if (nbyte == None):
-            return None
-        val = readEncodedNumber(self.fo)
-        return val
+        return self.readNumber()
 
 
     # format an arg by argtype
@@ -467,38 +574,29 @@ class PageParser(object):
     # arguments, and commands
     def procToken(self, token):
 
-        known_token = False
         self.tag_push(token)
 
         if self.debug : print('Processing: ', self.get_tagpath(0))
-        cnt = self.tagpath_len()
-        for j in xrange(cnt):
-            tkn = self.get_tagpath(j)
-            if tkn in self.token_tags :
-                num_args = self.token_tags[tkn][0]
-                argtype = self.token_tags[tkn][1]
-                subtags = self.token_tags[tkn][2]
-                splcase = self.token_tags[tkn][3]
-                ntags = -1
-                known_token = True
-                break
+        found = self.lookupTag(self.tagpath[-1])
 
-        if known_token :
+        if found is not None :
+            tkn, (num_args, argtype, subtags, splcase) = found
+            ntags = -1
 
             # handle subtags if present
             subtagres = []
             if (splcase == 1):
                 # this type of tag uses of escape marker 0x74 indicate subtag count
                 if self.peek(1) == 0x74:
-                    skip = readEncodedNumber(self.fo)
+                    skip = self.readNumber()
                     subtags = 1
                     num_args = 0
 
             if (subtags == 1):
-                ntags = readEncodedNumber(self.fo)
+                ntags = self.readNumber()
                 if self.debug : print('subtags: ' + token + ' has ' + str(ntags))
                 for j in xrange(ntags):
-                    val = readEncodedNumber(self.fo)
+                    val = self.readNumber()
                     subtagres.append(self.procToken(self.dict.lookup(val)))
 
             # arguments can be scalars or vectors of text or numbers
@@ -507,20 +605,15 @@ class PageParser(object):
                 firstarg = self.peek(1)
                 if (firstarg in self.cmd_list) and (argtype != 'scalar_number') and (argtype != 'scalar_text'):
                     # single argument is a variable length vector of data
-                    arg = readEncodedNumber(self.fo)
+                    arg = self.readNumber()
                     argres = self.decodeCMD(arg,argtype)
                 else :
                     # num_arg scalar arguments
                     for i in xrange(num_args):
-                        argres.append(self.formatArg(readEncodedNumber(self.fo), argtype))
+                        argres.append(self.formatArg(self.readNumber(), argtype))
 
             # build the return tag
-            result = []
-            tkn = self.get_tagpath(0)
-            result.append(tkn)
-            result.append(subtagres)
-            result.append(argtype)
-            result.append(argres)
+            result = [tkn, subtagres, argtype, argres]
             self.tag_pop()
             return result
 
@@ -540,7 +633,7 @@ class PageParser(object):
     # it is NEVER used to format arguments.
     # builds the snippetList
     def doLoop72(self, argtype):
-        cnt = readEncodedNumber(self.fo)
+        cnt = self.readNumber()
         if self.debug :
             result = 'Set of '+ str(cnt) + ' xml snippets. The overall structure \n'
             result += 'of the document is indicated by snippet number sets at the\n'
@@ -550,7 +643,7 @@ class PageParser(object):
             if self.debug: print('Snippet:',str(i))
             snippet = []
             snippet.append(i)
-            val = readEncodedNumber(self.fo)
+            val = self.readNumber()
             snippet.append(self.procToken(self.dict.lookup(val)))
             self.snippetList.append(snippet)
         return
@@ -562,16 +655,16 @@ class PageParser(object):
         result = []
         adj = 0
         if mode & 1:
-            adj = readEncodedNumber(self.fo)
+            adj = self.readNumber()
         mode = mode >> 1
-        x = []
-        for i in xrange(cnt):
-            x.append(readEncodedNumber(self.fo) - adj)
+        x = self.readNumbers(cnt, adj)
         for i in xrange(mode):
             for j in xrange(1, cnt):
                 x[j] = x[j] + x[j - 1]
-        for i in xrange(cnt):
-            result.append(self.formatArg(x[i],argtype))
+        if (argtype == 'text') or (argtype == 'scalar_text') :
+            result = [self.formatArg(v,argtype) for v in x]
+        else :
+            result = x
         return result
 
 
@@ -586,8 +679,8 @@ class PageParser(object):
         if (cmd == 0x76):
 
             # loop with cnt, and mode to control loop styles
-            cnt = readEncodedNumber(self.fo)
-            mode = readEncodedNumber(self.fo)
+            cnt = self.readNumber()
+            mode = self.readNumber()
 
             if self.debug : print('Loop for', cnt, 'with  mode', mode,  ':  ')
             return self.doLoop76Mode(argtype, cnt, mode)
@@ -692,14 +785,10 @@ class PageParser(object):
         rlst = []
         rlst.append(name)
         if (len(argList) > 0):
-            alst = []
-            for j in argList:
-                if (argtype == 'text') or (argtype == 'scalar_text') :
-                    alst.append(j + '|')
-                else :
-                    alst.append(str(j) + '|')
-            argres = "".join(alst)
-            argres = argres[0:-1]
+            if (argtype == 'text') or (argtype == 'scalar_text') :
+                argres = '|'.join(argList)
+            else :
+                argres = '|'.join(map(str, argList))
             if argtype == 'snippets' :
                 rlst.append('.snippets=' + argres)
             else :
@@ -737,21 +826,22 @@ class PageParser(object):
     def process(self):
 
         # peek at the first bytes to see what type of file it is
-        magic = self.fo.read(9)
+        magic = self.data[0:9]
+        self.pos = len(magic)
         if (magic[0:1] == 'p') and (magic[2:9] == 'marker_'):
             first_token = 'info'
         elif (magic[0:1] == 'p') and (magic[2:9] == '__PAGE_'):
-            skip = self.fo.read(2)
+            self.pos = min(self.pos + 2, self.end)
             first_token = 'info'
         elif (magic[0:1] == 'p') and (magic[2:8] == '_PAGE_'):
             first_token = 'info'
         elif (magic[0:1] == 'g') and (magic[2:9] == '__GLYPH'):
-            skip = self.fo.read(3)
+            self.pos = min(self.pos + 3, self.end)
             first_token = 'info'
         else :
             # other0.dat file
             first_token = None
-            self.fo.seek(-9,1)
+            self.pos = 0
 
 
         # main loop to read and build the document tree
@@ -779,7 +869,7 @@ class PageParser(object):
                     print("Main Loop:  Unknown value: %x" % v)
                 if (v == 0):
                     if (self.peek(1) == 0x5f):
-                        skip = self.fo.read(1)
+                        self.pos += 1
                         first_token = 'info'
 
         # now do snippet injection
@@ -798,17 +888,17 @@ class PageParser(object):
         return xmlpage
 
 
-def fromData(dict, fname):
+def fromData(dict, fname, data=None):
     flat_xml = True
     debug = False
-    pp = PageParser(fname, dict, debug, flat_xml)
+    pp = PageParser(fname, dict, debug, flat_xml, data)
     xmlpage = pp.process()
     return xmlpage
 
-def getXML(dict, fname):
+def getXML(dict, fname, data=None):
     flat_xml = False
     debug = False
-    pp = PageParser(fname, dict, debug, flat_xml)
+    pp = PageParser(fname, dict, debug, flat_xml, data)
     xmlpage = pp.process()
     return xmlpage
 
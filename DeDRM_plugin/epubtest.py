@@ -10,6 +10,7 @@
 # Changelog epubtest
 #  1.00 - Cut to epubtest.py, testing ePub files only by Apprentice Alf
 #  1.01 - Added routine for use by Windows DeDRM
+#  1.02 - Added routine to get the publisher, for ranking keys
 #
 # Written in 2011 by Paul Durrant
 # Released with unlicense. See http://unlicense.org/
@@ -47,7 +48,7 @@
 from __future__ import with_statement
 from __future__ import print_function
 
-__version__ = '1.01'
+__version__ = '1.02'
 
 import sys, struct, os, traceback
 import zlib
@@ -55,7 +56,9 @@ import zipfile
 import xml.etree.ElementTree as etree
 
 NSMAP = {'adept': 'http://ns.adobe.com/adept',
-         'enc': 'http://www.w3.org/2001/04/xmlenc#'}
+         'enc': 'http://www.w3.org/2001/04/xmlenc#',
+         'container': 'urn:oasis:names:tc:opendocument:xmlns:container',
+         'dc': 'http://purl.org/dc/elements/1.1/'}
 
 # Wrap a stream so that output gets flushed immediately
 # and also make sure that any unicode strings get
@@ -198,6 +201,20 @@ def encryption(infile):
         traceback.print_exc()
     return encryption
 
+def publisher(infile):
+    # returns the publisher named in the OPF metadata, which is never encrypted, or None
+    try:
+        with zipfile.ZipFile(infile,'r') as inzip:
+            container = etree.fromstring(inzip.read('META-INF/container.xml'))
+            rootfile = container.find('.//{%s}rootfile' % (NSMAP['container'],))
+            opf = etree.fromstring(inzip.read(rootfile.get('full-path')))
+            name = opf.findtext('.//{%s}publisher' % (NSMAP['dc'],))
+            if name is not None and name.strip() != '':
+                return name.strip()
+    except:
+        pass
+    return None
+
 def main():
     argv=unicode_argv()
     print(encryption(argv[1]))
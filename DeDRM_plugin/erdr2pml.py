@@ -67,8 +67,9 @@
 #       - Ignore sidebars for dictionaries (different format?)
 #  0.22 - Unicode and plugin support, different image folders for PMLZ and source
 #  0.23 - moved unicode_argv call inside main for Windows DeDRM compatibility
+#  0.24 - Read sections through the shared memory mapped PalmDB reader
 
-__version__='0.23'
+__version__='0.24'
 
 import sys, re
 import struct, binascii, getopt, zlib, os, os.path, urllib, tempfile, traceback
@@ -136,6 +137,11 @@ def unicode_argv():
             argvencoding = "utf-8"
         return [arg if (type(arg) == unicode) else unicode(arg,argvencoding) for arg in sys.argv]
 
+if inCalibre:
+    from calibre_plugins.dedrm import palmdb
+else:
+    import palmdb
+
 Des = None
 if iswindows:
     # first try with pycrypto
@@ -200,27 +206,20 @@ class Sectionizer(object):
     bkType = "Book"
 
     def __init__(self, filename, ident):
-        self.contents = file(filename, 'rb').read()
-        self.header = self.contents[0:72]
-        self.num_sections, = struct.unpack('>H', self.contents[76:78])
+        self.palmdb = palmdb.PalmDB(filename)
+        self.header = self.palmdb.header[0:72]
+        self.num_sections = self.palmdb.num_sections
         # Dictionary or normal content (TODO: Not hard-coded)
-        if self.header[0x3C:0x3C+8] != ident:
-            if self.header[0x3C:0x3C+8] == "PDctPPrs":
+        if self.palmdb.ident != ident:
+            if self.palmdb.ident == "PDctPPrs":
                 self.bkType = "Dict"
             else:
+                self.palmdb.close()
                 raise ValueError('Invalid file format')
-        self.sections = []
-        for i in xrange(self.num_sections):
-            offset, a1,a2,a3,a4 = struct.unpack('>LBBBB', self.contents[78+i*8:78+i*8+8])
-            flags, val = a1, a2<<16|a3<<8|a4
-            self.sections.append( (offset, flags, val) )
     def loadSection(self, section):
-        if section + 1 == self.num_sections:
-            end_off = len(self.contents)
-        else:
-            end_off = self.sections[section + 1][0]
-        off = self.sections[section][0]
-        return self.contents[off:end_off]
+        return self.palmdb.loadSection(section)
+    def close(self):
+        self.palmdb.close()
 
 # cleanup unicode filenames
 # borrowed from calibre from calibre/src/calibre/__init__.py
@@ -482,18 +481,22 @@ def decryptBook(infile, outpath, make_pmlz, user_key):
             os.makedirs(outdir)
         print u"Decoding File"
         sect = Sectionizer(infile, 'PNRdPPrs')
-        er = EreaderProcessor(sect, user_key)
-
-        if er.getNumImages() > 0:
-            print u"Extracting images"
-            if not os.path.exists(imagedirpath):
-                os.makedirs(imagedirpath)
-            for i in xrange(er.getNumImages()):
-                name, contents = er.getImage(i)
-                file(os.path.join(imagedirpath, name), 'wb').write(contents)
-
-        print u"Extracting pml"
-        pml_string = er.getText()
+        try:
+            er = EreaderProcessor(sect, user_key)
+
+            if er.getNumImages() > 0:
+                print u"Extracting images"
+                if not os.path.exists(imagedirpath):
+                    os.makedirs(imagedirpath)
+                for i in xrange(er.getNumImages()):
+                    name, contents = er.getImage(i)
+                    file(os.path.join(imagedirpath, name), 'wb').write(contents)
+
+            print u"Extracting pml"
+            pml_string = er.getText()
+        finally:
+            # a wrong key raises, and the file must not stay mapped
+            sect.close()
         pmlfilename = bookname + ".pml"
         file(os.path.join(outdir, pmlfilename),'wb').write(cleanPML(pml_string))
         if pmlzname is not None:
@@ -11,13 +11,18 @@ import getopt
 from struct import pack
 from struct import unpack
 
+if 'calibre' in sys.modules:
+    from calibre_plugins.dedrm import flatxmldoc
+else:
+    import flatxmldoc
+
 
 class DocParser(object):
     def __init__(self, flatxml, classlst, fileid, bookDir, gdict, fixedimage):
         self.id = os.path.basename(fileid).replace('.dat','')
         self.svgcount = 0
-        self.docList = flatxml.split('\n')
-        self.docSize = len(self.docList)
+        self.doc = flatxmldoc.FlatXMLDoc(flatxml)
+        self.docSize = self.doc.size
         self.classList = {}
         self.bookDir = bookDir
         self.gdict = gdict
@@ -53,10 +58,6 @@ class DocParser(object):
 
         svgDir = os.path.join(self.bookDir,'svg')
 
-        imgDir = os.path.join(self.bookDir,'img')
-        imgname = self.id + '_%04d.svg' % self.svgcount
-        imgfile = os.path.join(imgDir,imgname)
-
         # get glyph information
         gxList = self.getData('info.glyph.x',0,-1)
         gyList = self.getData('info.glyph.y',0,-1)
@@ -69,13 +70,12 @@ class DocParser(object):
         ys = []
         gdefs = []
 
-        # get path defintions, positions, dimensions for each glyph
-        # that makes up the image, and find min x and min y to reposition origin
+        # get positions for each glyph that makes up the image,
+        # and find min x and min y to reposition origin
         minx = -1
         miny = -1
         for j in glyphList:
-            gid = gidList[j]
-            gids.append(gid)
+            gids.append(gidList[j])
 
             xs.append(gxList[j])
             if minx == -1: minx = gxList[j]
@@ -85,19 +85,34 @@ class DocParser(object):
             if miny == -1: miny = gyList[j]
             else : miny = min(miny, gyList[j])
 
+        # change the origin to minx, miny
+        for j in xrange(0, len(xs)):
+            xs[j] = xs[j] - minx
+            ys[j] = ys[j] - miny
+
+        # the same run of glyphs is only written once
+        run = tuple(zip(gids, xs, ys))
+        imgname = self.gdict.lookupRun(run)
+        if imgname is not None:
+            return imgname
+
+        imgDir = os.path.join(self.bookDir,'img')
+        imgname = self.id + '_%04d.svg' % self.svgcount
+        imgfile = os.path.join(imgDir,imgname)
+        self.svgcount += 1
+
+        # get path defintions and dimensions for each glyph
+        for gid in gids:
             path = self.getGlyph(gid)
             gdefs.append(path)
 
             maxws.append(extract(path,'width='))
             maxhs.append(extract(path,'height='))
 
-
-        # change the origin to minx, miny and calc max height and width
-        maxw = maxws[0] + xs[0] - minx
-        maxh = maxhs[0] + ys[0] - miny
+        # calc max height and width
+        maxw = maxws[0] + xs[0]
+        maxh = maxhs[0] + ys[0]
         for j in xrange(0, len(xs)):
-            xs[j] = xs[j] - minx
-            ys[j] = ys[j] - miny
             maxw = max( maxw, (maxws[j] + xs[j]) )
             maxh = max( maxh, (maxhs[j] + ys[j]) )
 
@@ -115,65 +130,29 @@ class DocParser(object):
         ifile.write('</svg>')
         ifile.close()
 
-        return 0
+        self.gdict.addRun(run, imgname)
+        return imgname
 
 
 
     # return tag at line pos in document
     def lineinDoc(self, pos) :
-        if (pos >= 0) and (pos < self.docSize) :
-            item = self.docList[pos]
-            if item.find('=') >= 0:
-                (name, argres) = item.split('=',1)
-            else :
-                name = item
-                argres = ''
-        return name, argres
+        return self.doc.lineinDoc(pos)
 
 
     # find tag in doc if within pos to end inclusive
     def findinDoc(self, tagpath, pos, end) :
-        result = None
-        if end == -1 :
-            end = self.docSize
-        else:
-            end = min(self.docSize, end)
-        foundat = -1
-        for j in xrange(pos, end):
-            item = self.docList[j]
-            if item.find('=') >= 0:
-                (name, argres) = item.split('=',1)
-            else :
-                name = item
-                argres = ''
-            if name.endswith(tagpath) :
-                result = argres
-                foundat = j
-                break
-        return foundat, result
+        return self.doc.findinDoc(tagpath, pos, end)
 
 
     # return list of start positions for the tagpath
     def posinDoc(self, tagpath):
-        startpos = []
-        pos = 0
-        res = ""
-        while res != None :
-            (foundpos, res) = self.findinDoc(tagpath, pos, -1)
-            if res != None :
-                startpos.append(foundpos)
-            pos = foundpos + 1
-        return startpos
+        return self.doc.posinDoc(tagpath)
 
 
     # returns a vector of integers for the tagpath
     def getData(self, tagpath, pos, end):
-        argres=[]
-        (foundat, argt) = self.findinDoc(tagpath, pos, end)
-        if (argt != None) and (len(argt) > 0) :
-            argList = argt.split('|')
-            argres = [ int(strval) for strval in argList]
-        return argres
+        return self.doc.getData(tagpath, pos, end)
 
 
     # get the class
@@ -332,10 +311,7 @@ class DocParser(object):
             if (sfg != None) and (slg != None):
                 for glyphnum in xrange(int(sfg), int(slg)):
                     glyphList.append(glyphnum)
-            num = self.svgcount
-            self.glyphs_to_image(glyphList)
-            self.svgcount += 1
-            result.append(('svg', num))
+            result.append(('svg', self.glyphs_to_image(glyphList)))
             return pclass, result
 
         # this type of paragraph may be made up of multiple spans, inline
@@ -414,10 +390,7 @@ class DocParser(object):
                 glyphList = []
                 for glyphnum in xrange(gl_first, gl_last):
                     glyphList.append(glyphnum)
-                num = self.svgcount
-                self.glyphs_to_image(glyphList)
-                self.svgcount += 1
-                result.append(('svg', num))
+                result.append(('svg', self.glyphs_to_image(glyphList)))
                 gl_first = -1
                 gl_last = -1
 
@@ -523,7 +496,7 @@ class DocParser(object):
 
             elif wtype == 'svg' :
                 sep = ''
-                parares += '<img src="img/' + self.id + '_%04d.svg" alt="" />' % num
+                parares += '<img src="img/' + num + '" alt="" />'
                 parares += sep
 
         if len(sep) > 0 : parares = parares[0:-1]
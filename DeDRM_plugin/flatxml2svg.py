@@ -8,13 +8,18 @@ import getopt
 from struct import pack
 from struct import unpack
 
+if 'calibre' in sys.modules:
+    from calibre_plugins.dedrm import flatxmldoc
+else:
+    import flatxmldoc
+
 
 class PParser(object):
     def __init__(self, gd, flatxml, meta_array):
         self.gd = gd
-        self.flatdoc = flatxml.split('\n')
-        self.docSize = len(self.flatdoc)
-        self.temp = []
+        self.doc = flatxmldoc.FlatXMLDoc(flatxml)
+        self.docSize = self.doc.size
+        self.taken = {}
 
         self.ph = -1
         self.pw = -1
@@ -56,106 +61,39 @@ class PParser(object):
 
     # return tag at line pos in document
     def lineinDoc(self, pos) :
-        if (pos >= 0) and (pos < self.docSize) :
-            item = self.flatdoc[pos]
-            if item.find('=') >= 0:
-                (name, argres) = item.split('=',1)
-            else :
-                name = item
-                argres = ''
-        return name, argres
+        return self.doc.lineinDoc(pos)
 
     # find tag in doc if within pos to end inclusive
     def findinDoc(self, tagpath, pos, end) :
-        result = None
-        if end == -1 :
-            end = self.docSize
-        else:
-            end = min(self.docSize, end)
-        foundat = -1
-        for j in xrange(pos, end):
-            item = self.flatdoc[j]
-            if item.find('=') >= 0:
-                (name, argres) = item.split('=',1)
-            else :
-                name = item
-                argres = ''
-            if name.endswith(tagpath) :
-                result = argres
-                foundat = j
-                break
-        return foundat, result
+        return self.doc.findinDoc(tagpath, pos, end)
 
     # return list of start positions for the tagpath
     def posinDoc(self, tagpath):
-        startpos = []
-        pos = 0
-        res = ""
-        while res != None :
-            (foundpos, res) = self.findinDoc(tagpath, pos, -1)
-            if res != None :
-                startpos.append(foundpos)
-            pos = foundpos + 1
-        return startpos
+        return self.doc.posinDoc(tagpath)
 
     def getData(self, path):
-        result = None
-        cnt = len(self.flatdoc)
-        for j in xrange(cnt):
-            item = self.flatdoc[j]
-            if item.find('=') >= 0:
-                (name, argt) = item.split('=')
-                argres = argt.split('|')
-            else:
-                name = item
-                argres = []
-            if (name.endswith(path)):
-                result = argres
-                break
-        if (len(argres) > 0) :
-            for j in xrange(0,len(argres)):
-                argres[j] = int(argres[j])
-        return result
+        startpos = self.doc.positions(path)
+        if len(startpos) == 0:
+            return None
+        return self.doc.getInts(startpos[0])
 
     def getDataatPos(self, path, pos):
-        result = None
-        item = self.flatdoc[pos]
-        if item.find('=') >= 0:
-            (name, argt) = item.split('=')
-            argres = argt.split('|')
-        else:
-            name = item
-            argres = []
-        if (len(argres) > 0) :
-            for j in xrange(0,len(argres)):
-                argres[j] = int(argres[j])
-        if (name.endswith(path)):
-            result = argres
-        return result
+        if not self.doc.names[pos].endswith(path):
+            return None
+        return self.doc.getInts(pos)
 
+    # takes the first tag for the path that has not been taken yet
     def getDataTemp(self, path):
-        result = None
-        cnt = len(self.temp)
-        for j in xrange(cnt):
-            item = self.temp[j]
-            if item.find('=') >= 0:
-                (name, argt) = item.split('=')
-                argres = argt.split('|')
-            else:
-                name = item
-                argres = []
-            if (name.endswith(path)):
-                result = argres
-                self.temp.pop(j)
-                break
-        if (len(argres) > 0) :
-            for j in xrange(0,len(argres)):
-                argres[j] = int(argres[j])
-        return result
+        startpos = self.doc.positions(path)
+        j = self.taken.get(path, 0)
+        if j >= len(startpos):
+            return None
+        self.taken[path] = j + 1
+        return self.doc.getInts(startpos[j])
 
     def getImages(self):
         result = []
-        self.temp = self.flatdoc
+        self.taken = {}
         while (self.getDataTemp('img') != None):
             h = self.getDataTemp('img.h')[0]
             w = self.getDataTemp('img.w')[0]
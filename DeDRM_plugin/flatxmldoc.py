@@ -0,0 +1,98 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# flatxmldoc.py
+
+__license__ = 'GPL v3'
+__version__ = '1.0'
+
+# The flat xml that convert2xml.py makes of Topaz pages, glyphs and
+# stylesheets, shared by genbook.py, flatxml2html.py, flatxml2svg.py and
+# stylexml2css.py.
+#
+# A flat xml document has one tag per line, either name=value or just the
+# name, where the name is the full tag path (e.g. page.region.img.src).
+# Tags are looked up by the end of their name. The lines are split once,
+# the positions of each name are indexed, and the positions of all the
+# names ending with a tag path are gathered the first time that path is
+# asked for. A lookup within a range of lines is then a bisection.
+
+from bisect import bisect_left
+
+
+class FlatXMLDoc(object):
+    def __init__(self, flatxml):
+        self.names = []
+        self.values = []
+        self.index = {}
+        for (j, item) in enumerate(flatxml.split('\n')):
+            name, sep, value = item.partition('=')
+            self.names.append(name)
+            self.values.append(value)
+            self.index.setdefault(name, []).append(j)
+        self.size = len(self.names)
+        self.found = {}
+        self.ints = {}
+
+    def positions(self, tagpath):
+        # sorted line numbers of all the tags whose name ends with tagpath
+        found = self.found.get(tagpath)
+        if found is None:
+            lists = [pos for (name, pos) in self.index.iteritems() if name.endswith(tagpath)]
+            if len(lists) == 1:
+                found = lists[0]
+            else:
+                found = sorted(j for pos in lists for j in pos)
+            self.found[tagpath] = found
+        return found
+
+    def lineinDoc(self, pos):
+        # returns (name, value) of the tag at line pos
+        if (pos >= 0) and (pos < self.size):
+            return self.names[pos], self.values[pos]
+        raise IndexError('line %d outside of document' % pos)
+
+    def findinDoc(self, tagpath, pos, end):
+        # returns (line, value) of the first tag ending with tagpath at a
+        # line from pos up to but not including end (-1 for the end of the
+        # document), or (-1, None)
+        if end == -1:
+            end = self.size
+        else:
+            end = min(self.size, end)
+        if pos < 0:
+            # a negative start counts back from the end, as list indexes do
+            for j in xrange(pos, end):
+                if self.names[j].endswith(tagpath):
+                    return j, self.values[j]
+            return -1, None
+        found = self.positions(tagpath)
+        i = bisect_left(found, pos)
+        if i < len(found) and found[i] < end:
+            j = found[i]
+            return j, self.values[j]
+        return -1, None
+
+    def posinDoc(self, tagpath):
+        # returns the lines of all tags ending with tagpath
+        return list(self.positions(tagpath))
+
+    def getInts(self, pos):
+        # returns the value of the tag at line pos as a list of integers
+        ints = self.ints.get(pos)
+        if ints is None:
+            value = self.values[pos]
+            if value:
+                ints = [int(strval) for strval in value.split('|')]
+            else:
+                ints = []
+            self.ints[pos] = ints
+        return list(ints)
+
+    def getData(self, tagpath, pos, end):
+        # returns the value of the first tag ending with tagpath as a list
+        # of integers, or [] if there is none
+        (foundat, argt) = self.findinDoc(tagpath, pos, end)
+        if (argt != None) and (len(argt) > 0):
+            return self.getInts(foundat)
+        return []
@@ -19,6 +19,8 @@ sys.stdout=Unbuffered(sys.stdout)
 import csv
 import os
 import getopt
+from cStringIO import StringIO
+from collections import OrderedDict
 from struct import pack
 from struct import unpack
 
@@ -36,11 +38,15 @@ if inCalibre :
     from calibre_plugins.dedrm import flatxml2html
     from calibre_plugins.dedrm import flatxml2svg
     from calibre_plugins.dedrm import stylexml2css
+    from calibre_plugins.dedrm import flatxmldoc
+    from calibre_plugins.dedrm import workerpool
 else :
     import convert2xml
     import flatxml2html
     import flatxml2svg
     import stylexml2css
+    import flatxmldoc
+    import workerpool
 
 # global switch
 buildXML = False
@@ -84,10 +90,13 @@ def readString(file):
         return ""
     return unpack(str(stringLength)+"s",sv)[0]
 
-def getMetaArray(metaFile):
+def getMetaArray(metaFile, data=None):
     # parse the meta file
     result = {}
-    fo = file(metaFile,'rb')
+    if data is None:
+        fo = file(metaFile,'rb')
+    else:
+        fo = StringIO(data)
     size = readEncodedNumber(fo)
     for i in xrange(size):
         tag = readString(fo)
@@ -100,14 +109,19 @@ def getMetaArray(metaFile):
 
 # dictionary of all text strings by index value
 class Dictionary(object):
-    def __init__(self, dictFile):
+    def __init__(self, dictFile, data=None):
         self.filename = dictFile
         self.size = 0
-        self.fo = file(dictFile,'rb')
+        if data is None:
+            fo = file(dictFile,'rb')
+        else:
+            fo = StringIO(data)
         self.stable = []
-        self.size = readEncodedNumber(self.fo)
+        self.size = readEncodedNumber(fo)
         for i in xrange(self.size):
-            self.stable.append(self.escapestr(readString(self.fo)))
+            self.stable.append(self.escapestr(readString(fo)))
+        # no file is kept open, so the dictionary can be sent to page workers
+        fo.close()
         self.pos = 0
     def escapestr(self, str):
         str = str.replace('&','&amp;')
@@ -131,29 +145,10 @@ class Dictionary(object):
 
 class PageDimParser(object):
     def __init__(self, flatxml):
-        self.flatdoc = flatxml.split('\n')
+        self.doc = flatxmldoc.FlatXMLDoc(flatxml)
     # find tag if within pos to end inclusive
     def findinDoc(self, tagpath, pos, end) :
-        result = None
-        docList = self.flatdoc
-        cnt = len(docList)
-        if end == -1 :
-            end = cnt
-        else:
-            end = min(cnt,end)
-        foundat = -1
-        for j in xrange(pos, end):
-            item = docList[j]
-            if item.find('=') >= 0:
-                (name, argres) = item.split('=')
-            else :
-                name = item
-                argres = ''
-            if name.endswith(tagpath) :
-                result = argres
-                foundat = j
-                break
-        return foundat, result
+        return self.doc.findinDoc(tagpath, pos, end)
     def process(self):
         (pos, sph) = self.findinDoc('page.h',0,-1)
         (pos, spw) = self.findinDoc('page.w',0,-1)
@@ -169,7 +164,7 @@ def getPageDim(flatxml):
 
 class GParser(object):
     def __init__(self, flatxml):
-        self.flatdoc = flatxml.split('\n')
+        self.doc = flatxmldoc.FlatXMLDoc(flatxml)
         self.dpi = 1440
         self.gh = self.getData('info.glyph.h')
         self.gw = self.getData('info.glyph.w')
@@ -193,23 +188,11 @@ class GParser(object):
         elif self.gvtx :
             self.gvtx.append(0)
     def getData(self, path):
-        result = None
-        cnt = len(self.flatdoc)
-        for j in xrange(cnt):
-            item = self.flatdoc[j]
-            if item.find('=') >= 0:
-                (name, argt) = item.split('=')
-                argres = argt.split('|')
-            else:
-                name = item
-                argres = []
-            if (name == path):
-                result = argres
-                break
-        if (len(argres) > 0) :
-            for j in xrange(0,len(argres)):
-                argres[j] = int(argres[j])
-        return result
+        # glyph tags are matched on their whole name
+        startpos = self.doc.index.get(path)
+        if startpos is None:
+            return None
+        return self.doc.getInts(startpos[0])
     def getGlyphDim(self, gly):
         if self.gdpi[gly] == 0:
             return 0, 0
@@ -254,93 +237,215 @@ class GParser(object):
 
 
 
-# dictionary of all text strings by index value
+# all the glyphs of the book by id. Scanned books use the same few shapes
+# over and over, so identical path data is only kept once. The svg <path>
+# of each glyph is made once, when it is added, and handed out from then on.
+# The images made of runs of glyphs are remembered too (the most recently
+# used maxruns of them), so a run that comes up again can refer to the
+# image already written.
 class GlyphDict(object):
-    def __init__(self):
+    def __init__(self, maxruns=4096):
         self.gdict = {}
+        self.paths = {}
+        self.svgs = {}
+        self.runs = OrderedDict()
+        self.maxruns = maxruns
     def lookup(self, id):
         # id='id="gl%d"' % val
-        if id in self.gdict:
-            return self.gdict[id]
-        return None
-    def addGlyph(self, val, path):
+        return self.svgs.get(id)
+    def addGlyph(self, val, path, maxw, maxh):
         id='id="gl%d"' % val
-        self.gdict[id] = path
-
-
-def generateBook(bookDir, raw, fixedimage):
-    # sanity check Topaz file extraction
+        path = self.paths.setdefault(path, path)
+        self.gdict[id] = (val, path, maxw, maxh)
+        self.svgs[id] = '<path id="gl%d" d="%s" fill="black" /><!-- width=%d height=%d -->\n' % self.gdict[id]
+    def lookupRun(self, run):
+        # name of the image written for a run of glyphs, or None
+        name = self.runs.pop(run, None)
+        if name is not None:
+            self.runs[run] = name
+        return name
+    def addRun(self, run, name):
+        self.runs[run] = name
+        while len(self.runs) > self.maxruns:
+            self.runs.popitem(last=False)
+
+
+# the extracted records of a Topaz book, read from the directory they
+# were unpacked to. Record names are paths relative to that directory,
+# e.g. 'dict0000.dat' or 'page/page0000.dat'. topazextract.TopazRecords
+# provides the same interface straight from the .tpz file.
+class BookFiles(object):
+    def __init__(self, bookDir):
+        self.bookDir = bookDir
+
+    def __contains__(self, name):
+        return os.path.isfile(os.path.join(self.bookDir, name))
+
+    def __getitem__(self, name):
+        try:
+            return file(os.path.join(self.bookDir, name), 'rb').read()
+        except IOError:
+            raise KeyError(name)
+
+    def fetch(self, names, workers=1):
+        # yields the records for names, in order
+        for name in names:
+            yield self[name]
+
+    def listdir(self, dirname):
+        # sorted names of the records in dirname
+        path = os.path.join(self.bookDir, dirname)
+        if not os.path.isdir(path):
+            return []
+        return sorted(f for f in os.listdir(path) if os.path.isfile(os.path.join(path, f)))
+
+
+# Pages are converted by a pool of worker processes when there is more
+# than one worker. What every page needs (the dictionary, the style
+# classes, the glyphs and the book settings) is handed to each worker
+# once, when it starts, and kept in workerState.
+workerState = None
+
+# most pages handed to a worker at once
+PAGE_BATCH = 8
+
+def initWorker(state):
+    global workerState
+    workerState = state
+
+def runBatch(func, items):
+    return [func(item) for item in items]
+
+class PageWorkers(workerpool.WorkerPool):
+    def __init__(self, state, workers):
+        workerpool.WorkerPool.__init__(self, workers, False, initWorker, (state,))
+
+    def map(self, func, items, count):
+        # yields func(item) for each of the count items, in order. items
+        # may be a generator, so a book is never all in memory.
+        return workerpool.WorkerPool.map(self, runBatch, func, items, count, PAGE_BATCH)
+
+    def close(self):
+        workerpool.WorkerPool.close(self)
+        initWorker(None)
+
+    def terminate(self):
+        workerpool.WorkerPool.terminate(self)
+        initWorker(None)
+
+# convert one page file to html
+def convertPage(page):
+    fname, data = page
+    state = workerState
+    flat_xml = convert2xml.fromData(state['dict'], fname, data)
+
+    if state['xmlDir']:
+        xname = os.path.join(state['xmlDir'], os.path.basename(fname).replace('.dat','.xml'))
+        file(xname, 'wb').write(convert2xml.getXML(state['dict'], fname, data))
+
+    pagehtml, tocinfo = flatxml2html.convert2HTML(flat_xml, state['classlst'], fname, state['bookDir'], state['gd'], state['fixedimage'])
+    return pagehtml, tocinfo
+
+# render the page files of one book page as svg
+def renderPage(job):
+    pageid, previd, nextid, pages = job
+    state = workerState
+    flat_svg = "".join([convert2xml.fromData(state['dict'], fname, data) for (fname, data) in pages])
+    return flatxml2svg.convert2SVG(state['gd'], flat_svg, pageid, previd, nextid, state['svgDir'], state['raw'], state['meta_array'], state['scaledpi'])
+
+
+def generateBook(bookDir, raw, fixedimage, records=None, workers=1, renditions=None):
+    # records is a record store like BookFiles holding the extracted book.
+    # Without one the records are read from bookDir. Everything generated
+    # is written to bookDir. With workers > 1 records are read and pages
+    # are converted by that many processes.
+    # renditions is the set of outputs to make: 'html' (book.html, book.opf
+    # and the images), 'svg' (the svg pages and index_svg.xhtml) and 'xml'.
+    # By default html and svg, and xml if buildXML is set. The svg table of
+    # contents and the xml come from the html pass, so that pass also runs
+    # for xml, and for svg if it hasn't been run before.
     if not os.path.exists(bookDir) :
         print("Can not find directory with unencrypted book")
         return 1
 
-    dictFile = os.path.join(bookDir,'dict0000.dat')
-    if not os.path.exists(dictFile) :
+    if records is None:
+        print("Updating to color images if available")
+        spath = os.path.join(bookDir,'color_img')
+        dpath = os.path.join(bookDir,'img')
+        filenames = []
+        if os.path.isdir(spath):
+            filenames = sorted(os.listdir(spath))
+        for filename in filenames:
+            imgname = filename.replace('color','img')
+            sfile = os.path.join(spath,filename)
+            dfile = os.path.join(dpath,imgname)
+            imgdata = file(sfile,'rb').read()
+            file(dfile,'wb').write(imgdata)
+        records = BookFiles(bookDir)
+
+    # sanity check Topaz file extraction
+    dictFile = 'dict0000.dat'
+    if dictFile not in records :
         print("Can not find dict0000.dat file")
         return 1
 
-    pageDir = os.path.join(bookDir,'page')
-    if not os.path.exists(pageDir) :
+    pagenames = records.listdir('page')
+    if len(pagenames) == 0 :
         print("Can not find page directory in unencrypted book")
         return 1
 
-    imgDir = os.path.join(bookDir,'img')
-    if not os.path.exists(imgDir) :
-        print("Can not find image directory in unencrypted book")
-        return 1
-
-    glyphsDir = os.path.join(bookDir,'glyphs')
-    if not os.path.exists(glyphsDir) :
+    glyphnames = records.listdir('glyphs')
+    if len(glyphnames) == 0 :
         print("Can not find glyphs directory in unencrypted book")
         return 1
 
-    metaFile = os.path.join(bookDir,'metadata0000.dat')
-    if not os.path.exists(metaFile) :
+    metaFile = 'metadata0000.dat'
+    if metaFile not in records :
         print("Can not find metadata0000.dat in unencrypted book")
         return 1
 
+    # generated glyph images go next to the book's own images
+    imgDir = os.path.join(bookDir,'img')
+    if not os.path.exists(imgDir) :
+        os.makedirs(imgDir)
+
     svgDir = os.path.join(bookDir,'svg')
     if not os.path.exists(svgDir) :
         os.makedirs(svgDir)
 
-    if buildXML:
+    if renditions is None:
+        renditions = set(['html', 'svg'])
+        if buildXML:
+            renditions.add('xml')
+    makeXML = 'xml' in renditions
+    makeSVG = 'svg' in renditions
+    makeHTML = ('html' in renditions) or makeXML or (makeSVG and not os.path.isfile(os.path.join(svgDir, 'toc.xhtml')))
+
+    if makeXML:
         xmlDir = os.path.join(bookDir,'xml')
         if not os.path.exists(xmlDir) :
             os.makedirs(xmlDir)
 
-    otherFile = os.path.join(bookDir,'other0000.dat')
-    if not os.path.exists(otherFile) :
+    otherFile = 'other0000.dat'
+    if otherFile not in records :
         print("Can not find other0000.dat in unencrypted book")
         return 1
 
-    print("Updating to color images if available")
-    spath = os.path.join(bookDir,'color_img')
-    dpath = os.path.join(bookDir,'img')
-    filenames = os.listdir(spath)
-    filenames = sorted(filenames)
-    for filename in filenames:
-        imgname = filename.replace('color','img')
-        sfile = os.path.join(spath,filename)
-        dfile = os.path.join(dpath,imgname)
-        imgdata = file(sfile,'rb').read()
-        file(dfile,'wb').write(imgdata)
-
     print("Creating cover.jpg")
     isCover = False
-    cpath = os.path.join(bookDir,'img')
-    cpath = os.path.join(cpath,'img0000.jpg')
-    if os.path.isfile(cpath):
-        cover = file(cpath, 'rb').read()
+    cpath = 'img/img0000.jpg'
+    if cpath in records:
+        cover = records[cpath]
         cpath = os.path.join(bookDir,'cover.jpg')
         file(cpath, 'wb').write(cover)
         isCover = True
 
 
     print('Processing Dictionary')
-    dict = Dictionary(dictFile)
+    dict = Dictionary(dictFile, records[dictFile])
 
     print('Processing Meta Data and creating OPF')
-    meta_array = getMetaArray(metaFile)
+    meta_array = getMetaArray(metaFile, records[metaFile])
 
     # replace special chars in title and authors like & < >
     title = meta_array.get('Title','No Title Provided')
@@ -354,7 +459,7 @@ def generateBook(bookDir, raw, fixedimage):
     authors = authors.replace('>','&gt;')
     meta_array['Authors'] = authors
 
-    if buildXML:
+    if makeXML:
         xname = os.path.join(xmlDir, 'metadata.xml')
         mlst = []
         for key in meta_array:
@@ -374,8 +479,7 @@ def generateBook(bookDir, raw, fixedimage):
 
     # also get the size of a normal text page
     # get the total number of pages unpacked as a safety check
-    filenames = os.listdir(pageDir)
-    numfiles = len(filenames)
+    numfiles = len(pagenames)
 
     spage = '1'
     if 'firstTextPage' in meta_array:
@@ -388,9 +492,8 @@ def generateBook(bookDir, raw, fixedimage):
     # print "first normal text page is", spage
 
     # get page height and width from first text page for use in stylesheet scaling
-    pname = 'page%04d.dat' % (pnum - 1)
-    fname = os.path.join(pageDir,pname)
-    flat_xml = convert2xml.fromData(dict, fname)
+    fname = 'page/page%04d.dat' % (pnum - 1)
+    flat_xml = convert2xml.fromData(dict, fname, records[fname])
 
     (ph, pw) = getPageDim(flat_xml)
     if (ph == '-1') or (ph == '0') : ph = '11000'
@@ -404,14 +507,14 @@ def generateBook(bookDir, raw, fixedimage):
     # this map is needed because some pages actually are made up of multiple
     # pageXXXX.xml files
     xname = os.path.join(bookDir, 'style.css')
-    flat_xml = convert2xml.fromData(dict, otherFile)
+    otherData = records[otherFile]
+    flat_xml = convert2xml.fromData(dict, otherFile, otherData)
 
     # extract info.original.pid to get original page information
     pageIDMap = {}
     pageidnums = stylexml2css.getpageIDMap(flat_xml)
     if len(pageidnums) == 0:
-        filenames = os.listdir(pageDir)
-        numfiles = len(filenames)
+        numfiles = len(pagenames)
         for k in range(numfiles):
             pageidnums.append(k)
     # create a map from page ids to list of page file nums to process for that page
@@ -425,250 +528,262 @@ def generateBook(bookDir, raw, fixedimage):
     # now get the css info
     cssstr , classlst = stylexml2css.convert2CSS(flat_xml, fontsize, ph, pw)
     file(xname, 'wb').write(cssstr)
-    if buildXML:
+    if makeXML:
         xname = os.path.join(xmlDir, 'other0000.xml')
-        file(xname, 'wb').write(convert2xml.getXML(dict, otherFile))
+        file(xname, 'wb').write(convert2xml.getXML(dict, otherFile, otherData))
 
     print('Processing Glyphs')
     gd = GlyphDict()
-    filenames = os.listdir(glyphsDir)
-    filenames = sorted(filenames)
-    glyfname = os.path.join(svgDir,'glyphs.svg')
-    glyfile = open(glyfname, 'w')
-    glyfile.write('<?xml version="1.0" standalone="no"?>\n')
-    glyfile.write('<!DOCTYPE svg PUBLIC "-//W3C/DTD SVG 1.1//EN" "http://www.w3.org/Graphics/SVG/1.1/DTD/svg11.dtd">\n')
-    glyfile.write('<svg width="512" height="512" viewBox="0 0 511 511" xmlns="http://www.w3.org/2000/svg" version="1.1">\n')
-    glyfile.write('<title>Glyphs for %s</title>\n' % meta_array['Title'])
-    glyfile.write('<defs>\n')
+    if makeSVG:
+        glyfname = os.path.join(svgDir,'glyphs.svg')
+        glyfile = open(glyfname, 'w')
+        glyfile.write('<?xml version="1.0" standalone="no"?>\n')
+        glyfile.write('<!DOCTYPE svg PUBLIC "-//W3C/DTD SVG 1.1//EN" "http://www.w3.org/Graphics/SVG/1.1/DTD/svg11.dtd">\n')
+        glyfile.write('<svg width="512" height="512" viewBox="0 0 511 511" xmlns="http://www.w3.org/2000/svg" version="1.1">\n')
+        glyfile.write('<title>Glyphs for %s</title>\n' % meta_array['Title'])
+        glyfile.write('<defs>\n')
     counter = 0
-    for filename in filenames:
+    glyphkeys = ['glyphs/' + filename for filename in glyphnames]
+    for (i, data) in enumerate(records.fetch(glyphkeys, workers)):
+        filename = glyphnames[i]
         # print '     ', filename
         print('.', end=' ')
-        fname = os.path.join(glyphsDir,filename)
-        flat_xml = convert2xml.fromData(dict, fname)
+        fname = glyphkeys[i]
+        flat_xml = convert2xml.fromData(dict, fname, data)
 
-        if buildXML:
+        if makeXML:
             xname = os.path.join(xmlDir, filename.replace('.dat','.xml'))
-            file(xname, 'wb').write(convert2xml.getXML(dict, fname))
+            file(xname, 'wb').write(convert2xml.getXML(dict, fname, data))
 
         gp = GParser(flat_xml)
         for i in xrange(0, gp.count):
             path = gp.getPath(i)
             maxh, maxw = gp.getGlyphDim(i)
-            fullpath = '<path id="gl%d" d="%s" fill="black" /><!-- width=%d height=%d -->\n' % (counter * 256 + i, path, maxw, maxh)
-            glyfile.write(fullpath)
-            gd.addGlyph(counter * 256 + i, fullpath)
+            gd.addGlyph(counter * 256 + i, path, maxw, maxh)
+            if makeSVG:
+                glyfile.write(gd.lookup('id="gl%d"' % (counter * 256 + i)))
         counter += 1
-    glyfile.write('</defs>\n')
-    glyfile.write('</svg>\n')
-    glyfile.close()
+    if makeSVG:
+        glyfile.write('</defs>\n')
+        glyfile.write('</svg>\n')
+        glyfile.close()
     print(" ")
 
-
-    # start up the html
-    # also build up tocentries while processing html
-    htmlFileName = "book.html"
-    hlst = []
-    hlst.append('<?xml version="1.0" encoding="utf-8"?>\n')
-    hlst.append('<!DOCTYPE HTML PUBLIC "-//W3C//DTD XHTML 1.1 Strict//EN" "http://www.w3.org/TR/xhtml11/DTD/xhtml11-strict.dtd">\n')
-    hlst.append('<html xmlns="http://www.w3.org/1999/xhtml" xml:lang="en">\n')
-    hlst.append('<head>\n')
-    hlst.append('<meta http-equiv="content-type" content="text/html; charset=utf-8"/>\n')
-    hlst.append('<title>' + meta_array['Title'] + ' by ' + meta_array['Authors'] + '</title>\n')
-    hlst.append('<meta name="Author" content="' + meta_array['Authors'] + '" />\n')
-    hlst.append('<meta name="Title" content="' + meta_array['Title'] + '" />\n')
-    if 'ASIN' in meta_array:
-        hlst.append('<meta name="ASIN" content="' + meta_array['ASIN'] + '" />\n')
-    if 'GUID' in meta_array:
-        hlst.append('<meta name="GUID" content="' + meta_array['GUID'] + '" />\n')
-    hlst.append('<link href="style.css" rel="stylesheet" type="text/css" />\n')
-    hlst.append('</head>\n<body>\n')
-
-    print('Processing Pages')
     # Books are at 1440 DPI.  This is rendering at twice that size for
     # readability when rendering to the screen.
     scaledpi = 1440.0
 
-    filenames = os.listdir(pageDir)
-    filenames = sorted(filenames)
-    numfiles = len(filenames)
-
-    xmllst = []
-    elst = []
-
-    for filename in filenames:
-        # print '     ', filename
-        print(".", end=' ')
-        fname = os.path.join(pageDir,filename)
-        flat_xml = convert2xml.fromData(dict, fname)
-
-        # keep flat_xml for later svg processing
-        xmllst.append(flat_xml)
-
-        if buildXML:
-            xname = os.path.join(xmlDir, filename.replace('.dat','.xml'))
-            file(xname, 'wb').write(convert2xml.getXML(dict, fname))
-
-        # first get the html
-        pagehtml, tocinfo = flatxml2html.convert2HTML(flat_xml, classlst, fname, bookDir, gd, fixedimage)
-        elst.append(tocinfo)
-        hlst.append(pagehtml)
-
-    # finish up the html string and output it
-    hlst.append('</body>\n</html>\n')
-    htmlstr = "".join(hlst)
-    hlst = None
-    file(os.path.join(bookDir, htmlFileName), 'wb').write(htmlstr)
-
-    print(" ")
-    print('Extracting Table of Contents from Amazon OCR')
-
-    # first create a table of contents file for the svg images
-    tlst = []
-    tlst.append('<?xml version="1.0" encoding="utf-8"?>\n')
-    tlst.append('<!DOCTYPE html PUBLIC "-//W3C//DTD XHTML 1.1//EN" "http://www.w3.org/TR/xhtml11/DTD/xhtml11.dtd">\n')
-    tlst.append('<html xmlns="http://www.w3.org/1999/xhtml" xml:lang="en" >')
-    tlst.append('<head>\n')
-    tlst.append('<title>' + meta_array['Title'] + '</title>\n')
-    tlst.append('<meta name="Author" content="' + meta_array['Authors'] + '" />\n')
-    tlst.append('<meta name="Title" content="' + meta_array['Title'] + '" />\n')
-    if 'ASIN' in meta_array:
-        tlst.append('<meta name="ASIN" content="' + meta_array['ASIN'] + '" />\n')
-    if 'GUID' in meta_array:
-        tlst.append('<meta name="GUID" content="' + meta_array['GUID'] + '" />\n')
-    tlst.append('</head>\n')
-    tlst.append('<body>\n')
-
-    tlst.append('<h2>Table of Contents</h2>\n')
-    start = pageidnums[0]
-    if (raw):
-        startname = 'page%04d.svg' % start
-    else:
-        startname = 'page%04d.xhtml' % start
-
-    tlst.append('<h3><a href="' + startname + '">Start of Book</a></h3>\n')
-    # build up a table of contents for the svg xhtml output
-    tocentries = "".join(elst)
-    elst = None
-    toclst = tocentries.split('\n')
-    toclst.pop()
-    for entry in toclst:
-        print(entry)
-        title, pagenum = entry.split('|')
-        id = pageidnums[int(pagenum)]
+    numfiles = len(pagenames)
+
+    state = {'dict': dict, 'classlst': classlst, 'gd': gd, 'bookDir': bookDir, 'fixedimage': fixedimage,
+             'xmlDir': xmlDir if makeXML else None, 'svgDir': svgDir, 'raw': raw,
+             'meta_array': meta_array, 'scaledpi': scaledpi}
+    pool = PageWorkers(state, workers)
+    pagekeys = ['page/' + filename for filename in pagenames]
+
+    if makeHTML:
+        print('Processing Pages')
+        elst = []
+
+        # start up the html
+        # also build up tocentries while processing html
+        htmlFileName = "book.html"
+        hfile = open(os.path.join(bookDir, htmlFileName), 'wb')
+        hlst = []
+        hlst.append('<?xml version="1.0" encoding="utf-8"?>\n')
+        hlst.append('<!DOCTYPE HTML PUBLIC "-//W3C//DTD XHTML 1.1 Strict//EN" "http://www.w3.org/TR/xhtml11/DTD/xhtml11-strict.dtd">\n')
+        hlst.append('<html xmlns="http://www.w3.org/1999/xhtml" xml:lang="en">\n')
+        hlst.append('<head>\n')
+        hlst.append('<meta http-equiv="content-type" content="text/html; charset=utf-8"/>\n')
+        hlst.append('<title>' + meta_array['Title'] + ' by ' + meta_array['Authors'] + '</title>\n')
+        hlst.append('<meta name="Author" content="' + meta_array['Authors'] + '" />\n')
+        hlst.append('<meta name="Title" content="' + meta_array['Title'] + '" />\n')
+        if 'ASIN' in meta_array:
+            hlst.append('<meta name="ASIN" content="' + meta_array['ASIN'] + '" />\n')
+        if 'GUID' in meta_array:
+            hlst.append('<meta name="GUID" content="' + meta_array['GUID'] + '" />\n')
+        hlst.append('<link href="style.css" rel="stylesheet" type="text/css" />\n')
+        hlst.append('</head>\n<body>\n')
+        hfile.write("".join(hlst))
+        hlst = None
+
+        try:
+            pages = ((pagekeys[i], data) for (i, data) in enumerate(records.fetch(pagekeys, workers)))
+            # each page goes straight out to the html file
+            for (pagehtml, tocinfo) in pool.map(convertPage, pages, numfiles):
+                print(".", end=' ')
+                elst.append(tocinfo)
+                hfile.write(pagehtml)
+        except:
+            pool.terminate()
+            hfile.close()
+            raise
+
+        # finish up the html and close it
+        hfile.write('</body>\n</html>\n')
+        hfile.close()
+
+        print(" ")
+        print('Extracting Table of Contents from Amazon OCR')
+
+        # first create a table of contents file for the svg images
+        tlst = []
+        tlst.append('<?xml version="1.0" encoding="utf-8"?>\n')
+        tlst.append('<!DOCTYPE html PUBLIC "-//W3C//DTD XHTML 1.1//EN" "http://www.w3.org/TR/xhtml11/DTD/xhtml11.dtd">\n')
+        tlst.append('<html xmlns="http://www.w3.org/1999/xhtml" xml:lang="en" >')
+        tlst.append('<head>\n')
+        tlst.append('<title>' + meta_array['Title'] + '</title>\n')
+        tlst.append('<meta name="Author" content="' + meta_array['Authors'] + '" />\n')
+        tlst.append('<meta name="Title" content="' + meta_array['Title'] + '" />\n')
+        if 'ASIN' in meta_array:
+            tlst.append('<meta name="ASIN" content="' + meta_array['ASIN'] + '" />\n')
+        if 'GUID' in meta_array:
+            tlst.append('<meta name="GUID" content="' + meta_array['GUID'] + '" />\n')
+        tlst.append('</head>\n')
+        tlst.append('<body>\n')
+
+        tlst.append('<h2>Table of Contents</h2>\n')
+        start = pageidnums[0]
         if (raw):
-            fname = 'page%04d.svg' % id
+            startname = 'page%04d.svg' % start
         else:
-            fname = 'page%04d.xhtml' % id
-        tlst.append('<h3><a href="'+ fname + '">' + title + '</a></h3>\n')
-    tlst.append('</body>\n')
-    tlst.append('</html>\n')
-    tochtml = "".join(tlst)
-    file(os.path.join(svgDir, 'toc.xhtml'), 'wb').write(tochtml)
-
-
-    # now create index_svg.xhtml that points to all required files
-    slst = []
-    slst.append('<?xml version="1.0" encoding="utf-8"?>\n')
-    slst.append('<!DOCTYPE html PUBLIC "-//W3C//DTD XHTML 1.1//EN" "http://www.w3.org/TR/xhtml11/DTD/xhtml11.dtd">\n')
-    slst.append('<html xmlns="http://www.w3.org/1999/xhtml" xml:lang="en" >')
-    slst.append('<head>\n')
-    slst.append('<title>' + meta_array['Title'] + '</title>\n')
-    slst.append('<meta name="Author" content="' + meta_array['Authors'] + '" />\n')
-    slst.append('<meta name="Title" content="' + meta_array['Title'] + '" />\n')
-    if 'ASIN' in meta_array:
-        slst.append('<meta name="ASIN" content="' + meta_array['ASIN'] + '" />\n')
-    if 'GUID' in meta_array:
-        slst.append('<meta name="GUID" content="' + meta_array['GUID'] + '" />\n')
-    slst.append('</head>\n')
-    slst.append('<body>\n')
-
-    print("Building svg images of each book page")
-    slst.append('<h2>List of Pages</h2>\n')
-    slst.append('<div>\n')
-    idlst = sorted(pageIDMap.keys())
-    numids = len(idlst)
-    cnt = len(idlst)
-    previd = None
-    for j in range(cnt):
-        pageid = idlst[j]
-        if j < cnt - 1:
-            nextid = idlst[j+1]
-        else:
-            nextid = None
-        print('.', end=' ')
-        pagelst = pageIDMap[pageid]
-        flst = []
-        for page in pagelst:
-            flst.append(xmllst[page])
-        flat_svg = "".join(flst)
-        flst=None
-        svgxml = flatxml2svg.convert2SVG(gd, flat_svg, pageid, previd, nextid, svgDir, raw, meta_array, scaledpi)
-        if (raw) :
-            pfile = open(os.path.join(svgDir,'page%04d.svg' % pageid),'w')
-            slst.append('<a href="svg/page%04d.svg">Page %d</a>\n' % (pageid, pageid))
-        else :
-            pfile = open(os.path.join(svgDir,'page%04d.xhtml' % pageid), 'w')
-            slst.append('<a href="svg/page%04d.xhtml">Page %d</a>\n' % (pageid, pageid))
-        previd = pageid
-        pfile.write(svgxml)
-        pfile.close()
-        counter += 1
-    slst.append('</div>\n')
-    slst.append('<h2><a href="svg/toc.xhtml">Table of Contents</a></h2>\n')
-    slst.append('</body>\n</html>\n')
-    svgindex = "".join(slst)
-    slst = None
-    file(os.path.join(bookDir, 'index_svg.xhtml'), 'wb').write(svgindex)
-
-    print(" ")
-
-    # build the opf file
-    opfname = os.path.join(bookDir, 'book.opf')
-    olst = []
-    olst.append('<?xml version="1.0" encoding="utf-8"?>\n')
-    olst.append('<package xmlns="http://www.idpf.org/2007/opf" unique-identifier="guid_id">\n')
-    # adding metadata
-    olst.append('   <metadata xmlns:dc="http://purl.org/dc/elements/1.1/" xmlns:opf="http://www.idpf.org/2007/opf">\n')
-    if 'GUID' in meta_array:
-        olst.append('      <dc:identifier opf:scheme="GUID" id="guid_id">' + meta_array['GUID'] + '</dc:identifier>\n')
-    if 'ASIN' in meta_array:
-        olst.append('      <dc:identifier opf:scheme="ASIN">' + meta_array['ASIN'] + '</dc:identifier>\n')
-    if 'oASIN' in meta_array:
-        olst.append('      <dc:identifier opf:scheme="oASIN">' + meta_array['oASIN'] + '</dc:identifier>\n')
-    olst.append('      <dc:title>' + meta_array['Title'] + '</dc:title>\n')
-    olst.append('      <dc:creator opf:role="aut">' + meta_array['Authors'] + '</dc:creator>\n')
-    olst.append('      <dc:language>en</dc:language>\n')
-    olst.append('      <dc:date>' + meta_array['UpdateTime'] + '</dc:date>\n')
-    if isCover:
-        olst.append('      <meta name="cover" content="bookcover"/>\n')
-    olst.append('   </metadata>\n')
-    olst.append('<manifest>\n')
-    olst.append('   <item id="book" href="book.html" media-type="application/xhtml+xml"/>\n')
-    olst.append('   <item id="stylesheet" href="style.css" media-type="text/css"/>\n')
-    # adding image files to manifest
-    filenames = os.listdir(imgDir)
-    filenames = sorted(filenames)
-    for filename in filenames:
-        imgname, imgext = os.path.splitext(filename)
-        if imgext == '.jpg':
-            imgext = 'jpeg'
-        if imgext == '.svg':
-            imgext = 'svg+xml'
-        olst.append('   <item id="' + imgname + '" href="img/' + filename + '" media-type="image/' + imgext + '"/>\n')
-    if isCover:
-        olst.append('   <item id="bookcover" href="cover.jpg" media-type="image/jpeg" />\n')
-    olst.append('</manifest>\n')
-    # adding spine
-    olst.append('<spine>\n   <itemref idref="book" />\n</spine>\n')
-    if isCover:
-        olst.append('   <guide>\n')
-        olst.append('      <reference href="cover.jpg" type="cover" title="Cover"/>\n')
-        olst.append('   </guide>\n')
-    olst.append('</package>\n')
-    opfstr = "".join(olst)
-    olst = None
-    file(opfname, 'wb').write(opfstr)
+            startname = 'page%04d.xhtml' % start
+
+        tlst.append('<h3><a href="' + startname + '">Start of Book</a></h3>\n')
+        # build up a table of contents for the svg xhtml output
+        tocentries = "".join(elst)
+        elst = None
+        toclst = tocentries.split('\n')
+        toclst.pop()
+        for entry in toclst:
+            print(entry)
+            title, pagenum = entry.split('|')
+            id = pageidnums[int(pagenum)]
+            if (raw):
+                fname = 'page%04d.svg' % id
+            else:
+                fname = 'page%04d.xhtml' % id
+            tlst.append('<h3><a href="'+ fname + '">' + title + '</a></h3>\n')
+        tlst.append('</body>\n')
+        tlst.append('</html>\n')
+        tochtml = "".join(tlst)
+        file(os.path.join(svgDir, 'toc.xhtml'), 'wb').write(tochtml)
+
+    if makeSVG:
+        # now create index_svg.xhtml that points to all required files
+        slst = []
+        slst.append('<?xml version="1.0" encoding="utf-8"?>\n')
+        slst.append('<!DOCTYPE html PUBLIC "-//W3C//DTD XHTML 1.1//EN" "http://www.w3.org/TR/xhtml11/DTD/xhtml11.dtd">\n')
+        slst.append('<html xmlns="http://www.w3.org/1999/xhtml" xml:lang="en" >')
+        slst.append('<head>\n')
+        slst.append('<title>' + meta_array['Title'] + '</title>\n')
+        slst.append('<meta name="Author" content="' + meta_array['Authors'] + '" />\n')
+        slst.append('<meta name="Title" content="' + meta_array['Title'] + '" />\n')
+        if 'ASIN' in meta_array:
+            slst.append('<meta name="ASIN" content="' + meta_array['ASIN'] + '" />\n')
+        if 'GUID' in meta_array:
+            slst.append('<meta name="GUID" content="' + meta_array['GUID'] + '" />\n')
+        slst.append('</head>\n')
+        slst.append('<body>\n')
+
+        print("Building svg images of each book page")
+        slst.append('<h2>List of Pages</h2>\n')
+        slst.append('<div>\n')
+        idlst = sorted(pageIDMap.keys())
+        numids = len(idlst)
+        cnt = len(idlst)
+
+        # the page files are read and converted again rather than kept
+        # from the html pass, each svg page taking the files mapped to it
+        def svgJobs():
+            svgkeys = [pagekeys[page] for pageid in idlst for page in pageIDMap[pageid]]
+            data = iter(records.fetch(svgkeys, workers))
+            previd = None
+            for j in range(cnt):
+                pageid = idlst[j]
+                if j < cnt - 1:
+                    nextid = idlst[j+1]
+                else:
+                    nextid = None
+                pages = [(pagekeys[page], data.next()) for page in pageIDMap[pageid]]
+                yield (pageid, previd, nextid, pages)
+                previd = pageid
+
+        try:
+            for (j, svgxml) in enumerate(pool.map(renderPage, svgJobs(), cnt)):
+                pageid = idlst[j]
+                print('.', end=' ')
+                if (raw) :
+                    pfile = open(os.path.join(svgDir,'page%04d.svg' % pageid),'w')
+                    slst.append('<a href="svg/page%04d.svg">Page %d</a>\n' % (pageid, pageid))
+                else :
+                    pfile = open(os.path.join(svgDir,'page%04d.xhtml' % pageid), 'w')
+                    slst.append('<a href="svg/page%04d.xhtml">Page %d</a>\n' % (pageid, pageid))
+                pfile.write(svgxml)
+                pfile.close()
+                counter += 1
+        except:
+            pool.terminate()
+            raise
+        slst.append('</div>\n')
+        slst.append('<h2><a href="svg/toc.xhtml">Table of Contents</a></h2>\n')
+        slst.append('</body>\n</html>\n')
+        svgindex = "".join(slst)
+        slst = None
+        file(os.path.join(bookDir, 'index_svg.xhtml'), 'wb').write(svgindex)
+
+        print(" ")
+
+    pool.close()
+
+    if makeHTML:
+        # build the opf file
+        opfname = os.path.join(bookDir, 'book.opf')
+        olst = []
+        olst.append('<?xml version="1.0" encoding="utf-8"?>\n')
+        olst.append('<package xmlns="http://www.idpf.org/2007/opf" unique-identifier="guid_id">\n')
+        # adding metadata
+        olst.append('   <metadata xmlns:dc="http://purl.org/dc/elements/1.1/" xmlns:opf="http://www.idpf.org/2007/opf">\n')
+        if 'GUID' in meta_array:
+            olst.append('      <dc:identifier opf:scheme="GUID" id="guid_id">' + meta_array['GUID'] + '</dc:identifier>\n')
+        if 'ASIN' in meta_array:
+            olst.append('      <dc:identifier opf:scheme="ASIN">' + meta_array['ASIN'] + '</dc:identifier>\n')
+        if 'oASIN' in meta_array:
+            olst.append('      <dc:identifier opf:scheme="oASIN">' + meta_array['oASIN'] + '</dc:identifier>\n')
+        olst.append('      <dc:title>' + meta_array['Title'] + '</dc:title>\n')
+        olst.append('      <dc:creator opf:role="aut">' + meta_array['Authors'] + '</dc:creator>\n')
+        olst.append('      <dc:language>en</dc:language>\n')
+        olst.append('      <dc:date>' + meta_array['UpdateTime'] + '</dc:date>\n')
+        if isCover:
+            olst.append('      <meta name="cover" content="bookcover"/>\n')
+        olst.append('   </metadata>\n')
+        olst.append('<manifest>\n')
+        olst.append('   <item id="book" href="book.html" media-type="application/xhtml+xml"/>\n')
+        olst.append('   <item id="stylesheet" href="style.css" media-type="text/css"/>\n')
+        # adding image files to manifest, both the book's and the generated ones
+        filenames = set(records.listdir('img'))
+        filenames.update(os.listdir(imgDir))
+        filenames = sorted(filenames)
+        for filename in filenames:
+            imgname, imgext = os.path.splitext(filename)
+            if imgext == '.jpg':
+                imgext = 'jpeg'
+            if imgext == '.svg':
+                imgext = 'svg+xml'
+            olst.append('   <item id="' + imgname + '" href="img/' + filename + '" media-type="image/' + imgext + '"/>\n')
+        if isCover:
+            olst.append('   <item id="bookcover" href="cover.jpg" media-type="image/jpeg" />\n')
+        olst.append('</manifest>\n')
+        # adding spine
+        olst.append('<spine>\n   <itemref idref="book" />\n</spine>\n')
+        if isCover:
+            olst.append('   <guide>\n')
+            olst.append('      <reference href="cover.jpg" type="cover" title="Cover"/>\n')
+            olst.append('   </guide>\n')
+        olst.append('</package>\n')
+        opfstr = "".join(olst)
+        olst = None
+        file(opfname, 'wb').write(opfstr)
 
     print('Processing Complete')
 
@@ -677,11 +792,12 @@ def generateBook(bookDir, raw, fixedimage):
 def usage():
     print("genbook.py generates a book from the extract Topaz Files")
     print("Usage:")
-    print("    genbook.py [-r] [-h [--fixed-image] <bookDir>  ")
+    print("    genbook.py [-r] [-h] [-w <workers>] [--fixed-image] <bookDir>  ")
     print("  ")
     print("Options:")
     print("  -h            :  help - print this usage message")
     print("  -r            :  generate raw svg files (not wrapped in xhtml)")
+    print("  -w <workers>  :  convert pages with this many processes")
     print("  --fixed-image :  genearate any Fixed Area as an svg image in the html")
     print("  ")
 
@@ -692,7 +808,7 @@ def main(argv):
         argv = sys.argv
 
     try:
-        opts, args = getopt.getopt(argv[1:], "rh:",["fixed-image"])
+        opts, args = getopt.getopt(argv[1:], "rh:w:",["fixed-image"])
 
     except getopt.GetoptError, err:
         print(str(err))
@@ -705,6 +821,7 @@ def main(argv):
 
     raw = 0
     fixedimage = True
+    workers = 1
     for o, a in opts:
         if o =="-h":
             usage()
@@ -713,10 +830,12 @@ def main(argv):
             raw = 1
         if o =="--fixed-image":
             fixedimage = True
+        if o =="-w":
+            workers = int(a)
 
     bookDir = args[0]
 
-    rv = generateBook(bookDir, raw, fixedimage)
+    rv = generateBook(bookDir, raw, fixedimage, None, workers)
     return rv
 
 
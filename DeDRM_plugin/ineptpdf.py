@@ -59,6 +59,20 @@ from __future__ import with_statement
 #   8.0.4 - Completely remove erroneous check on DER file sanity
 #   8.0.5 - Do not process DRM-free documents
 #   8.0.6 - Replace use of float by Decimal for greater precision, and import tkFileDialog
+#   8.0.7 - Parse the document once and try a list of keys against it (decryptBookKeys)
+#   8.0.8 - Streaming output for large documents, with a bounded object cache
+#   8.0.9 - Write objects in the order they appear in the input file
+#   8.1.0 - Tokenize with a single regular expression over a memory map of the file
+#   8.1.1 - Merge all xref sections into one object index, and read tables in bulk
+#   8.1.2 - Decrypt streams with a pool of workers while writing (-w option)
+#   8.1.3 - Stream filters moved to pdffilters.py: working LZW, all PNG and TIFF
+#           predictors, ASCIIHex and RunLength
+#   8.1.4 - Keep per-document state in PDFDocument, so that several books can
+#           be decrypted at once in one process
+#   8.1.5 - Optionally pack objects into new object streams on output (-p and -z options)
+#   8.1.6 - Rebuild a damaged xref with one regular expression over the whole file,
+#           using any xref streams found for objects in object streams
+#   8.1.7 - Serialize objects without recursion into a buffered writer
 
 
 """
@@ -66,18 +80,28 @@ Decrypts Adobe ADEPT-encrypted PDF files.
 """
 
 __license__ = 'GPL v3'
-__version__ = "8.0.6"
+__version__ = "8.1.7"
 
 import sys
 import os
 import re
 import zlib
+import getopt
+import mmap
 import struct
 import hashlib
 from decimal import *
-from itertools import chain, islice
+from itertools import chain, islice, izip, repeat
+from collections import OrderedDict
 import xml.etree.ElementTree as etree
 
+if 'calibre' in sys.modules:
+    inCalibre = True
+    from calibre_plugins.dedrm import pdffilters
+else:
+    inCalibre = False
+    import pdffilters
+
 # Wrap a stream so that output gets flushed immediately
 # and also make sure that any unicode strings get
 # encoded using "replace" before writing them.
@@ -222,6 +246,8 @@ def _load_crypto_libcrypto():
                 self._rsa = None
 
     class ARC4(object):
+        # ctypes calls release the GIL
+        native = True
         @classmethod
         def new(cls, userkey):
             self = ARC4()
@@ -238,6 +264,7 @@ def _load_crypto_libcrypto():
             return out.raw
 
     class AES(object):
+        native = True
         MODE_CBC = 0
         @classmethod
         def new(cls, userkey, mode, iv):
@@ -363,6 +390,7 @@ def _load_crypto_pycrypto():
                 return p.get(lengthLength)
 
     class ARC4(object):
+        native = False
         @classmethod
         def new(cls, userkey):
             self = ARC4()
@@ -374,6 +402,7 @@ def _load_crypto_pycrypto():
             return self._arc4.decrypt(data)
 
     class AES(object):
+        native = False
         MODE_CBC = _AES.MODE_CBC
         @classmethod
         def new(cls, userkey, mode, iv):
@@ -417,6 +446,10 @@ def _load_crypto():
     return (ARC4, RSA, AES)
 ARC4, RSA, AES = _load_crypto()
 
+# Are the ciphers from libcrypto? Then threads are enough to run them in parallel.
+def nativeCrypto():
+    return getattr(ARC4, 'native', False) and getattr(AES, 'native', False)
+
 
 try:
     from cStringIO import StringIO
@@ -431,8 +464,28 @@ except ImportError:
 
 GEN_XREF_STM = 1
 
-# This is the value for the current document
-gen_xref_stm = False # will be set in PDFSerializer
+# The value for each document is kept in its PDFDocument (gen_xref_stm)
+
+# Documents at least this big are written in streaming mode: objects are
+# dropped from memory once written, and only OBJCACHE_SIZE others are kept.
+STREAMING_SIZE = 64 * 1024 * 1024
+OBJCACHE_SIZE = 256
+# how many objects findKey looks through for a compressed stream to check a key with
+KEYCHECK_OBJECTS = 256
+
+# With workers, objects are read in windows of up to this many objects
+# or stream bytes, and the streams of one window are decrypted while
+# the window before it is written.
+WINDOW_OBJECTS = 64
+WINDOW_BYTES = 16 * 1024 * 1024
+
+# When packing (-p option), objects other than streams are written into new
+# object streams, with a cross reference stream to find them. Those streams
+# are compressed at this zlib level (-z option).
+ZLIB_LEVEL = 6
+
+# Output is collected and written in blocks of this size
+WRITE_BUFSIZE = 1024 * 1024
 
 # PDF parsing routines from pdfminer, with changes for EBX_HANDLER
 
@@ -528,11 +581,10 @@ class PSSymbolTable(object):
         return
 
     def intern(self, name):
-        if name in self.dic:
-            lit = self.dic[name]
-        else:
-            lit = self.classe(name)
-            self.dic[name] = lit
+        # setdefault keeps this safe when several threads intern the same name
+        lit = self.dic.get(name)
+        if lit is None:
+            lit = self.dic.setdefault(name, self.classe(name))
         return lit
 
 PSLiteralTable = PSSymbolTable(PSLiteral)
@@ -545,6 +597,7 @@ KEYWORD_ARRAY_BEGIN = KWD('[')
 KEYWORD_ARRAY_END = KWD(']')
 KEYWORD_DICT_BEGIN = KWD('<<')
 KEYWORD_DICT_END = KWD('>>')
+KEYWORD_STREAM = KWD('stream')
 
 
 def literal_name(x):
@@ -568,314 +621,238 @@ def keyword_name(x):
 ##
 EOL = re.compile(r'[\r\n]')
 SPC = re.compile(r'\s')
-NONSPC = re.compile(r'\S')
-HEX = re.compile(r'[0-9a-fA-F]')
-END_LITERAL = re.compile(r'[#/%\[\]()<>{}\s]')
-END_HEX_STRING = re.compile(r'[^\s0-9a-fA-F]')
 HEX_PAIR = re.compile(r'[0-9a-fA-F]{2}|.')
-END_NUMBER = re.compile(r'[^0-9]')
-END_KEYWORD = re.compile(r'[#/%\[\]()<>{}\s]')
+LITERAL_HEX = re.compile(r'#([0-9a-fA-F]{0,2})')
 END_STRING = re.compile(r'[()\134]')
-OCT_STRING = re.compile(r'[0-7]')
+OCT_STRING = re.compile(r'[0-7]{1,3}')
 ESC_STRING = { 'b':8, 't':9, 'n':10, 'f':12, 'r':13, '(':40, ')':41, '\\':92 }
 
+# The whole tokenizer in one pattern. Leading whitespace is skipped and
+# the name of the group that matched says what kind of token was found.
+# A lone '<' or '>' is dropped, as is a sign without any digits.
+PS_TOKEN = re.compile(r'''\s*(?:
+    (?P<comment> %[^\r\n]* )
+  | (?P<decimal> [-+]?[0-9]*\.[0-9]* )
+  | (?P<number> [-+]?[0-9]+ | [-+] )
+  | (?P<literal> /(?:[^#/%\[\]()<>{}\s]|\#[0-9a-fA-F]{0,2})* )
+  | (?P<keyword> [A-Za-z][^#/%\[\]()<>{}\s]* )
+  | (?P<string> \( )
+  | (?P<dictbegin> << )
+  | (?P<hexstring> <[\s0-9a-fA-F]+ )
+  | (?P<wopen> < )
+  | (?P<dictend> >> )
+  | (?P<wclose> > )
+  | (?P<char> \S )
+)''', re.VERBOSE | re.DOTALL)
+
+# These tokens only end at the next character, so they can't end the data.
+PS_UNTERMINATED = ('comment', 'decimal', 'number', 'literal', 'keyword',
+                   'hexstring', 'wopen', 'wclose')
+
 class PSBaseParser(object):
 
     '''
     Most basic PostScript parser that performs only basic tokenization.
+    Works straight on a memory map of the file (or on the whole string,
+    when the file can't be mapped), a few tokens at a time.
     '''
     BUFSIZ = 4096
+    # tokens scanned ahead: few just after a seek, more as reading goes on
+    TOKENS_MIN = 4
+    TOKENS_MAX = 128
 
     def __init__(self, fp):
         self.fp = fp
+        try:
+            self.data = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+            self.mapped = True
+        except (AttributeError, EnvironmentError, ValueError):
+            # a StringIO, or an empty file
+            fp.seek(0)
+            self.data = fp.read()
+            self.mapped = False
         self.seek(0)
         return
 
     def __repr__(self):
-        return '<PSBaseParser: %r, bufpos=%d>' % (self.fp, self.bufpos)
+        return '<PSBaseParser: %r, pos=%d>' % (self.fp, self.pos)
 
     def flush(self):
         return
 
     def close(self):
         self.flush()
+        if self.mapped:
+            self.data.close()
+            self.mapped = False
         return
 
     def tell(self):
-        return self.bufpos+self.charpos
+        return self.pos
 
     def poll(self, pos=None, n=80):
-        pos0 = self.fp.tell()
         if not pos:
-            pos = self.bufpos+self.charpos
-        self.fp.seek(pos)
-        ##print >>sys.stderr, 'poll(%d): %r' % (pos, self.fp.read(n))
-        self.fp.seek(pos0)
+            pos = self.pos
+        ##print >>sys.stderr, 'poll(%d): %r' % (pos, self.data[pos:pos+n])
         return
 
     def seek(self, pos):
         '''
         Seeks the parser to the given position.
         '''
-        self.fp.seek(pos)
-        # reset the status for nextline()
-        self.bufpos = pos
-        self.buf = ''
-        self.charpos = 0
-        # reset the status for nexttoken()
-        self.parse1 = self.parse_main
+        # pos is just after the last token handed out, and the tokens
+        # scanned ahead of it are kept in self.tokens
+        self.pos = pos
         self.tokens = []
+        self.ntokens = self.TOKENS_MIN
         return
 
-    def fillbuf(self):
-        if self.charpos < len(self.buf): return
-        # fetch next chunk.
-        self.bufpos = self.fp.tell()
-        self.buf = self.fp.read(self.BUFSIZ)
-        if not self.buf:
-            raise PSEOF('Unexpected EOF')
-        self.charpos = 0
-        return
-
-    def parse_main(self, s, i):
-        m = NONSPC.search(s, i)
-        if not m:
-            return (self.parse_main, len(s))
-        j = m.start(0)
-        c = s[j]
-        self.tokenstart = self.bufpos+j
-        if c == '%':
-            self.token = '%'
-            return (self.parse_comment, j+1)
-        if c == '/':
-            self.token = ''
-            return (self.parse_literal, j+1)
-        if c in '-+' or c.isdigit():
-            self.token = c
-            return (self.parse_number, j+1)
-        if c == '.':
-            self.token = c
-            return (self.parse_decimal, j+1)
-        if c.isalpha():
-            self.token = c
-            return (self.parse_keyword, j+1)
-        if c == '(':
-            self.token = ''
-            self.paren = 1
-            return (self.parse_string, j+1)
-        if c == '<':
-            self.token = ''
-            return (self.parse_wopen, j+1)
-        if c == '>':
-            self.token = ''
-            return (self.parse_wclose, j+1)
-        self.add_token(KWD(c))
-        return (self.parse_main, j+1)
-
-    def add_token(self, obj):
-        self.tokens.append((self.tokenstart, obj))
+    def scan(self):
+        '''
+        Scans a few tokens from self.pos onwards into self.tokens.
+        '''
+        data = self.data
+        size = len(data)
+        match = PS_TOKEN.match
+        tokens = self.tokens
+        i = self.pos
+        ntokens = self.ntokens
+        self.ntokens = min(ntokens * 2, self.TOKENS_MAX)
+        while len(tokens) < ntokens:
+            m = match(data, i)
+            if not m:
+                break
+            kind = m.lastgroup
+            start = m.start(kind)
+            i = m.end(0)
+            if i == size and kind in PS_UNTERMINATED:
+                break
+            s = m.group(kind)
+            if kind == 'number':
+                if len(s) == 1 and s in '-+':
+                    continue
+                token = int(s)
+            elif kind == 'keyword':
+                if s == 'true':
+                    token = True
+                elif s == 'false':
+                    token = False
+                else:
+                    token = KWD(s)
+            elif kind == 'literal':
+                s = s[1:]
+                if '#' in s:
+                    s = LITERAL_HEX.sub(lambda h: chr(int(h.group(1), 16)) if h.group(1) else '', s)
+                token = LIT(s)
+            elif kind == 'string':
+                try:
+                    (token, i) = self.parse_string(data, i)
+                except PSEOF:
+                    break
+            elif kind == 'dictbegin':
+                token = KEYWORD_DICT_BEGIN
+            elif kind == 'dictend':
+                token = KEYWORD_DICT_END
+            elif kind == 'hexstring':
+                token = HEX_PAIR.sub(lambda h: chr(int(h.group(0), 16)),
+                                     SPC.sub('', s[1:]))
+            elif kind == 'decimal':
+                try:
+                    token = Decimal(s)
+                except InvalidOperation:
+                    continue
+            elif kind == 'char':
+                token = KWD(s)
+            else:
+                # comments, and a lone '<' or '>'
+                continue
+            tokens.append((start, token, i))
+            if token is KEYWORD_STREAM:
+                # raw stream data follows, which is no use to tokenize
+                break
         return
 
-    def parse_comment(self, s, i):
-        m = EOL.search(s, i)
-        if not m:
-            self.token += s[i:]
-            return (self.parse_comment, len(s))
-        j = m.start(0)
-        self.token += s[i:j]
-        # We ignore comments.
-        #self.tokens.append(self.token)
-        return (self.parse_main, j)
-
-    def parse_literal(self, s, i):
-        m = END_LITERAL.search(s, i)
-        if not m:
-            self.token += s[i:]
-            return (self.parse_literal, len(s))
-        j = m.start(0)
-        self.token += s[i:j]
-        c = s[j]
-        if c == '#':
-            self.hex = ''
-            return (self.parse_literal_hex, j+1)
-        self.add_token(LIT(self.token))
-        return (self.parse_main, j)
-
-    def parse_literal_hex(self, s, i):
-        c = s[i]
-        if HEX.match(c) and len(self.hex) < 2:
-            self.hex += c
-            return (self.parse_literal_hex, i+1)
-        if self.hex:
-            self.token += chr(int(self.hex, 16))
-        return (self.parse_literal, i)
-
-    def parse_number(self, s, i):
-        m = END_NUMBER.search(s, i)
-        if not m:
-            self.token += s[i:]
-            return (self.parse_number, len(s))
-        j = m.start(0)
-        self.token += s[i:j]
-        c = s[j]
-        if c == '.':
-            self.token += c
-            return (self.parse_decimal, j+1)
-        try:
-            self.add_token(int(self.token))
-        except ValueError:
-            pass
-        return (self.parse_main, j)
-        
-    def parse_decimal(self, s, i):
-        m = END_NUMBER.search(s, i)
-        if not m:
-            self.token += s[i:]
-            return (self.parse_decimal, len(s))
-        j = m.start(0)
-        self.token += s[i:j]
-        self.add_token(Decimal(self.token))
-        return (self.parse_main, j)
-
-    def parse_keyword(self, s, i):
-        m = END_KEYWORD.search(s, i)
-        if not m:
-            self.token += s[i:]
-            return (self.parse_keyword, len(s))
-        j = m.start(0)
-        self.token += s[i:j]
-        if self.token == 'true':
-            token = True
-        elif self.token == 'false':
-            token = False
-        else:
-            token = KWD(self.token)
-        self.add_token(token)
-        return (self.parse_main, j)
-
-    def parse_string(self, s, i):
-        m = END_STRING.search(s, i)
-        if not m:
-            self.token += s[i:]
-            return (self.parse_string, len(s))
-        j = m.start(0)
-        self.token += s[i:j]
-        c = s[j]
-        if c == '\\':
-            self.oct = ''
-            return (self.parse_string_1, j+1)
-        if c == '(':
-            self.paren += 1
-            self.token += c
-            return (self.parse_string, j+1)
-        if c == ')':
-            self.paren -= 1
-            if self.paren:
-                self.token += c
-                return (self.parse_string, j+1)
-        self.add_token(self.token)
-        return (self.parse_main, j+1)
-    def parse_string_1(self, s, i):
-        c = s[i]
-        if OCT_STRING.match(c) and len(self.oct) < 3:
-            self.oct += c
-            return (self.parse_string_1, i+1)
-        if self.oct:
-            self.token += chr(int(self.oct, 8))
-            return (self.parse_string, i)
-        if c in ESC_STRING:
-            self.token += chr(ESC_STRING[c])
-        return (self.parse_string, i+1)
-
-    def parse_wopen(self, s, i):
-        c = s[i]
-        if c.isspace() or HEX.match(c):
-            return (self.parse_hexstring, i)
-        if c == '<':
-            self.add_token(KEYWORD_DICT_BEGIN)
-            i += 1
-        return (self.parse_main, i)
-
-    def parse_wclose(self, s, i):
-        c = s[i]
-        if c == '>':
-            self.add_token(KEYWORD_DICT_END)
-            i += 1
-        return (self.parse_main, i)
-
-    def parse_hexstring(self, s, i):
-        m = END_HEX_STRING.search(s, i)
-        if not m:
-            self.token += s[i:]
-            return (self.parse_hexstring, len(s))
-        j = m.start(0)
-        self.token += s[i:j]
-        token = HEX_PAIR.sub(lambda m: chr(int(m.group(0), 16)),
-                                                 SPC.sub('', self.token))
-        self.add_token(token)
-        return (self.parse_main, j)
+    def parse_string(self, data, i):
+        '''
+        Returns a string token starting just after its '(', and the end.
+        '''
+        token = []
+        paren = 1
+        while 1:
+            m = END_STRING.search(data, i)
+            if not m:
+                raise PSEOF('Unexpected EOF')
+            j = m.start(0)
+            token.append(data[i:j])
+            c = data[j]
+            if c == '\\':
+                m = OCT_STRING.match(data, j+1)
+                if m:
+                    token.append(chr(int(m.group(0), 8) & 255))
+                    i = m.end(0)
+                    continue
+                c = data[j+1:j+2]
+                if not c:
+                    raise PSEOF('Unexpected EOF')
+                if c in ESC_STRING:
+                    token.append(chr(ESC_STRING[c]))
+                i = j+2
+                continue
+            if c == '(':
+                paren += 1
+            else:
+                paren -= 1
+                if not paren:
+                    return (''.join(token), j+1)
+            token.append(c)
+            i = j+1
 
     def nexttoken(self):
-        while not self.tokens:
-            self.fillbuf()
-            (self.parse1, self.charpos) = self.parse1(self.buf, self.charpos)
-        token = self.tokens.pop(0)
-        return token
+        if not self.tokens:
+            self.scan()
+            if not self.tokens:
+                raise PSEOF('Unexpected EOF')
+        (pos, token, self.pos) = self.tokens.pop(0)
+        return (pos, token)
 
     def nextline(self):
         '''
         Fetches a next line that ends either with \\r or \\n.
         '''
-        linebuf = ''
-        linepos = self.bufpos + self.charpos
-        eol = False
-        while 1:
-            self.fillbuf()
-            if eol:
-                c = self.buf[self.charpos]
-                # handle '\r\n'
-                if c == '\n':
-                    linebuf += c
-                    self.charpos += 1
-                break
-            m = EOL.search(self.buf, self.charpos)
-            if m:
-                linebuf += self.buf[self.charpos:m.end(0)]
-                self.charpos = m.end(0)
-                if linebuf[-1] == '\r':
-                    eol = True
-                else:
-                    break
-            else:
-                linebuf += self.buf[self.charpos:]
-                self.charpos = len(self.buf)
-        return (linepos, linebuf)
+        data = self.data
+        linepos = self.pos
+        self.tokens = []
+        self.ntokens = self.TOKENS_MIN
+        m = EOL.search(data, linepos)
+        if not m:
+            raise PSEOF('Unexpected EOF')
+        end = m.end(0)
+        if m.group(0) == '\r':
+            # handle '\r\n'
+            if end == len(data):
+                raise PSEOF('Unexpected EOF')
+            if data[end] == '\n':
+                end += 1
+        self.pos = end
+        return (linepos, data[linepos:end])
 
     def revreadlines(self):
         '''
         Fetches a next line backword. This is used to locate
         the trailers at the end of a file.
         '''
-        self.fp.seek(0, 2)
-        pos = self.fp.tell()
-        buf = ''
+        data = self.data
+        end = pos = len(data)
         while 0 < pos:
-            prevpos = pos
-            pos = max(0, pos-self.BUFSIZ)
-            self.fp.seek(pos)
-            s = self.fp.read(prevpos-pos)
-            if not s: break
-            while 1:
-                n = max(s.rfind('\r'), s.rfind('\n'))
-                if n == -1:
-                    buf = s + buf
-                    break
-                yield s[n:]+buf
-                s = s[:n]
-                buf = ''
+            start = max(0, pos-self.BUFSIZ)
+            n = max(data.rfind('\r', start, pos), data.rfind('\n', start, pos))
+            if n == -1:
+                pos = start
+                continue
+            yield data[n:end]
+            end = pos = n
         return
 
-
 ##  PSStackParser
 ##
 class PSStackParser(PSBaseParser):
@@ -981,10 +958,7 @@ class PSStackParser(PSBaseParser):
         return obj
 
 
-LITERAL_CRYPT = PSLiteralTable.intern('Crypt')
 LITERALS_FLATE_DECODE = (PSLiteralTable.intern('FlateDecode'), PSLiteralTable.intern('Fl'))
-LITERALS_LZW_DECODE = (PSLiteralTable.intern('LZWDecode'), PSLiteralTable.intern('LZW'))
-LITERALS_ASCII85_DECODE = (PSLiteralTable.intern('ASCII85Decode'), PSLiteralTable.intern('A85'))
 
 
 ##  PDF Objects
@@ -1113,29 +1087,6 @@ def stream_value(x):
         return PDFStream({}, '')
     return x
 
-# ascii85decode(data)
-def ascii85decode(data):
-    n = b = 0
-    out = ''
-    for c in data:
-        if '!' <= c and c <= 'u':
-            n += 1
-            b = b*85+(ord(c)-33)
-            if n == 5:
-                out += struct.pack('>L',b)
-                n = b = 0
-        elif c == 'z':
-            assert n == 0
-            out += '\0\0\0\0'
-        elif c == '~':
-            if n:
-                for _ in range(5-n):
-                    b = b*85+84
-                out += struct.pack('>L',b)[:n-1]
-            break
-    return out
-
-
 ##  PDFStream type
 class PDFStream(PDFObject):
     def __init__(self, dic, rawdata, decipher=None):
@@ -1179,54 +1130,35 @@ class PDFStream(PDFObject):
         if self.decipher:
             # Handle encryption
             data = self.decipher(self.objid, self.genno, data)
-            if gen_xref_stm:
+            if self.decipher.__self__.gen_xref_stm:
                 self.decdata = data # keep decrypted data
         if 'Filter' not in self.dic:
             self.data = data
             self.rawdata = None
             ##print self.dict
             return
-        filters = self.dic['Filter']
+        filters = resolve1(self.dic['Filter'])
         if not isinstance(filters, list):
             filters = [ filters ]
+        filters = [ literal_name(resolve1(f)) for f in filters ]
         for f in filters:
-            if f in LITERALS_FLATE_DECODE:
-                # will get errors if the document is encrypted.
-                data = zlib.decompress(data)
-            elif f in LITERALS_LZW_DECODE:
-                data = ''.join(LZWDecoder(StringIO(data)).run())
-            elif f in LITERALS_ASCII85_DECODE:
-                data = ascii85decode(data)
-            elif f == LITERAL_CRYPT:
+            if f == 'Crypt':
                 raise PDFNotImplementedError('/Crypt filter is unsupported')
-            else:
+            if pdffilters.getFilter(f) is None:
                 raise PDFNotImplementedError('Unsupported filter: %r' % f)
-            # apply predictors
-            if 'DP' in self.dic:
-                params = self.dic['DP']
-            else:
-                params = self.dic.get('DecodeParms', {})
-            if 'Predictor' in params:
-                pred = int_value(params['Predictor'])
-                if pred:
-                    if pred != 12:
-                        raise PDFNotImplementedError(
-                            'Unsupported predictor: %r' % pred)
-                    if 'Columns' not in params:
-                        raise PDFValueError(
-                            'Columns undefined for predictor=12')
-                    columns = int_value(params['Columns'])
-                    buf = ''
-                    ent0 = '\x00' * columns
-                    for i in xrange(0, len(data), columns+1):
-                        pred = data[i]
-                        ent1 = data[i+1:i+1+columns]
-                        if pred == '\x02':
-                            ent1 = ''.join(chr((ord(a)+ord(b)) & 255) \
-                                               for (a,b) in zip(ent0,ent1))
-                        buf += ent1
-                        ent0 = ent1
-                    data = buf
+        # decode parameters: one dictionary, or an array with one per filter
+        if 'DP' in self.dic:
+            params = resolve1(self.dic['DP'])
+        else:
+            params = resolve1(self.dic.get('DecodeParms', {}))
+        if not isinstance(params, list):
+            params = [ params ] * len(filters)
+        params = [ dict((k, resolve1(v)) for (k,v) in dict_value(p).iteritems()) if p else {}
+                   for p in map(resolve1, params) ]
+        try:
+            data = pdffilters.decode(data, filters, params)
+        except ValueError, e:
+            raise PDFValueError('%s in stream %r' % (e, self.objid))
         self.data = data
         self.rawdata = None
         return
@@ -1248,6 +1180,19 @@ class PDFStream(PDFObject):
             data = self.decipher(self.objid, self.genno, data)
         return data
 
+    def iter_decdata(self, chunksize=1024*1024):
+        # Like get_decdata, but in pieces, so that a large stream is never
+        # in memory both encrypted and decrypted. Only RC4 keeps its state
+        # from one piece to the next; anything else comes in one piece.
+        if self.decdata is not None or not self.rawdata or \
+           getattr(self.decipher, '__name__', None) != 'decrypt_rc4':
+            yield self.get_decdata()
+            return
+        cipher = ARC4.new(self.decipher.__self__.genkey(self.objid, self.genno))
+        data = self.rawdata
+        for i in xrange(0, len(data), chunksize):
+            yield cipher.decrypt(data[i:i+chunksize])
+
 
 ##  PDF Exceptions
 ##
@@ -1259,6 +1204,7 @@ class PDFPasswordIncorrect(PDFEncryptionError): pass
 # some predefined literals and keywords.
 LITERAL_OBJSTM = PSLiteralTable.intern('ObjStm')
 LITERAL_XREF = PSLiteralTable.intern('XRef')
+LITERAL_METADATA = PSLiteralTable.intern('Metadata')
 LITERAL_PAGE = PSLiteralTable.intern('Page')
 LITERAL_PAGES = PSLiteralTable.intern('Pages')
 LITERAL_CATALOG = PSLiteralTable.intern('Catalog')
@@ -1267,12 +1213,26 @@ LITERAL_CATALOG = PSLiteralTable.intern('Catalog')
 ##  XRefs
 ##
 
+# a subsection header in a classic xref table, and a run of standard
+# 20 byte entries following it
+XREF_SUBSECTION = re.compile(r'(\d+) (\d+)[ \t]*(?:\r\n|\r|\n)')
+XREF_ENTRIES = re.compile(r'(\d{10}) (\d{5}) ([fn])(?: \r| \n|\r\n)')
+
+# what a damaged file's xref is rebuilt from: 'N G obj' and 'trailer' at
+# the start of a line, and the /Type of xref streams. The search is for the
+# keywords alone, which is much quicker, and OBJ_HEAD then checks the text
+# before each 'obj'.
+XREF_RECOVER = re.compile(r'(obj|trailer|/Type\s*/XRef)\b')
+OBJ_HEAD = re.compile(r'[\r\n](\d+)\s+\d+\s+$')
+STARTXREF = re.compile(r'startxref\s+(\d+)')
+
 ##  PDFXRef
 ##
 class PDFXRef(object):
 
     def __init__(self):
         self.offsets = None
+        self.trailer = {}
         return
 
     def __repr__(self):
@@ -1281,8 +1241,31 @@ class PDFXRef(object):
     def objids(self):
         return self.offsets.iterkeys()
 
+    def positions(self):
+        # (objid, (None, offset)) for each object in use
+        for (objid, (genno, pos)) in self.offsets.iteritems():
+            yield (objid, (None, pos))
+
     def load(self, parser):
         self.offsets = {}
+        # Take whole subsections of standard entries in one go. Anything
+        # else is left to the line by line reading below.
+        data = parser.data
+        pos = parser.tell()
+        while 1:
+            m = XREF_SUBSECTION.match(data, pos)
+            if not m:
+                break
+            (start, nobjs) = (int(m.group(1)), int(m.group(2)))
+            end = m.end(0) + 20*nobjs
+            entries = XREF_ENTRIES.findall(data[m.end(0):end])
+            if len(entries) != nobjs:
+                break
+            for (objid, (offset, genno, use)) in izip(xrange(start, start+nobjs), entries):
+                if use == 'n':
+                    self.offsets[objid] = (int(genno), int(offset))
+            pos = end
+        parser.seek(pos)
         while 1:
             try:
                 (pos, line) = parser.nextline()
@@ -1373,6 +1356,53 @@ class PDFXRefStream(object):
         self.trailer = stream.dic
         return
 
+    def positions(self):
+        # (objid, (None, offset)) or (objid, (stmid, index)) for each object
+        # in use, the first entry winning if an objid is given twice
+        (fl1, fl2, fl3, entlen) = (self.fl1, self.fl2, self.fl3, self.entlen)
+        codes = {0: '', 1: 'B', 2: 'H', 4: 'L'}
+        seen = set()
+        i = 0
+        for first, size in self.index:
+            block = self.data[i:i+entlen*size]
+            i += entlen*size
+            if fl1 in codes and fl2 in codes and fl3 in codes and len(block) == entlen*size:
+                # all the entries of the range at once
+                fields = struct.unpack('>' + (codes[fl1]+codes[fl2]+codes[fl3])*size, block)
+                width = (fl1 > 0) + (fl2 > 0) + (fl3 > 0)
+                columns = []
+                for (fl, default) in ((fl1, 1), (fl2, 0), (fl3, 0)):
+                    if fl:
+                        columns.append(fields[len(columns):len(fields):width])
+                    else:
+                        columns.append(repeat(default, size))
+                rows = izip(xrange(first, first+size), *columns)
+            else:
+                rows = ((objid,) + self.getfields(objid) for objid in xrange(first, first+size))
+            for (objid, f1, f2, f3) in rows:
+                if objid in seen:
+                    continue
+                seen.add(objid)
+                if f1 == 1:
+                    yield (objid, (None, f2))
+                elif f1 == 2:
+                    yield (objid, (f2, f3))
+        return
+
+    def getfields(self, objid):
+        offset = 0
+        for first, size in self.index:
+            if first <= objid  and objid < (first + size):
+                break
+            offset += size
+        else:
+            raise KeyError(objid)
+        i = self.entlen * ((objid - first) + offset)
+        ent = self.data[i:i+self.entlen]
+        return (nunpack(ent[:self.fl1], 1),
+                nunpack(ent[self.fl1:self.fl1+self.fl2]),
+                nunpack(ent[self.fl1+self.fl2:]))
+
     def getpos(self, objid):
         offset = 0
         for first, size in self.index:
@@ -1396,24 +1426,91 @@ class PDFXRefStream(object):
         raise KeyError(objid)
 
 
+##  PDFObjCache
+##
+##  Least recently used cache of the objects of a PDFDocument, so that
+##  a large document never has to be held in memory all at once.
+##  Pinned objects (the catalog and the page tree) are never evicted.
+##
+class PDFObjCache(object):
+
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self.lru = OrderedDict()
+        self.pinned = {}
+        self.pinids = set()
+        return
+
+    def __len__(self):
+        return len(self.pinned) + len(self.lru)
+
+    def __contains__(self, objid):
+        return objid in self.pinned or objid in self.lru
+
+    def __getitem__(self, objid):
+        if objid in self.pinned:
+            return self.pinned[objid]
+        obj = self.lru.pop(objid)
+        self.lru[objid] = obj
+        return obj
+
+    def __setitem__(self, objid, obj):
+        if objid in self.pinids:
+            self.pinned[objid] = obj
+            return
+        self.lru.pop(objid, None)
+        self.lru[objid] = obj
+        while len(self.lru) > self.maxsize:
+            self.lru.popitem(last=False)
+        return
+
+    def pin(self, objid):
+        self.pinids.add(objid)
+        if objid in self.lru:
+            self.pinned[objid] = self.lru.pop(objid)
+        return
+
+    def release(self, objid):
+        # forget an object that is no longer needed, unless it is pinned
+        self.lru.pop(objid, None)
+        return
+
+
 ##  PDFDocument
 ##
 ##  A PDFDocument object represents a PDF document.
 ##  Since a PDF file is usually pretty big, normally it is not loaded
 ##  at once. Rather it is parsed dynamically as processing goes.
 ##  A PDF parser is associated with the document.
+##  With a cachesize, only that many objects are kept (see PDFObjCache).
 ##
 class PDFDocument(object):
 
-    def __init__(self):
+    def __init__(self, cachesize=None, xrefstm=None):
         self.xrefs = []
-        self.objs = {}
+        self.index = {}
+        self.streaming = bool(cachesize)
+        if self.streaming:
+            self.objs = PDFObjCache(cachesize)
+        else:
+            self.objs = {}
         self.parsed_objs = {}
+        # objects of each parsed object stream not yet released, and
+        # the object stream each of them came from
+        self.objstm_left = {}
+        self.objstm_of = {}
         self.root = None
         self.catalog = None
         self.parser = None
         self.encryption = None
         self.decipher = None
+        # do we generate cross reference streams on output? (see GEN_XREF_STM)
+        if xrefstm is None:
+            xrefstm = GEN_XREF_STM
+        self.xrefstm = xrefstm
+        self.gen_xref_stm = xrefstm > 1
+        # the highest index of an object in an object stream
+        self.objstm_maxindex = 0
         return
 
     # set_parser(parser)
@@ -1429,6 +1526,13 @@ class PDFDocument(object):
         # Retrieve the information of each header that was appended
         # (maybe multiple times) at the end of the document.
         self.xrefs = parser.read_xref()
+        # One index for the whole document. The newest xref comes first
+        # and wins over the older ones it updates.
+        self.index = {}
+        for xref in self.xrefs:
+            for (objid, pos) in xref.positions():
+                if objid not in self.index:
+                    self.index[objid] = pos
         for xref in self.xrefs:
             trailer = xref.trailer
             if not trailer: continue
@@ -1444,6 +1548,8 @@ class PDFDocument(object):
                     self.encryption = ('ffffffffffffffffffffffffffffffffffff',
                                        dict_value(trailer['Encrypt']))
             if 'Root' in trailer:
+                if self.streaming and isinstance(trailer['Root'], PDFObjRef):
+                    self.objs.pin(trailer['Root'].objid)
                 self.set_root(dict_value(trailer['Root']))
                 break
         else:
@@ -1464,6 +1570,24 @@ class PDFDocument(object):
             if STRICT:
                 raise PDFSyntaxError('Catalog not found!')
         return
+
+    # release(objid)
+    #   Tell a streaming document that an object has been dealt with.
+    def release(self, objid):
+        if not self.streaming:
+            return
+        self.objs.release(objid)
+        stmid = self.objstm_of.pop(objid, None)
+        if stmid in self.objstm_left:
+            left = self.objstm_left[stmid]
+            left.discard(objid)
+            if not left:
+                # everything in the object stream has been dealt with.
+                # The stream object itself goes when it has been written.
+                del self.objstm_left[stmid]
+                del self.parsed_objs[stmid]
+        return
+
     # initialize(password='')
     #   Perform the initialization with a given password.
     #   This step is mandatory even if there's no password associated
@@ -1704,6 +1828,12 @@ class PDFDocument(object):
 
     KEYWORD_OBJ = PSKeywordTable.intern('obj')
 
+    # find(objid)
+    #   Returns where the xrefs put an object: (None, file offset), or
+    #   (object stream id, index in the stream). None if it isn't there.
+    def find(self, objid):
+        return self.index.get(objid)
+
     def getobj(self, objid):
         if not self.ready:
             raise PDFException('PDFDocument not initialized')
@@ -1712,18 +1842,16 @@ class PDFDocument(object):
             genno = 0
             obj = self.objs[objid]
         else:
-            for xref in self.xrefs:
-                try:
-                    (stmid, index) = xref.getpos(objid)
-                    break
-                except KeyError:
-                    pass
-            else:
+            pos = self.find(objid)
+            if pos is None:
                 #if STRICT:
                 #    raise PDFSyntaxError('Cannot locate objid=%r' % objid)
                 return None
+            (stmid, index) = pos
             if stmid:
-                if gen_xref_stm:
+                if self.gen_xref_stm:
+                    if index > self.objstm_maxindex:
+                        self.objstm_maxindex = index
                     return PDFObjStmRef(objid, stmid, index)
                 # Stuff from pdfminer: extract objects from object stream
                 stream = stream_value(self.getobj(stmid))
@@ -1749,6 +1877,11 @@ class PDFDocument(object):
                     except PSEOF:
                         pass
                     self.parsed_objs[stmid] = objs
+                    if self.streaming:
+                        members = objs[0:n*2:2]
+                        self.objstm_left[stmid] = set(members)
+                        for member in members:
+                            self.objstm_of[member] = stmid
                 genno = 0
                 i = n*2+index
                 try:
@@ -1787,13 +1920,10 @@ class PDFDocument(object):
 
 
 class PDFObjStmRef(object):
-    maxindex = 0
     def __init__(self, objid, stmid, index):
         self.objid = objid
         self.stmid = stmid
         self.index = index
-        if index > PDFObjStmRef.maxindex:
-            PDFObjStmRef.maxindex = index
 
 
 ##  PDFParser
@@ -1851,8 +1981,7 @@ class PDFParser(PSStackParser):
                     raise PDFSyntaxError('Unexpected EOF')
                 return
             pos += len(line)
-            self.fp.seek(pos)
-            data = self.fp.read(objlen)
+            data = self.data[pos:pos+objlen]
             self.seek(pos+objlen)
             while 1:
                 try:
@@ -1878,16 +2007,14 @@ class PDFParser(PSStackParser):
         return
 
     def find_xref(self):
-        # search the last xref table by scanning the file backwards.
-        prev = None
-        for line in self.revreadlines():
-            line = line.strip()
-            if line == 'startxref': break
-            if line:
-                prev = line
-        else:
+        # the position of the last xref table, given after the last startxref
+        pos = self.data.rfind('startxref')
+        if pos < 0:
             raise PDFNoValidXRef('Unexpected EOF')
-        return int(prev)
+        m = STARTXREF.match(self.data, pos)
+        if not m:
+            raise PDFNoValidXRef('Invalid startxref')
+        return int(m.group(1))
 
     # read xref table
     def read_xref_from(self, start, xrefs):
@@ -1899,9 +2026,8 @@ class PDFParser(PSStackParser):
             raise PDFNoValidXRef('Unexpected EOF')
         if isinstance(token, int):
             # XRefStream: PDF-1.5
-            if GEN_XREF_STM == 1:
-                global gen_xref_stm
-                gen_xref_stm = True
+            if self.doc.xrefstm == 1:
+                self.doc.gen_xref_stm = True
             self.seek(pos)
             self.reset()
             xref = PDFXRefStream()
@@ -1927,35 +2053,67 @@ class PDFParser(PSStackParser):
     # read xref tables and trailers
     def read_xref(self):
         xrefs = []
-        trailerpos = None
         try:
             pos = self.find_xref()
             self.read_xref_from(pos, xrefs)
-        except PDFNoValidXRef:
-            # fallback
-            self.seek(0)
-            pat = re.compile(r'^(\d+)\s+(\d+)\s+obj\b')
-            offsets = {}
-            xref = PDFXRef()
-            while 1:
-                try:
-                    (pos, line) = self.nextline()
-                except PSEOF:
-                    break
-                if line.startswith('trailer'):
-                    trailerpos = pos # remember last trailer
-                m = pat.match(line)
-                if not m: continue
-                (objid, genno) = m.groups()
-                offsets[int(objid)] = (0, pos)
-            if not offsets: raise
-            xref.offsets = offsets
-            if trailerpos:
-                self.seek(trailerpos)
-                xref.load_trailer(self)
-                xrefs.append(xref)
+        except Exception:
+            # a damaged xref, or startxref pointing at the wrong place
+            self.recover_xref(xrefs)
         return xrefs
 
+    def recover_xref(self, xrefs):
+        # Rebuild the xref of a damaged file from the objects themselves.
+        # Later objects and trailers win, as in an incremental update.
+        # Objects in object streams can only be found through the xref
+        # streams, which are read too if they are still whole.
+        data = self.data
+        offsets = {}
+        trailerpos = None
+        xrefstms = []
+        last = None
+        for m in XREF_RECOVER.finditer(data):
+            word = m.group(1)
+            pos = m.start()
+            if word == 'obj':
+                if pos > 64:
+                    head = OBJ_HEAD.search(data[pos-64:pos])
+                else:
+                    head = OBJ_HEAD.search('\n' + data[:pos])
+                if head:
+                    last = pos - len(head.group(0)) + 1
+                    offsets[int(head.group(1))] = (0, last)
+            elif word == 'trailer':
+                if pos == 0 or data[pos-1] in '\r\n':
+                    trailerpos = pos
+            elif last is not None:
+                xrefstms.append(last)
+        if not offsets:
+            raise PDFNoValidXRef('No objects found')
+        xref = PDFXRef()
+        xref.offsets = offsets
+        streams = []
+        for pos in xrefstms:
+            stream = PDFXRefStream()
+            try:
+                self.seek(pos)
+                stream.load(self)
+            except Exception:
+                continue
+            streams.append(stream)
+            if self.doc.xrefstm == 1:
+                self.doc.gen_xref_stm = True
+        if trailerpos is not None:
+            self.seek(trailerpos)
+            xref.load_trailer(self)
+        elif streams:
+            # no trailer, but the newest xref stream holds the same keys
+            for key in ('Root', 'Info', 'ID', 'Encrypt'):
+                if key in streams[-1].trailer:
+                    xref.trailer[key] = streams[-1].trailer[key]
+        xrefs.append(xref)
+        xrefs.extend(reversed(streams))
+        return
+
 ##  PDFObjStrmParser
 ##
 class PDFObjStrmParser(PDFParser):
@@ -1988,15 +2146,119 @@ class PDFObjStrmParser(PDFParser):
 ###
 ### My own code, for which there is none else to blame
 
+# Strings get escaped, and one ciando id removed, on output
+STRING_ESCAPED = '\\\n()'
+CIANDO_ID = re.compile(r'http://www.ciando.com/index.cfm/intRefererID/\d{5}')
+
+
+# What PDFSerializer.pieces does with each type of object
+(KIND_TEXT, KIND_DICT, KIND_LIST, KIND_STRING, KIND_NAME, KIND_BOOL,
+ KIND_NUMBER, KIND_REF, KIND_STREAM, KIND_OTHER) = range(10)
+
+def serialKind(obj):
+    if isinstance(obj, tuple):
+        return KIND_TEXT
+    if isinstance(obj, dict):
+        return KIND_DICT
+    if isinstance(obj, list):
+        return KIND_LIST
+    if isinstance(obj, str):
+        return KIND_STRING
+    if isinstance(obj, PSLiteral):
+        return KIND_NAME
+    if isinstance(obj, bool):
+        return KIND_BOOL
+    if isinstance(obj, (int, long, Decimal)):
+        return KIND_NUMBER
+    if isinstance(obj, PDFObjRef):
+        return KIND_REF
+    if isinstance(obj, PDFStream):
+        return KIND_STREAM
+    return KIND_OTHER
+
+# the kinds of the usual types, looked up rather than worked out each time
+SERIAL_KINDS = {tuple: KIND_TEXT, dict: KIND_DICT, list: KIND_LIST,
+                str: KIND_STRING, PSLiteral: KIND_NAME, bool: KIND_BOOL,
+                int: KIND_NUMBER, long: KIND_NUMBER, Decimal: KIND_NUMBER,
+                PDFObjRef: KIND_REF, PDFStream: KIND_STREAM}
+
+
+##  PDFWriter
+##
+##  Buffers output, keeping track of the position in the file
+##  and of the last character written.
+##
+class PDFWriter(object):
+
+    def __init__(self, outf, bufsize=WRITE_BUFSIZE):
+        self.outf = outf
+        self.bufsize = bufsize
+        self.buf = []
+        self.buflen = 0
+        self.pos = outf.tell()
+        self.last = ''
+
+    def write(self, data):
+        if not data:
+            return
+        self.last = data[-1]
+        if len(data) >= self.bufsize:
+            # a big piece, such as stream data, goes straight out
+            self.flush()
+            self.outf.write(data)
+            self.pos += len(data)
+            return
+        self.buf.append(data)
+        self.buflen += len(data)
+        if self.buflen >= self.bufsize:
+            self.flush()
+
+    def tell(self):
+        return self.pos + self.buflen
+
+    def flush(self):
+        if self.buf:
+            self.outf.write(''.join(self.buf))
+            self.pos += self.buflen
+            self.buf = []
+            self.buflen = 0
+
+# Decrypt a batch of (decipher name, objid, genno, rawdata) stream bodies.
+# Only the document key is needed, so a bare PDFDocument will do, and the
+# batch can be sent to another process.
+def decryptStreamBatch(args):
+    (decrypt_key, genkey, streams) = args
+    doc = PDFDocument()
+    doc.decrypt_key = decrypt_key
+    doc.genkey = getattr(doc, genkey)
+    return [getattr(doc, decipher)(objid, genno, data) for (decipher, objid, genno, data) in streams]
+
+
 class PDFSerializer(object):
-    def __init__(self, inf, userkey):
-        global GEN_XREF_STM, gen_xref_stm
-        gen_xref_stm = GEN_XREF_STM > 1
+    def __init__(self, inf, userkey=None, streaming=False, workers=1, objstmsize=0, zlevel=ZLIB_LEVEL):
         self.version = inf.read(8)
         inf.seek(0)
-        self.doc = doc = PDFDocument()
+        # in streaming mode objects are dropped once they have been written
+        self.streaming = streaming
+        self.workers = workers
+        # when packing, objects are taken out of the input's object streams
+        # and put into new ones, so the document must not keep them there
+        self.objstmsize = objstmsize
+        self.zlevel = zlevel
+        if objstmsize > 0:
+            xrefstm = 0
+            if self.version < '%PDF-1.5':
+                self.version = '%PDF-1.5'
+        else:
+            xrefstm = None
+        if streaming:
+            self.doc = doc = PDFDocument(OBJCACHE_SIZE, xrefstm)
+        else:
+            self.doc = doc = PDFDocument(None, xrefstm)
         parser = PDFParser(doc, inf)
-        doc.initialize(userkey)
+        # without a key, call findKey before dump
+        if userkey is not None:
+            doc.initialize(userkey)
         self.objids = objids = set()
         for xref in reversed(doc.xrefs):
             trailer = xref.trailer
@@ -2008,9 +2270,186 @@ class PDFSerializer(object):
         if 'Encrypt' in trailer:
             objids.remove(trailer.pop('Encrypt').objid)
         self.trailer = trailer
+        self.order = self.fileorder(objids)
+
+    def fileorder(self, objids):
+        # Sort objids by where they are in the input, so that it gets read
+        # from start to end rather than all over the place. Objects from an
+        # object stream come together, just before the stream itself.
+        doc = self.doc
+        offsets = {}
+        def offset(objid):
+            if objid not in offsets:
+                pos = doc.find(objid)
+                if pos is None or pos[0]:
+                    offsets[objid] = sys.maxint
+                else:
+                    offsets[objid] = pos[1]
+            return offsets[objid]
+        keys = []
+        for objid in objids:
+            pos = doc.find(objid)
+            if pos is None:
+                keys.append((sys.maxint, sys.maxint, objid))
+            elif pos[0]:
+                keys.append((offset(pos[0]), pos[1], objid))
+            else:
+                keys.append((pos[1], sys.maxint, objid))
+        keys.sort()
+        return [objid for (_, _, objid) in keys]
+
+    def findKey(self, userkeys):
+        # Try (keyname, userkey) pairs against the /Encrypt dictionary only,
+        # without touching the rest of the document. Returns the name of
+        # the first key that fits, leaving the document ready to dump,
+        # or None if none of them do.
+        doc = self.doc
+        if not doc.encryption:
+            doc.initialize()
+        for keyname, userkey in userkeys:
+            try:
+                doc.initialize(userkey)
+                if self.checkKey():
+                    return keyname
+            except (PDFEncryptionError, PDFNotImplementedError):
+                # the same for every key
+                raise
+            except Exception:
+                # wrong key
+                pass
+            doc.decipher = None
+            doc.ready = False
+        return None
+
+    def checkKey(self):
+        # A wrong key now and then gets through initialize, whose only test
+        # is the padding of the book key. So decrypt and inflate the first
+        # compressed stream with it: zlib's checksum will not match if the
+        # key is wrong. The streams are parsed straight from the file, so
+        # nothing decrypted with a wrong key is left in the object cache.
+        doc = self.doc
+        for objid in islice(self.order, KEYCHECK_OBJECTS):
+            pos = doc.find(objid)
+            if pos is None or pos[0]:
+                continue
+            try:
+                doc.parser.seek(pos[1])
+                doc.parser.nexttoken() # objid
+                (_,genno) = doc.parser.nexttoken()
+                (_,kwd) = doc.parser.nexttoken()
+                if kwd is not doc.KEYWORD_OBJ:
+                    continue
+                (_,obj) = doc.parser.nextobject()
+            except (PSException, PDFException):
+                # a damaged object says nothing about the key
+                continue
+            if not isinstance(obj, PDFStream):
+                continue
+            # xref streams are never encrypted, metadata may not be
+            if obj.dic.get('Type') in (LITERAL_XREF, LITERAL_METADATA):
+                continue
+            filters = resolve1(obj.dic.get('Filter'))
+            if not isinstance(filters, list):
+                filters = [ filters ]
+            if [ literal_name(resolve1(f)) for f in filters ] != ['FlateDecode']:
+                continue
+            obj.set_objid(objid, genno)
+            try:
+                zlib.decompress(obj.decipher(objid, genno, obj.rawdata))
+            except zlib.error:
+                return False
+            return True
+        # nothing to check the key with
+        return True
+
+    def pin_page_tree(self):
+        # keep the catalog and the /Pages nodes cached while streaming
+        # (the catalog itself was pinned when the trailer was read)
+        doc = self.doc
+        todo = [doc.catalog.get('Pages')]
+        while todo:
+            ref = todo.pop()
+            if not isinstance(ref, PDFObjRef) or ref.objid in doc.objs.pinids:
+                continue
+            obj = resolve1(ref)
+            if not isinstance(obj, dict) or obj.get('Type') is not LITERAL_PAGES:
+                continue
+            todo.extend(obj.get('Kids', []))
+            doc.objs.pin(ref.objid)
+        return
+
+    def objects(self):
+        # Yields (objid, obj) in self.order. With workers, the stream
+        # bodies are decrypted by a pool, a window ahead of the writing.
+        doc = self.doc
+        if self.workers <= 1 or not doc.decipher:
+            for objid in self.order:
+                yield (objid, doc.getobj(objid))
+            return
+        if nativeCrypto():
+            from multiprocessing.pool import ThreadPool as Pool
+        else:
+            from multiprocessing import Pool
+        pool = Pool(self.workers)
+        try:
+            order = iter(self.order)
+            pending = None
+            while 1:
+                window = []
+                size = 0
+                for objid in order:
+                    obj = doc.getobj(objid)
+                    window.append((objid, obj))
+                    if isinstance(obj, PDFStream) and obj.rawdata:
+                        size += len(obj.rawdata)
+                    if len(window) >= WINDOW_OBJECTS or size >= WINDOW_BYTES:
+                        break
+                streams = [obj for (_, obj) in window if self.needsdecrypt(obj)]
+                result = None
+                if streams:
+                    jobs = [(obj.decipher.__name__, obj.objid, obj.genno, obj.rawdata) for obj in streams]
+                    batchsize = max(1, (len(jobs) + self.workers - 1) // self.workers)
+                    batches = [(doc.decrypt_key, doc.genkey.__name__, jobs[i:i+batchsize])
+                               for i in xrange(0, len(jobs), batchsize)]
+                    result = pool.map_async(decryptStreamBatch, batches)
+                if pending is not None:
+                    for item in self.finishwindow(*pending):
+                        yield item
+                if not window:
+                    break
+                pending = (window, streams, result)
+            pool.close()
+        except:
+            pool.terminate()
+            raise
+        finally:
+            pool.join()
+
+    def needsdecrypt(self, obj):
+        # the streams whose bodies get_decdata would have to decrypt
+        if not isinstance(obj, PDFStream) or obj.decdata is not None:
+            return False
+        if not obj.decipher or not obj.rawdata:
+            return False
+        # object streams are left out unless cross ref streams are written
+        return self.doc.gen_xref_stm or obj.dic.get('Type') != LITERAL_OBJSTM
+
+    def finishwindow(self, window, streams, result):
+        if result is not None:
+            decrypted = []
+            for batch in result.get():
+                decrypted.extend(batch)
+            for (obj, data) in izip(streams, decrypted):
+                obj.decdata = data
+        for item in window:
+            yield item
+        # don't keep the decrypted copies once they have been written
+        for obj in streams:
+            obj.decdata = None
 
     def dump(self, outf):
-        self.outf = outf
+        self.writer = PDFWriter(outf)
+        self.names = {}
         self.write(self.version)
         self.write('\n%\xe2\xe3\xcf\xd3\n')
         doc = self.doc
@@ -2019,11 +2458,28 @@ class PDFSerializer(object):
         maxobj = max(objids)
         trailer = dict(self.trailer)
         trailer['Size'] = maxobj + 1
-        for objid in objids:
-            obj = doc.getobj(objid)
+        if self.streaming:
+            self.pin_page_tree()
+        packing = self.objstmsize > 0
+        xrefstm = doc.gen_xref_stm or packing
+        pack = []
+        for (objid, obj) in self.objects():
             if isinstance(obj, PDFObjStmRef):
                 xrefs[objid] = obj
                 continue
+            if packing and obj is not None:
+                if not isinstance(obj, PDFStream):
+                    pack.append((objid, self.serialize_packed(obj)))
+                    doc.release(objid)
+                    if len(pack) >= self.objstmsize:
+                        maxobj += 1
+                        self.write_objstm(maxobj, pack, xrefs)
+                        pack = []
+                    continue
+                if obj.dic.get('Type') in (LITERAL_OBJSTM, LITERAL_XREF):
+                    # the input's object and xref streams are replaced
+                    doc.release(objid)
+                    continue
             if obj is not None:
                 try:
                     genno = obj.genno
@@ -2031,9 +2487,13 @@ class PDFSerializer(object):
                     genno = 0
                 xrefs[objid] = (self.tell(), genno)
                 self.serialize_indirect(objid, obj)
+                doc.release(objid)
+        if pack:
+            maxobj += 1
+            self.write_objstm(maxobj, pack, xrefs)
         startxref = self.tell()
 
-        if not gen_xref_stm:
+        if not xrefstm:
             self.write('xref\n')
             self.write('0 %d\n' % (maxobj + 1,))
             for objid in xrange(0, maxobj + 1):
@@ -2051,7 +2511,9 @@ class PDFSerializer(object):
 
             # Calculate size of entries
             maxoffset = max(startxref, maxobj)
-            maxindex = PDFObjStmRef.maxindex
+            maxindex = doc.objstm_maxindex
+            if packing:
+                maxindex = max(maxindex, self.objstmsize - 1)
             fl2 = 2
             power = 65536
             while maxoffset >= power:
@@ -2094,7 +2556,7 @@ class PDFSerializer(object):
                 data.append(struct.pack('>L', f2)[-fl2:])
                 data.append(struct.pack('>L', f3)[-fl3:])
             index.extend((first, prev - first + 1))
-            data = zlib.compress(''.join(data))
+            data = zlib.compress(''.join(data), self.zlevel)
             dic = {'Type': LITERAL_XREF, 'Size': prev + 1, 'Index': index,
                    'W': [1, fl2, fl3], 'Length': len(data),
                    'Filter': LITERALS_FLATE_DECODE[0],
@@ -2104,118 +2566,230 @@ class PDFSerializer(object):
             xrefstm = PDFStream(dic, data)
             self.serialize_indirect(maxobj, xrefstm)
             self.write('startxref\n%d\n%%%%EOF' % startxref)
+        self.writer.flush()
+
+    def serialize_packed(self, obj):
+        # the text of an object for an object stream
+        return ''.join(self.pieces(obj, '\n')[0])
+
+    def write_objstm(self, stmid, pack, xrefs):
+        # write (objid, text) pairs as object stream stmid
+        head = []
+        body = []
+        offset = 0
+        for (index, (objid, text)) in enumerate(pack):
+            head.append('%d %d' % (objid, offset))
+            body.append(text)
+            offset += len(text) + 1
+            xrefs[objid] = PDFObjStmRef(objid, stmid, index)
+        head = ' '.join(head) + '\n'
+        data = zlib.compress(head + '\n'.join(body) + '\n', self.zlevel)
+        dic = {'Type': LITERAL_OBJSTM, 'N': len(pack), 'First': len(head),
+               'Length': len(data), 'Filter': LITERALS_FLATE_DECODE[0]}
+        xrefs[stmid] = (self.tell(), 0)
+        self.serialize_indirect(stmid, PDFStream(dic, data))
+
+    def close(self):
+        # let go of the input file's memory map
+        self.doc.parser.close()
+
     def write(self, data):
-        self.outf.write(data)
-        self.last = data[-1:]
+        self.writer.write(data)
 
     def tell(self):
-        return self.outf.tell()
+        return self.writer.tell()
 
     def escape_string(self, string):
-        string = string.replace('\\', '\\\\')
-        string = string.replace('\n', r'\n')
-        string = string.replace('(', r'\(')
-        string = string.replace(')', r'\)')
-         # get rid of ciando id
-        regularexp = re.compile(r'http://www.ciando.com/index.cfm/intRefererID/\d{5}')
-        if regularexp.match(string): return ('http://www.ciando.com')
+        # strings with nothing to escape come through translate unchanged
+        if len(string.translate(None, STRING_ESCAPED)) != len(string):
+            string = string.replace('\\', '\\\\')
+            string = string.replace('\n', r'\n')
+            string = string.replace('(', r'\(')
+            string = string.replace(')', r'\)')
+        # get rid of ciando id
+        if CIANDO_ID.match(string): return ('http://www.ciando.com')
         return string
 
+    def pieces(self, obj, last):
+        # The text of obj as a list of strings, and the last character of
+        # it, given the last character written before. Nested objects are
+        # walked with a stack rather than by recursion. Raw text waiting
+        # on the stack is in a 1-tuple, which is never a PDF object.
+        out = []
+        append = out.append
+        names = self.names
+        stack = [obj]
+        pop = stack.pop
+        push = stack.append
+        kinds = SERIAL_KINDS
+        while stack:
+            obj = pop()
+            kind = kinds.get(type(obj))
+            if kind is None:
+                kind = serialKind(obj)
+            if kind == KIND_TEXT:
+                text = obj[0]
+            elif kind == KIND_DICT:
+                # Correct malformed Mac OS resource forks for Stanza
+                if 'ResFork' in obj and 'Type' in obj and 'Subtype' not in obj \
+                       and isinstance(obj['Type'], int):
+                    obj['Subtype'] = obj['Type']
+                    del obj['Type']
+                # end - hope this doesn't have bad effects
+                push(('>>',))
+                for (key, val) in reversed(obj.items()):
+                    push(val)
+                    push(('/' + key,))
+                text = '<<'
+            elif kind == KIND_LIST:
+                push((']',))
+                stack.extend(reversed(obj))
+                text = '['
+            elif kind == KIND_REF:
+                text = '%d 0 R' % obj.objid
+                if last.isalnum():
+                    append(' ')
+            elif kind == KIND_NAME:
+                text = names.get(obj)
+                if text is None:
+                    text = names[obj] = str(obj)
+            elif kind == KIND_NUMBER:
+                text = str(obj)
+                if last.isalnum():
+                    append(' ')
+            elif kind == KIND_STRING:
+                text = '(%s)' % self.escape_string(obj)
+            elif kind == KIND_BOOL:
+                text = obj and 'true' or 'false'
+                if last.isalnum():
+                    append(' ')
+            elif kind == KIND_STREAM:
+                # only inside another object in a broken file
+                if self.deleted(obj):
+                    text = '(deleted)'
+                else:
+                    push(('\nendstream',))
+                    push((obj.get_decdata(),))
+                    push(('stream\n',))
+                    push(obj.dic)
+                    continue
+            else:
+                text = str(obj)
+                if text[:1].isalnum() and last.isalnum():
+                    append(' ')
+            if text:
+                append(text)
+                last = text[-1]
+        return (out, last)
+
+    def deleted(self, obj):
+        ### If we don't generate cross ref streams the object streams
+        ### are no longer useful, as we have extracted all objects from
+        ### them. Therefore leave them out from the output.
+        ### (When packing, the only ones left are the new ones.)
+        return obj.dic.get('Type') == LITERAL_OBJSTM and not self.doc.gen_xref_stm \
+               and self.objstmsize <= 0
+
     def serialize_object(self, obj):
-        if isinstance(obj, dict):
-            # Correct malformed Mac OS resource forks for Stanza
-            if 'ResFork' in obj and 'Type' in obj and 'Subtype' not in obj \
-                   and isinstance(obj['Type'], int):
-                obj['Subtype'] = obj['Type']
-                del obj['Type']
-            # end - hope this doesn't have bad effects
-            self.write('<<')
-            for key, val in obj.items():
-                self.write('/%s' % key)
-                self.serialize_object(val)
-            self.write('>>')
-        elif isinstance(obj, list):
-            self.write('[')
-            for val in obj:
-                self.serialize_object(val)
-            self.write(']')
-        elif isinstance(obj, str):
-            self.write('(%s)' % self.escape_string(obj))
-        elif isinstance(obj, bool):
-            if self.last.isalnum():
-                self.write(' ')
-            self.write(str(obj).lower())
-        elif isinstance(obj, (int, long)):
-            if self.last.isalnum():
-                self.write(' ')
-            self.write(str(obj))
-        elif isinstance(obj, Decimal):
-            if self.last.isalnum():
-                self.write(' ')
-            self.write(str(obj))
-        elif isinstance(obj, PDFObjRef):
-            if self.last.isalnum():
-                self.write(' ')
-            self.write('%d %d R' % (obj.objid, 0))
-        elif isinstance(obj, PDFStream):
-            ### If we don't generate cross ref streams the object streams
-            ### are no longer useful, as we have extracted all objects from
-            ### them. Therefore leave them out from the output.
-            if obj.dic.get('Type') == LITERAL_OBJSTM and not gen_xref_stm:
-                self.write('(deleted)')
+        if isinstance(obj, PDFStream) and not self.deleted(obj):
+            self.serialize_object(obj.dic)
+            self.write('stream\n')
+            if self.streaming:
+                for data in obj.iter_decdata():
+                    self.write(data)
             else:
-                data = obj.get_decdata()
-                self.serialize_object(obj.dic)
-                self.write('stream\n')
-                self.write(data)
-                self.write('\nendstream')
-        else:
-            data = str(obj)
-            if data[0].isalnum() and self.last.isalnum():
-                self.write(' ')
-            self.write(data)
+                self.write(obj.get_decdata())
+            self.write('\nendstream')
+            return
+        self.write(''.join(self.pieces(obj, self.writer.last)[0]))
 
     def serialize_indirect(self, objid, obj):
         self.write('%d 0 obj' % (objid,))
         self.serialize_object(obj)
-        if self.last.isalnum():
+        if self.writer.last.isalnum():
             self.write('\n')
         self.write('endobj\n')
 
 
 
 
-def decryptBook(userkey, inpath, outpath):
+def decryptBook(userkey, inpath, outpath, workers=1, objstmsize=0, zlevel=ZLIB_LEVEL):
     if RSA is None:
         raise ADEPTError(u"PyCrypto or OpenSSL must be installed.")
+    streaming = os.path.getsize(inpath) >= STREAMING_SIZE
     with open(inpath, 'rb') as inf:
         #try:
-        serializer = PDFSerializer(inf, userkey)
+        serializer = PDFSerializer(inf, userkey, streaming, workers, objstmsize, zlevel)
         #except:
         #    print u"Error serializing pdf {0}. Probably wrong key.".format(os.path.basename(inpath))
         #    return 2
         # hope this will fix the 'bad file descriptor' problem
-        with open(outpath, 'wb') as outf:
-            # help construct to make sure the method runs to the end
-            try:
-                serializer.dump(outf)
-            except Exception, e:
-                print u"error writing pdf: {0}".format(e.args[0])
-                return 2
+        try:
+            with open(outpath, 'wb') as outf:
+                # help construct to make sure the method runs to the end
+                try:
+                    serializer.dump(outf)
+                except Exception, e:
+                    print u"error writing pdf: {0}".format(e.args[0])
+                    return 2
+        finally:
+            serializer.close()
     return 0
 
 
+def decryptBookKeys(userkeys, inpath, outpath, workers=1, objstmsize=0, zlevel=ZLIB_LEVEL):
+    # Like decryptBook, but with a list of (keyname, userkey) pairs.
+    # The file is parsed once, and outpath is only written when a key fits.
+    # Returns the name of the key used, or None.
+    if RSA is None:
+        raise ADEPTError(u"PyCrypto or OpenSSL must be installed.")
+    streaming = os.path.getsize(inpath) >= STREAMING_SIZE
+    with open(inpath, 'rb') as inf:
+        serializer = PDFSerializer(inf, None, streaming, workers, objstmsize, zlevel)
+        try:
+            keyname = serializer.findKey(userkeys)
+            if keyname is None:
+                print u"No key fits {0}".format(os.path.basename(inpath))
+                return None
+            with open(outpath, 'wb') as outf:
+                try:
+                    serializer.dump(outf)
+                except Exception, e:
+                    print u"error writing pdf: {0}".format(e.args[0])
+                    return None
+        finally:
+            serializer.close()
+    return keyname
+
+
 def cli_main():
     sys.stdout=SafeUnbuffered(sys.stdout)
     sys.stderr=SafeUnbuffered(sys.stderr)
     argv=unicode_argv()
     progname = os.path.basename(argv[0])
-    if len(argv) != 4:
-        print u"usage: {0} <keyfile.der> <inbook.pdf> <outbook.pdf>".format(progname)
+    usage = u"usage: {0} [-w workers] [-p objects_per_stream] [-z zlib_level] <keyfile.der> <inbook.pdf> <outbook.pdf>".format(progname)
+    workers = 1
+    objstmsize = 0
+    zlevel = ZLIB_LEVEL
+    try:
+        opts, args = getopt.getopt(argv[1:], "w:p:z:")
+        for o, a in opts:
+            if o == "-w":
+                workers = int(a)
+            if o == "-p":
+                objstmsize = int(a)
+            if o == "-z":
+                zlevel = int(a)
+    except (getopt.GetoptError, ValueError), err:
+        print u"Error in options or arguments: {0}".format(err)
+        print usage
+        return 1
+    if len(args) != 3:
+        print usage
         return 1
-    keypath, inpath, outpath = argv[1:]
+    keypath, inpath, outpath = args
     userkey = open(keypath,'rb').read()
-    result = decryptBook(userkey, inpath, outpath)
+    result = decryptBook(userkey, inpath, outpath, workers, objstmsize, zlevel)
     if result == 0:
         print u"Successfully decrypted {0:s} as {1:s}".format(os.path.basename(inpath),os.path.basename(outpath))
     return result
@@ -765,21 +765,39 @@ class DrmIonVoucher(object):
         self.envelope = BinaryIonParser(voucherenv)
         addprottable(self.envelope)
 
-    def decryptvoucher(self):
+    def getkey(self, dsn, secret):
         shared = "PIDv3" + self.encalgorithm + self.enctransformation + self.hashalgorithm
 
         self.lockparams.sort()
         for param in self.lockparams:
             if param == "ACCOUNT_SECRET":
-                shared += param + self.secret
+                shared += param + secret
             elif param == "CLIENT_ID":
-                shared += param + self.dsn
+                shared += param + dsn
             else:
                 _assert(False, "Unknown lock parameter: %s" % param)
 
         sharedsecret = shared.encode("UTF-8")
 
-        key = hmac.new(sharedsecret, sharedsecret[:5], digestmod=hashlib.sha256).digest()
+        return hmac.new(sharedsecret, sharedsecret[:5], digestmod=hashlib.sha256).digest()
+
+    def checkkey(self, key):
+        # Decrypt only the last block and check its padding. That rules out
+        # nearly every wrong key without decrypting and parsing the voucher.
+        if len(self.ciphertext) < 16 or len(self.ciphertext) % 16 != 0:
+            return True
+
+        if len(self.ciphertext) >= 32:
+            iv = self.ciphertext[-32:-16]
+        else:
+            iv = self.cipheriv[:16]
+        b = AES.new(key[:32], AES.MODE_CBC, iv).decrypt(self.ciphertext[-16:])
+        paddinglen = bord(b[-1])
+        return paddinglen > 0 and paddinglen <= 16 and b[-paddinglen:] == bchr(paddinglen) * paddinglen
+
+    def decryptvoucher(self, key=None):
+        if key is None:
+            key = self.getkey(self.dsn, self.secret)
         aes = AES.new(key[:32], AES.MODE_CBC, self.cipheriv[:16])
         b = aes.decrypt(self.ciphertext)
         b = pkcs7unpad(b, 16)
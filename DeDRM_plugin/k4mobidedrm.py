@@ -7,7 +7,7 @@ from __future__ import with_statement
 # Copyright © 2008-2019 by Apprentice Harper et al.
 
 __license__ = 'GPL v3'
-__version__ = '5.7'
+__version__ = '6.1'
 
 # Engine to remove drm from Kindle and Mobipocket ebooks
 # for personal use for archiving and converting your ebooks
@@ -62,6 +62,10 @@ __version__ = '5.7'
 #  5.5 - Added GPL v3 licence explicitly.
 #  5.6 - Invoke KFXZipBook to handle zipped KFX files
 #  5.7 - Revamp cleanup_name
+#  5.8 - Added -w option to decrypt Mobipocket records with several workers
+#  5.9 - Keep PIDs in the order given, so that the best ranked keys are tried first
+#  6.0 - Pass the -w workers on to Topaz books too, for page conversion
+#  6.1 - Optionally take one list of keys of all kinds, ranked by the caller
 
 import sys, os, re
 import csv
@@ -198,7 +202,9 @@ def unescape(text):
         return text # leave as is
     return re.sub(u"&#?\w+;", fixup, text)
 
-def GetDecryptedBook(infile, kDatabases, androidFiles, serials, pids, starttime = time.time()):
+# rankedkeys, if given, replaces kDatabases, serials and pids with one list
+# of keys of all kinds, to be tried in that order (see kgenpids.getRankedPidList)
+def GetDecryptedBook(infile, kDatabases, androidFiles, serials, pids, starttime = time.time(), workers = 1, rankedkeys = None):
     # handle the obvious cases at the beginning
     if not os.path.isfile(infile):
         raise DrmException(u"Input file does not exist.")
@@ -222,23 +228,39 @@ def GetDecryptedBook(infile, kDatabases, androidFiles, serials, pids, starttime
     bookname = unescape(mb.getBookTitle())
     print u"Decrypting {1} ebook: {0}".format(bookname, mb.getBookType())
 
-    # copy list of pids
-    totalpids = list(pids)
-    # extend list of serials with serials from android databases
-    for aFile in androidFiles:
-        serials.extend(androidkindlekey.get_serials(aFile))
-    # extend PID list with book-specific PIDs from seriala and kDatabases
     md1, md2 = mb.getPIDMetaInfo()
-    totalpids.extend(kgenpids.getPidList(md1, md2, serials, kDatabases))
-    # remove any duplicates
-    totalpids = list(set(totalpids))
+    if rankedkeys is not None:
+        # android serials come after the ranked keys
+        rankedkeys = list(rankedkeys)
+        for aFile in androidFiles:
+            rankedkeys.extend(('serial', serial) for serial in androidkindlekey.get_serials(aFile))
+        totalpids = kgenpids.getRankedPidList(md1, md2, rankedkeys)
+    else:
+        # copy list of pids
+        totalpids = list(pids)
+        # extend list of serials with serials from android databases
+        for aFile in androidFiles:
+            serials.extend(androidkindlekey.get_serials(aFile))
+        # extend PID list with book-specific PIDs from seriala and kDatabases
+        totalpids.extend(kgenpids.getPidList(md1, md2, serials, kDatabases))
+    # remove any duplicates, keeping the order the keys were given in
+    uniquepids = []
+    seenpids = set()
+    for pid in totalpids:
+        if pid not in seenpids:
+            seenpids.add(pid)
+            uniquepids.append(pid)
+    totalpids = uniquepids
     print u"Found {1:d} keys to try after {0:.1f} seconds".format(time.time()-starttime, len(totalpids))
     #print totalpids
 
     try:
-        mb.processBook(totalpids)
+        if isinstance(mb, (mobidedrm.MobiBook, topazextract.TopazBook)):
+            mb.processBook(totalpids, workers)
+        else:
+            mb.processBook(totalpids)
     except:
-        mb.cleanup
+        mb.cleanup()
         raise
 
     print u"Decryption succeeded after {0:.1f} seconds".format(time.time()-starttime)
@@ -246,7 +268,7 @@ def GetDecryptedBook(infile, kDatabases, androidFiles, serials, pids, starttime
 
 
 # kDatabaseFiles is a list of files created by kindlekey
-def decryptBook(infile, outdir, kDatabaseFiles, androidFiles, serials, pids):
+def decryptBook(infile, outdir, kDatabaseFiles, androidFiles, serials, pids, workers = 1):
     starttime = time.time()
     kDatabases = []
     for dbfile in kDatabaseFiles:
@@ -262,7 +284,7 @@ def decryptBook(infile, outdir, kDatabaseFiles, androidFiles, serials, pids):
 
 
     try:
-        book = GetDecryptedBook(infile, kDatabases, androidFiles, serials, pids, starttime)
+        book = GetDecryptedBook(infile, kDatabases, androidFiles, serials, pids, starttime, workers)
     except Exception, e:
         print u"Error decrypting book after {1:.1f} seconds: {0}".format(e.args[0],time.time()-starttime)
         traceback.print_exc()
@@ -302,7 +324,7 @@ def decryptBook(infile, outdir, kDatabaseFiles, androidFiles, serials, pids):
 def usage(progname):
     print u"Removes DRM protection from Mobipocket, Amazon KF8, Amazon Print Replica and Amazon Topaz ebooks"
     print u"Usage:"
-    print u"    {0} [-k <kindle.k4i>] [-p <comma separated PIDs>] [-s <comma separated Kindle serial numbers>] [ -a <AmazonSecureStorage.xml|backup.ab> ] <infile> <outdir>".format(progname)
+    print u"    {0} [-k <kindle.k4i>] [-p <comma separated PIDs>] [-s <comma separated Kindle serial numbers>] [ -a <AmazonSecureStorage.xml|backup.ab> ] [-w <number of workers>] <infile> <outdir>".format(progname)
 
 #
 # Main
@@ -313,7 +335,7 @@ def cli_main():
     print u"K4MobiDeDrm v{0}.\nCopyright © 2008-2017 Apprentice Harper et al.".format(__version__)
 
     try:
-        opts, args = getopt.getopt(argv[1:], "k:p:s:a:")
+        opts, args = getopt.getopt(argv[1:], "k:p:s:a:w:")
     except getopt.GetoptError, err:
         print u"Error in options or arguments: {0}".format(err.args[0])
         usage(progname)
@@ -328,6 +350,7 @@ def cli_main():
     androidFiles = []
     serials = []
     pids = []
+    workers = 1
 
     for o, a in opts:
         if o == "-k":
@@ -346,11 +369,16 @@ def cli_main():
             if a == None:
                 raise DrmException("Invalid parameter for -a")
             androidFiles.append(a)
+        if o == '-w':
+            try:
+                workers = int(a)
+            except ValueError:
+                raise DrmException("Invalid parameter for -w")
 
     # try with built in Kindle Info files if not on Linux
     k4 = not sys.platform.startswith('linux')
 
-    return decryptBook(infile, outdir, kDatabaseFiles, androidFiles, serials, pids)
+    return decryptBook(infile, outdir, kDatabaseFiles, androidFiles, serials, pids, workers)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,45 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# keyprobe.py
+
+__license__ = 'GPL v3'
+__version__ = '1.0'
+
+# Finds which of a list of candidate keys (PIDs) opens a Kindle book.
+# Used by mobidedrm.py, topazextract.py and kfxdedrm.py.
+#
+# Each candidate is turned into its key material once, then put through a
+# cheap test (a checksum, a few decrypted bytes, the padding of one block).
+# Only candidates that pass it get the full, expensive check, and probing
+# stops at the first candidate that is accepted.
+
+
+class KeyProbe(object):
+    # derive(candidate) returns the key material for a candidate, or None to skip it.
+    # quickcheck(key) returns something true (passed on to fullcheck) if the key may fit.
+    # fullcheck(key, hint) returns the result of decrypting with the key, or None.
+    def __init__(self, derive, quickcheck, fullcheck):
+        self.derive = derive
+        self.quickcheck = quickcheck
+        self.fullcheck = fullcheck
+        self.tried = 0
+
+    def find(self, candidates):
+        # returns (candidate, result) for the first candidate accepted, or (None, None)
+        seen = set()
+        for candidate in candidates:
+            if candidate in seen:
+                continue
+            seen.add(candidate)
+            self.tried += 1
+            key = self.derive(candidate)
+            if key is None:
+                continue
+            hint = self.quickcheck(key)
+            if not hint:
+                continue
+            result = self.fullcheck(key, hint)
+            if result is not None:
+                return candidate, result
+        return None, None
@@ -17,18 +17,21 @@ except ImportError:
 
 try:
     from calibre_plugins.dedrm import ion
+    from calibre_plugins.dedrm import keyprobe
 except ImportError:
     import ion
+    import keyprobe
 
 
 __license__ = 'GPL v3'
-__version__ = '1.0'
+__version__ = '1.1'
 
 
 class KFXZipBook:
     def __init__(self, infile):
         self.infile = infile
         self.voucher = None
+        self.foundpid = None
         self.decrypted = {}
 
     def getPIDMetaInfo(self):
@@ -68,22 +71,37 @@ class KFXZipBook:
 
         print(u'Decrypting KFX DRM voucher: {0}'.format(info.filename))
 
-        for pid in [''] + totalpids:
+        voucher = ion.DrmIonVoucher(StringIO(data), '', '')
+        try:
+            voucher.parse()
+        except:
+            raise Exception(u'Failed to decrypt KFX DRM voucher with any key')
+
+        def derive(pid):
             for dsn_len,secret_len in [(0,0), (16,0), (16,40), (32,40), (40,0), (40,40)]:
                 if len(pid) == dsn_len + secret_len:
                     break       # split pid into DSN and account secret
             else:
-                continue
+                return None
+            dsn, secret = pid[:dsn_len], pid[dsn_len:]
+            return dsn, secret, voucher.getkey(dsn, secret)
+
+        def quickcheck(key):
+            return voucher.checkkey(key[2])
 
+        def fullcheck(key, hint):
             try:
-                voucher = ion.DrmIonVoucher(StringIO(data), pid[:dsn_len], pid[dsn_len:])
-                voucher.parse()
-                voucher.decryptvoucher()
-                break
+                voucher.decryptvoucher(key[2])
             except:
-                pass
-        else:
+                return None
+            voucher.dsn, voucher.secret = key[0], key[1]
+            return True
+
+        pid, found = keyprobe.KeyProbe(derive, quickcheck, fullcheck).find([''] + totalpids)
+        if not found:
             raise Exception(u'Failed to decrypt KFX DRM voucher with any key')
+        if pid != '':
+            self.foundpid = pid
 
         print(u'KFX DRM voucher successfully decrypted')
 
@@ -94,6 +112,9 @@ class KFXZipBook:
 
         self.voucher = voucher
 
+    def getFoundPID(self):
+        return self.foundpid
+
     def getBookTitle(self):
         return os.path.splitext(os.path.split(self.infile)[1])[0]
 
@@ -8,12 +8,13 @@ from __future__ import print_function
 # Copyright © 2008-2017 Apprentice Harper et al.
 
 __license__ = 'GPL v3'
-__version__ = '2.1'
+__version__ = '2.2'
 
 # Revision history:
 #  2.0   - Fix for non-ascii Windows user names
 #  2.1   - Actual fix for non-ascii WIndows user names.
 #  x.x   - Return information needed for KFX decryption
+#  2.2   - Added getRankedPidList, for keys ranked across PIDs, serials and databases
 
 import sys
 import os, csv
@@ -309,3 +310,16 @@ def getPidList(md1, md2, serials=[], kDatabases=[]):
             traceback.print_exc()
 
     return pidlst
+
+# PIDs for keys of all kinds, in the order given. Each key is one of
+# ('pid', pid), ('serial', serialnum) or ('kDatabase', (name, kDatabase)).
+def getRankedPidList(md1, md2, keys):
+    pidlst = []
+    for (kind, key) in keys:
+        if kind == 'pid':
+            pidlst.append(key)
+        elif kind == 'serial':
+            pidlst.extend(getPidList(md1, md2, [key], []))
+        elif kind == 'kDatabase':
+            pidlst.extend(getPidList(md1, md2, [], [key]))
+    return pidlst
@@ -7,7 +7,7 @@
 
 from __future__ import print_function
 __license__ = 'GPL v3'
-__version__ = u"0.42"
+__version__ = u"0.47"
 
 # This is a python script. You need a Python interpreter to run it.
 # For example, ActiveState Python, which exists for windows.
@@ -73,16 +73,36 @@ __version__ = u"0.42"
 #  0.40 - moved unicode_argv call inside main for Windows DeDRM compatibility
 #  0.41 - Fixed potential unicode problem in command line calls
 #  0.42 - Added GPL v3 licence. updated/removed some print statements
+#  0.43 - Optionally decrypt text records in parallel with a pool of workers
+#  0.44 - Read sections through the shared memory mapped PalmDB reader
+#  0.45 - Stream the output, copying unencrypted records directly from the input file
+#  0.46 - Faster python PC1 implementation
+#  0.47 - Probe PIDs with the shared key probe, checking the cookie's verification value first
 
 import sys
 import os
 import struct
 import binascii
+try:
+    from cStringIO import StringIO
+except ImportError:
+    from StringIO import StringIO
 try:
     from alfcrypto import Pukall_Cipher
 except:
     print(u"AlfCrypto not found. Using python PC1 implementation.")
 
+if 'calibre' in sys.modules:
+    inCalibre = True
+    from calibre_plugins.dedrm import palmdb
+    from calibre_plugins.dedrm import keyprobe
+    from calibre_plugins.dedrm import workerpool
+else:
+    inCalibre = False
+    import palmdb
+    import keyprobe
+    import workerpool
+
 # Wrap a stream so that output gets flushed immediately
 # and also make sure that any unicode strings get
 # encoded using "replace" before writing them.
@@ -160,36 +180,89 @@ def PC1(key, src, decryption=True):
     except TypeError:
         pass
 
-    # use slow python version, since Pukall_Cipher didn't load
-    sum1 = 0;
-    sum2 = 0;
-    keyXorVal = 0;
+    # use the python version, since Pukall_Cipher didn't load
     if len(key)!=16:
-         DrmException (u"PC1: Bad key length")
-    wkey = []
-    for i in xrange(8):
-        wkey.append(ord(key[i*2])<<8 | ord(key[i*2+1]))
-    dst = ""
+        raise DrmException(u"PC1: Bad key length")
+    # the key words live in locals and the eight rounds per byte are
+    # unrolled, as attribute and list lookups dominate the inner loop
+    key = bytearray(key)
+    w0 = key[0]<<8 | key[1]
+    w1 = key[2]<<8 | key[3]
+    w2 = key[4]<<8 | key[5]
+    w3 = key[6]<<8 | key[7]
+    w4 = key[8]<<8 | key[9]
+    w5 = key[10]<<8 | key[11]
+    w6 = key[12]<<8 | key[13]
+    w7 = key[14]<<8 | key[15]
+    sum1 = 0
+    sum2 = 0
+    src = bytearray(src)
+    dst = bytearray(len(src))
     for i in xrange(len(src)):
-        temp1 = 0;
-        byteXorVal = 0;
-        for j in xrange(8):
-            temp1 ^= wkey[j]
-            sum2  = (sum2+j)*20021 + sum1
-            sum1  = (temp1*346)&0xFFFF
-            sum2  = (sum2+sum1)&0xFFFF
-            temp1 = (temp1*20021+1)&0xFFFF
-            byteXorVal ^= temp1 ^ sum2
-        curByte = ord(src[i])
-        if not decryption:
-            keyXorVal = curByte * 257;
-        curByte = ((curByte ^ (byteXorVal >> 8)) ^ byteXorVal) & 0xFF
+        t = w0
+        sum2 = sum2*20021 + sum1
+        sum1 = (t*346)&0xFFFF
+        sum2 = (sum2+sum1)&0xFFFF
+        t = (t*20021+1)&0xFFFF
+        x = t ^ sum2
+        t ^= w1
+        sum2 = (sum2+1)*20021 + sum1
+        sum1 = (t*346)&0xFFFF
+        sum2 = (sum2+sum1)&0xFFFF
+        t = (t*20021+1)&0xFFFF
+        x ^= t ^ sum2
+        t ^= w2
+        sum2 = (sum2+2)*20021 + sum1
+        sum1 = (t*346)&0xFFFF
+        sum2 = (sum2+sum1)&0xFFFF
+        t = (t*20021+1)&0xFFFF
+        x ^= t ^ sum2
+        t ^= w3
+        sum2 = (sum2+3)*20021 + sum1
+        sum1 = (t*346)&0xFFFF
+        sum2 = (sum2+sum1)&0xFFFF
+        t = (t*20021+1)&0xFFFF
+        x ^= t ^ sum2
+        t ^= w4
+        sum2 = (sum2+4)*20021 + sum1
+        sum1 = (t*346)&0xFFFF
+        sum2 = (sum2+sum1)&0xFFFF
+        t = (t*20021+1)&0xFFFF
+        x ^= t ^ sum2
+        t ^= w5
+        sum2 = (sum2+5)*20021 + sum1
+        sum1 = (t*346)&0xFFFF
+        sum2 = (sum2+sum1)&0xFFFF
+        t = (t*20021+1)&0xFFFF
+        x ^= t ^ sum2
+        t ^= w6
+        sum2 = (sum2+6)*20021 + sum1
+        sum1 = (t*346)&0xFFFF
+        sum2 = (sum2+sum1)&0xFFFF
+        t = (t*20021+1)&0xFFFF
+        x ^= t ^ sum2
+        t ^= w7
+        sum2 = (sum2+7)*20021 + sum1
+        sum1 = (t*346)&0xFFFF
+        sum2 = (sum2+sum1)&0xFFFF
+        t = (t*20021+1)&0xFFFF
+        x ^= t ^ sum2
+        curByte = src[i]
+        plainByte = (curByte ^ (x >> 8) ^ x) & 0xFF
+        dst[i] = plainByte
         if decryption:
-            keyXorVal = curByte * 257;
-        for j in xrange(8):
-            wkey[j] ^= keyXorVal;
-        dst+=chr(curByte)
-    return dst
+            keyXorVal = plainByte * 257
+        else:
+            keyXorVal = curByte * 257
+        w0 ^= keyXorVal
+        w1 ^= keyXorVal
+        w2 ^= keyXorVal
+        w3 ^= keyXorVal
+        w4 ^= keyXorVal
+        w5 ^= keyXorVal
+        w6 ^= keyXorVal
+        w7 ^= keyXorVal
+    return bytes(dst)
 
 def checksumPid(s):
     letters = 'ABCDEFGHIJKLMNPQRSTUVWXYZ123456789'
@@ -229,20 +302,35 @@ def getSizeOfTrailingDataEntries(ptr, size, flags):
         num += (ord(ptr[size - num - 1]) & 0x3) + 1
     return num
 
+# Is PC1 provided by the native alfcrypto library?
+def nativePC1():
+    try:
+        return Pukall_Cipher.native
+    except (NameError, AttributeError):
+        return False
+
+# Decrypt a batch of text records. Every record restarts PC1 from the
+# book key, so batches are independent and can go to separate workers.
+def decryptRecordBatch(key, records):
+    return [PC1(key, data) for data in records]
+
+# Decrypt text records with a pool of workers, keeping them in order
+def decryptRecords(key, records, workers):
+    decoded = []
+    for data in workerpool.mapBatches(decryptRecordBatch, key, records, len(records), workers, nativePC1()):
+        decoded.append(data)
+        if len(decoded)%100 == 0:
+            print(u".", end=' ')
+    return decoded
 
 
 class MobiBook:
     def loadSection(self, section):
-        if (section + 1 == self.num_sections):
-            endoff = len(self.data_file)
-        else:
-            endoff = self.sections[section + 1][0]
-        off = self.sections[section][0]
-        return self.data_file[off:endoff]
+        return self.palmdb.loadSection(section)
 
     def cleanup(self):
         # to match function in Topaz book
-        pass
+        self.palmdb.close()
 
     def __init__(self, infile):
         print(u"MobiDeDrm v{0:s}.\nCopyright © 2008-2017 The Dark Reverser, Apprentice Harper et al.".format(__version__))
@@ -253,21 +341,26 @@ class MobiBook:
             print(u"AlfCrypto not found. Using python PC1 implementation.")
 
         # initial sanity check on file
-        self.data_file = file(infile, 'rb').read()
-        self.mobi_data = ''
-        self.header = self.data_file[0:78]
-        if self.header[0x3C:0x3C+8] != 'BOOKMOBI' and self.header[0x3C:0x3C+8] != 'TEXtREAd':
+        try:
+            self.palmdb = palmdb.PalmDB(infile)
+        except ValueError:
             raise DrmException(u"Invalid file format")
-        self.magic = self.header[0x3C:0x3C+8]
+        # output pieces: strings to write, or (offset, length) ranges to copy from the input
+        self.mobidataList = []
+        self.header = self.palmdb.header
+        if (self.palmdb.ident != 'BOOKMOBI' and self.palmdb.ident != 'TEXtREAd') or self.palmdb.num_sections == 0:
+            self.palmdb.close()
+            raise DrmException(u"Invalid file format")
+        self.magic = self.palmdb.ident
         self.crypto_type = -1
+        self.foundpid = None
+
+        # section offsets, with the end of file as the final entry
+        self.num_sections = self.palmdb.num_sections
+        self.sections = self.palmdb.offsets
 
-        # build up section offset and flag info
-        self.num_sections, = struct.unpack('>H', self.header[76:78])
-        self.sections = []
-        for i in xrange(self.num_sections):
-            offset, a1,a2,a3,a4 = struct.unpack('>LBBBB', self.data_file[78+i*8:78+i*8+8])
-            flags, val = a1, a2<<16|a3<<8|a4
-            self.sections.append( (offset, flags, val) )
+        # the header and section 0 get patched, so keep them in memory
+        self.header_data = self.palmdb.data[:self.sections[1]]
 
         # parse information from section 0
         self.sect = self.loadSection(0)
@@ -360,52 +453,67 @@ class MobiBook:
         return rec209, token
 
     def patch(self, off, new):
-        self.data_file = self.data_file[:off] + new + self.data_file[off+len(new):]
+        # only the header and section 0 are held in memory to be patched
+        assert off + len(new) <= len(self.header_data)
+        self.header_data = self.header_data[:off] + new + self.header_data[off+len(new):]
 
     def patchSection(self, section, new, in_off = 0):
-        if (section + 1 == self.num_sections):
-            endoff = len(self.data_file)
-        else:
-            endoff = self.sections[section + 1][0]
-        off = self.sections[section][0]
+        endoff = self.sections[section + 1]
+        off = self.sections[section]
         assert off + in_off + len(new) <= endoff
         self.patch(off + in_off, new)
 
     def parseDRM(self, data, count, pidlist):
-        found_key = None
         keyvec1 = '\x72\x38\x33\xB0\xB4\xF2\xE3\xCA\xDF\x09\x01\xD6\xE2\xE0\x3F\x96'
-        for pid in pidlist:
-            bigpid = pid.ljust(16,'\0')
-            temp_key = PC1(keyvec1, bigpid, False)
-            temp_key_sum = sum(map(ord,temp_key)) & 0xff
-            found_key = None
-            for i in xrange(count):
-                verification, size, type, cksum, cookie = struct.unpack('>LLLBxxx32s', data[i*0x30:i*0x30+0x30])
-                if cksum == temp_key_sum:
-                    cookie = PC1(temp_key, cookie)
-                    ver,flags,finalkey,expiry,expiry2 = struct.unpack('>LL16sLL', cookie)
-                    if verification == ver and (flags & 0x1F) == 1:
-                        found_key = finalkey
-                        break
-            if found_key != None:
-                break
+        # unpack the DRM records once, grouped by the checksum of the key that opens them
+        drmrecords = {}
+        for i in xrange(count):
+            verification, size, type, cksum, cookie = struct.unpack('>LLLBxxx32s', data[i*0x30:i*0x30+0x30])
+            drmrecords.setdefault(cksum, []).append((verification, cookie))
+
+        def derive(pid):
+            temp_key = PC1(keyvec1, pid.ljust(16,'\0'), False)
+            return temp_key, sum(map(ord,temp_key)) & 0xff
+
+        def quickcheck(key):
+            # the cookie starts with the verification value, so
+            # decrypting its first four bytes weeds out wrong keys
+            temp_key, temp_key_sum = key
+            return [(verification, cookie) for verification, cookie in drmrecords.get(temp_key_sum, [])
+                    if PC1(temp_key, cookie[:4]) == struct.pack('>L', verification)]
+
+        def fullcheck(key, matches, anyflags=False):
+            temp_key, temp_key_sum = key
+            for verification, cookie in matches:
+                cookie = PC1(temp_key, cookie)
+                ver,flags,finalkey,expiry,expiry2 = struct.unpack('>LL16sLL', cookie)
+                if verification == ver and (anyflags or (flags & 0x1F) == 1):
+                    return finalkey
+            return None
+
+        pid, found_key = keyprobe.KeyProbe(derive, quickcheck, fullcheck).find(pidlist)
         if not found_key:
             # Then try the default encoding that doesn't require a PID
             pid = '00000000'
-            temp_key = keyvec1
-            temp_key_sum = sum(map(ord,temp_key)) & 0xff
-            for i in xrange(count):
-                verification, size, type, cksum, cookie = struct.unpack('>LLLBxxx32s', data[i*0x30:i*0x30+0x30])
-                if cksum == temp_key_sum:
-                    cookie = PC1(temp_key, cookie)
-                    ver,flags,finalkey,expiry,expiry2 = struct.unpack('>LL16sLL', cookie)
-                    if verification == ver:
-                        found_key = finalkey
-                        break
+            defaultkey = lambda pid: (keyvec1, sum(map(ord,keyvec1)) & 0xff)
+            defaultcheck = lambda key, matches: fullcheck(key, matches, True)
+            found_key = keyprobe.KeyProbe(defaultkey, quickcheck, defaultcheck).find([pid])[1]
         return [found_key,pid]
 
+    def writeBook(self, outf):
+        for piece in self.mobidataList:
+            if isinstance(piece, tuple):
+                self.palmdb.copyRange(outf, piece[0], piece[1])
+            else:
+                outf.write(piece)
+
     def getFile(self, outpath):
-        file(outpath,'wb').write(self.mobi_data)
+        with open(outpath, 'wb') as outf:
+            self.writeBook(outf)
+
+    def getFoundPID(self):
+        # the PID from the list passed to processBook that opened the book, if one was needed
+        return self.foundpid
 
     def getBookType(self):
         if self.print_replica:
@@ -423,7 +531,7 @@ class MobiBook:
             return u".azw3"
         return u".mobi"
 
-    def processBook(self, pidlist):
+    def processBook(self, pidlist, workers=1):
         crypto_type, = struct.unpack('>H', self.sect[0xC:0xC+2])
         print(u"Crypto Type is: {0:d}".format(crypto_type))
         self.crypto_type = crypto_type
@@ -431,7 +539,7 @@ class MobiBook:
             print(u"This book is not encrypted.")
             # we must still check for Print Replica
             self.print_replica = (self.loadSection(1)[0:4] == '%MOP')
-            self.mobi_data = self.data_file
+            self.mobidataList = [self.header_data, (len(self.header_data), len(self.palmdb) - len(self.header_data))]
             return
         if crypto_type != 2 and crypto_type != 1:
             raise DrmException(u"Cannot decode unknown Mobipocket encryption type {0:d}".format(crypto_type))
@@ -442,13 +550,17 @@ class MobiBook:
                 raise DrmException(u"Cannot decode library or rented ebooks.")
 
         goodpids = []
+        # remember which of the PIDs passed in each one came from
+        origpids = {}
         for pid in pidlist:
             if len(pid)==10:
                 if checksumPid(pid[0:-2]) != pid:
                     print(u"Warning: PID {0} has incorrect checksum, should have been {1}".format(pid,checksumPid(pid[0:-2])))
                 goodpids.append(pid[0:-2])
+                origpids.setdefault(pid[0:-2], pid)
             elif len(pid)==8:
                 goodpids.append(pid)
+                origpids.setdefault(pid, pid)
             else:
                 print(u"Warning: PID {0} has wrong number of digits".format(pid))
 
@@ -479,6 +591,7 @@ class MobiBook:
             print(u"File has default encryption, no specific key needed.")
         else:
             print(u"File is encoded with PID {0}.".format(checksumPid(pid)))
+            self.foundpid = origpids.get(pid)
 
         # clear the crypto type
         self.patchSection(0, "\0" * 2, 0xC)
@@ -486,31 +599,51 @@ class MobiBook:
         # decrypt sections
         print(u"Decrypting. Please wait . . .", end=' ')
         mobidataList = []
-        mobidataList.append(self.data_file[:self.sections[1][0]])
-        for i in xrange(1, self.records+1):
-            data = self.loadSection(i)
-            extra_size = getSizeOfTrailingDataEntries(data, len(data), self.extra_data_flags)
-            if i%100 == 0:
-                print(u".", end=' ')
-            # print "record %d, extra_size %d" %(i,extra_size)
-            decoded_data = PC1(found_key, data[0:len(data) - extra_size])
-            if i==1:
-                self.print_replica = (decoded_data[0:4] == '%MOP')
-            mobidataList.append(decoded_data)
-            if extra_size > 0:
-                mobidataList.append(data[-extra_size:])
+        mobidataList.append(self.header_data)
+        if workers > 1 and self.records > 1:
+            records = []
+            trailers = []
+            for i in xrange(1, self.records+1):
+                data = self.loadSection(i)
+                extra_size = getSizeOfTrailingDataEntries(data, len(data), self.extra_data_flags)
+                records.append(data[0:len(data) - extra_size])
+                trailers.append(data[len(data) - extra_size:])
+            decoded = decryptRecords(found_key, records, workers)
+            self.print_replica = (decoded[0][0:4] == '%MOP')
+            for decoded_data, trailer in zip(decoded, trailers):
+                mobidataList.append(decoded_data)
+                if len(trailer) > 0:
+                    mobidataList.append(trailer)
+        else:
+            for i in xrange(1, self.records+1):
+                data = self.loadSection(i)
+                extra_size = getSizeOfTrailingDataEntries(data, len(data), self.extra_data_flags)
+                if i%100 == 0:
+                    print(u".", end=' ')
+                # print "record %d, extra_size %d" %(i,extra_size)
+                decoded_data = PC1(found_key, data[0:len(data) - extra_size])
+                if i==1:
+                    self.print_replica = (decoded_data[0:4] == '%MOP')
+                mobidataList.append(decoded_data)
+                if extra_size > 0:
+                    mobidataList.append(data[-extra_size:])
         if self.num_sections > self.records+1:
-            mobidataList.append(self.data_file[self.sections[self.records+1][0]:])
-        self.mobi_data = "".join(mobidataList)
+            # image and other resource records are not encrypted, so copy them as they are
+            tailoff = self.sections[self.records+1]
+            mobidataList.append((tailoff, len(self.palmdb) - tailoff))
+        self.mobidataList = mobidataList
         print(u"done")
         return
 
-def getUnencryptedBook(infile,pidlist):
+def getUnencryptedBook(infile,pidlist,workers=1):
     if not os.path.isfile(infile):
         raise DrmException(u"Input File Not Found.")
     book = MobiBook(infile)
-    book.processBook(pidlist)
-    return book.mobi_data
+    book.processBook(pidlist,workers)
+    outf = StringIO()
+    book.writeBook(outf)
+    book.cleanup()
+    return outf.getvalue()
 
 
 def cli_main():
@@ -530,8 +663,12 @@ def cli_main():
         else:
             pidlist = []
         try:
-            stripped_file = getUnencryptedBook(infile, pidlist)
-            file(outfile, 'wb').write(stripped_file)
+            if not os.path.isfile(infile):
+                raise DrmException(u"Input File Not Found.")
+            book = MobiBook(infile)
+            book.processBook(pidlist)
+            book.getFile(outfile)
+            book.cleanup()
         except DrmException, e:
             print(u"MobiDeDRM v{0} Error: {1:s}".format(__version__,e.args[0]))
             return 1
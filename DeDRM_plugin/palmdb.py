@@ -0,0 +1,112 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# palmdb.py
+
+__license__ = 'GPL v3'
+__version__ = '1.0'
+
+# Section reader for Palm database (PDB) files, shared by the
+# Mobipocket (mobidedrm.py) and eReader (erdr2pml.py) handlers.
+#
+# The file is memory mapped rather than read into a string, and sections
+# are handed out as read-only views of the map, so a section only gets
+# copied when the caller slices it.
+
+import os
+import mmap
+import struct
+from array import array
+
+
+class PalmDB(object):
+    def __init__(self, filename):
+        self.fo = open(filename, 'rb')
+        try:
+            self.data = mmap.mmap(self.fo.fileno(), 0, access=mmap.ACCESS_READ)
+        except (ValueError, EnvironmentError):
+            # an empty file can't be mapped
+            self.fo.close()
+            raise ValueError('Invalid file format')
+        self.header = self.data[0:78]
+        if len(self.header) < 78:
+            self.close()
+            raise ValueError('Invalid file format')
+        self.ident = self.header[0x3C:0x3C+8]
+        self.num_sections, = struct.unpack('>H', self.header[76:78])
+
+        # the section table holds an offset, an attribute byte and a three byte
+        # unique id for each section. Only the offsets are needed. One extra
+        # entry marks the end of the file, so section i always spans
+        # offsets[i] to offsets[i+1].
+        table = self.data[78:78+self.num_sections*8]
+        if len(table) < self.num_sections*8:
+            self.close()
+            raise ValueError('Invalid file format')
+        self.offsets = array('L', struct.unpack('>' + 'L4x'*self.num_sections, table))
+        self.offsets.append(len(self.data))
+
+        try:
+            self.view = memoryview(self.data)
+        except TypeError:
+            # Python 2 mmap objects only support the old buffer interface
+            self.view = None
+
+    def __len__(self):
+        return len(self.data)
+
+    def sectionSize(self, section):
+        return max(0, self.offsets[section + 1] - self.offsets[section])
+
+    def getView(self, offset, size):
+        if self.view is not None:
+            return self.view[offset:offset+size]
+        return buffer(self.data, offset, size)
+
+    def loadSection(self, section):
+        return self.getView(self.offsets[section], self.sectionSize(section))
+
+    def copyRange(self, outf, offset, size):
+        # Copy part of the input file to outf without passing it through
+        # Python strings: inside the kernel where os.copy_file_range or
+        # os.sendfile are available, otherwise straight out of the map.
+        try:
+            outfd = outf.fileno()
+        except (AttributeError, EnvironmentError, ValueError):
+            outfd = None
+        if outfd is not None:
+            outf.flush()
+            infd = self.fo.fileno()
+            for name in ('copy_file_range', 'sendfile'):
+                func = getattr(os, name, None)
+                if func is None:
+                    continue
+                try:
+                    while size > 0:
+                        if name == 'copy_file_range':
+                            done = func(infd, outfd, size, offset)
+                        else:
+                            done = func(outfd, infd, offset, size)
+                        if done == 0:
+                            break
+                        offset += done
+                        size -= done
+                except EnvironmentError:
+                    # not supported for this pair of files, try the next way
+                    pass
+                # keep the file object's idea of its position in step
+                outf.seek(0, os.SEEK_END)
+                if size == 0:
+                    return
+        while size > 0:
+            chunk = min(size, 1 << 20)
+            outf.write(self.getView(offset, chunk))
+            offset += chunk
+            size -= chunk
+
+    def close(self):
+        self.view = None
+        if self.data is not None:
+            self.data.close()
+            self.data = None
+        self.fo.close()
@@ -0,0 +1,320 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# pdffilters.py
+
+__license__ = 'GPL v3'
+__version__ = '1.0'
+
+# Stream filters for ineptpdf.py.
+#
+# Each filter is a function taking the (decrypted) stream data and a dict of
+# its decode parameters, with any indirect objects already resolved, and
+# returning the decoded data. Filters are looked up by name in FILTERS, so
+# more can be added with registerFilter without touching the PDF parser.
+#
+# PNG and TIFF predictors work on whole rows at once: a row is turned into
+# one long integer and added to its neighbour a byte at a time with a few
+# masked integer operations, instead of a Python loop over the bytes. A run
+# of PNG rows using the Up filter, which is what xref streams are made of,
+# is summed all at once in a handful of passes over the data.
+
+import re
+import zlib
+import struct
+from binascii import hexlify, unhexlify, Error as BinasciiError
+
+
+FILTERS = {}
+
+def registerFilter(func, *names):
+    for name in names:
+        FILTERS[name] = func
+    return func
+
+def getFilter(name):
+    return FILTERS.get(name)
+
+def decode(data, filters, params=None):
+    # filters is a list of filter names and params a list of parameter
+    # dicts, one per filter (or None). Raises KeyError for an unknown filter.
+    if params is None:
+        params = []
+    for (i, name) in enumerate(filters):
+        func = FILTERS.get(name)
+        if func is None:
+            raise KeyError(name)
+        if i < len(params) and params[i]:
+            data = func(data, params[i])
+        else:
+            data = func(data, {})
+    return data
+
+
+##  Bytewise arithmetic on long integers
+##
+
+def toInt(s):
+    if not s:
+        return 0
+    return int(hexlify(s), 16)
+
+def fromInt(x, n):
+    if not n:
+        return ''
+    return unhexlify('%0*x' % (2*n, x))
+
+class ByteAdder(object):
+    # Adds strings of n bytes to each other a byte at a time, modulo 256,
+    # with the carry out of each byte dropped.
+    def __init__(self, n):
+        self.n = n
+        self.full = (1 << (8*n)) - 1
+        self.low = int('7f'*n, 16) if n else 0
+        self.high = self.full ^ self.low
+
+    def add(self, x, y):
+        # x and y are the integer forms of two strings of n bytes
+        low = self.low
+        return ((x & low) + (y & low)) ^ ((x ^ y) & self.high)
+
+    def prefix(self, x, step):
+        # each byte gets the sum of itself and every step'th byte before it
+        shift = 8*step
+        bits = 8*self.n
+        while shift < bits:
+            x = self.add(x, x >> shift)
+            shift *= 2
+        return x
+
+
+##  Predictors
+##
+
+def predictor(data, params):
+    pred = int(params.get('Predictor', 1))
+    if pred <= 1:
+        return data
+    colors = int(params.get('Colors', 1))
+    bpc = int(params.get('BitsPerComponent', 8))
+    columns = int(params.get('Columns', 1))
+    if colors < 1 or columns < 1 or bpc not in (1, 2, 4, 8, 16):
+        raise ValueError('Invalid predictor parameters: %r' % params)
+    if pred == 2:
+        return tiffPredictor(data, colors, bpc, columns)
+    if pred >= 10:
+        return pngPredictor(data, colors, bpc, columns)
+    raise ValueError('Unsupported predictor: %r' % pred)
+
+def pngPredictor(data, colors, bpc, columns):
+    bpp = max(1, (colors*bpc + 7) // 8)
+    rowlen = (colors*bpc*columns + 7) // 8
+    stride = rowlen + 1
+    nrows = len(data) // stride
+    if not nrows:
+        return ''
+    # a partial last row is dropped, as other readers do
+    data = data[:nrows*stride]
+    kinds = data[0::stride]
+    adder = ByteAdder(rowlen)
+    rows = []
+    prev = '\x00' * rowlen
+    for m in PNG_RUNS.finditer(kinds):
+        r = m.start()
+        if m.group(1):
+            # a run of Up rows, done together
+            rows.append(pngUp(data, rowlen, r, m.end() - r, prev))
+            prev = rows[-1][-rowlen:]
+            continue
+        kind = kinds[r]
+        row = data[r*stride+1:(r+1)*stride]
+        if kind == '\x00':
+            pass
+        elif kind == '\x01':
+            row = fromInt(adder.prefix(toInt(row), bpp), rowlen)
+        elif kind == '\x03':
+            row = pngAverage(bytearray(row), bytearray(prev), bpp)
+        elif kind == '\x04':
+            row = pngPaeth(bytearray(row), bytearray(prev), bpp)
+        else:
+            raise ValueError('Invalid PNG filter type: %d' % ord(kind))
+        rows.append(row)
+        prev = row
+    return ''.join(rows)
+
+PNG_RUNS = re.compile(r'(\x02+)|.', re.DOTALL)
+
+def pngUp(data, rowlen, start, count, prev):
+    # each row is the bytewise sum of the row before the run and all
+    # the rows of the run up to it
+    stride = rowlen + 1
+    data = data[start*stride:(start+count)*stride]
+    body = bytearray(rowlen*count)
+    for j in xrange(rowlen):
+        body[j::rowlen] = data[j+1::stride]
+    adder = ByteAdder(rowlen*count)
+    x = adder.prefix(toInt(str(body)), rowlen)
+    if prev.strip('\x00'):
+        x = adder.add(x, toInt(prev * count))
+    return fromInt(x, rowlen*count)
+
+def pngAverage(row, prev, bpp):
+    for i in xrange(bpp):
+        row[i] = (row[i] + (prev[i] >> 1)) & 255
+    for i in xrange(bpp, len(row)):
+        row[i] = (row[i] + ((row[i-bpp] + prev[i]) >> 1)) & 255
+    return str(row)
+
+def pngPaeth(row, prev, bpp):
+    for i in xrange(bpp):
+        row[i] = (row[i] + prev[i]) & 255
+    for i in xrange(bpp, len(row)):
+        a = row[i-bpp]
+        b = prev[i]
+        c = prev[i-bpp]
+        pa = abs(b - c)
+        pb = abs(a - c)
+        pc = abs(a + b - 2*c)
+        if pa <= pb and pa <= pc:
+            row[i] = (row[i] + a) & 255
+        elif pb <= pc:
+            row[i] = (row[i] + b) & 255
+        else:
+            row[i] = (row[i] + c) & 255
+    return str(row)
+
+def tiffPredictor(data, colors, bpc, columns):
+    rowlen = (colors*bpc*columns + 7) // 8
+    nrows = len(data) // rowlen
+    rows = []
+    if bpc == 8:
+        adder = ByteAdder(rowlen)
+        for i in xrange(0, nrows*rowlen, rowlen):
+            rows.append(fromInt(adder.prefix(toInt(data[i:i+rowlen]), colors), rowlen))
+    elif bpc == 16:
+        fmt = '>%dH' % (colors*columns)
+        for i in xrange(0, nrows*rowlen, rowlen):
+            row = list(struct.unpack(fmt, data[i:i+rowlen]))
+            for j in xrange(colors, len(row)):
+                row[j] = (row[j] + row[j-colors]) & 0xffff
+            rows.append(struct.pack(fmt, *row))
+    else:
+        mask = (1 << bpc) - 1
+        nsamples = colors*columns
+        for i in xrange(0, nrows*rowlen, rowlen):
+            bits = toInt(data[i:i+rowlen]) >> (8*rowlen - bpc*nsamples)
+            samples = [(bits >> (bpc*(nsamples-1-j))) & mask for j in xrange(nsamples)]
+            for j in xrange(colors, nsamples):
+                samples[j] = (samples[j] + samples[j-colors]) & mask
+            bits = 0
+            for s in samples:
+                bits = (bits << bpc) | s
+            rows.append(fromInt(bits << (8*rowlen - bpc*nsamples), rowlen))
+    return ''.join(rows)
+
+
+##  Filters
+##
+
+def flateDecode(data, params):
+    return predictor(zlib.decompress(data), params)
+
+def lzwDecode(data, params):
+    early = int(params.get('EarlyChange', 1))
+    out = []
+    table = [chr(c) for c in xrange(256)] + [None, None]
+    width = 9
+    prev = None
+    bits = 0
+    nbits = 0
+    for c in bytearray(data):
+        bits = (bits << 8) | c
+        nbits += 8
+        while nbits >= width:
+            nbits -= width
+            code = bits >> nbits
+            bits &= (1 << nbits) - 1
+            if code == 256:
+                del table[258:]
+                width = 9
+                prev = None
+                continue
+            if code == 257:
+                return predictor(''.join(out), params)
+            if code < len(table):
+                entry = table[code]
+                if prev is not None:
+                    table.append(prev + entry[0])
+            elif code == len(table) and prev is not None:
+                entry = prev + prev[0]
+                table.append(entry)
+            else:
+                # damaged data: keep what we have
+                return predictor(''.join(out), params)
+            out.append(entry)
+            prev = entry
+            if len(table) >= 4096:
+                # full table, the encoder must send a clear code next
+                prev = None
+            elif len(table) + early >= (1 << width) and width < 12:
+                width += 1
+    return predictor(''.join(out), params)
+
+HEX_SKIP = re.compile(r'[\x00\t\n\x0c\r ]+')
+
+def asciiHexDecode(data, params):
+    end = data.find('>')
+    if end >= 0:
+        data = data[:end]
+    data = HEX_SKIP.sub('', data)
+    if len(data) % 2:
+        data += '0'
+    try:
+        return unhexlify(data)
+    except (TypeError, BinasciiError):
+        raise ValueError('Invalid ASCIIHex data')
+
+def ascii85Decode(data, params):
+    data = HEX_SKIP.sub('', data)
+    if data.startswith('<~'):
+        data = data[2:]
+    end = data.find('~')
+    if end >= 0:
+        data = data[:end]
+    data = data.replace('z', '!!!!!')
+    tail = len(data) % 5
+    if tail == 1:
+        raise ValueError('Invalid ASCII85 data')
+    if tail:
+        data += 'u' * (5 - tail)
+    values = []
+    chars = bytearray(data)
+    for i in xrange(0, len(chars), 5):
+        a, b, c, d, e = chars[i:i+5]
+        values.append(((((a-33)*85 + (b-33))*85 + (c-33))*85 + (d-33))*85 + (e-33))
+    out = struct.pack('>%dL' % len(values), *values)
+    if tail:
+        out = out[:len(out) - 5 + tail]
+    return out
+
+def runLengthDecode(data, params):
+    out = []
+    i = 0
+    n = len(data)
+    while i < n:
+        length = ord(data[i])
+        if length == 128:
+            break
+        if length < 128:
+            out.append(data[i+1:i+length+2])
+            i += length + 2
+        else:
+            out.append(data[i+1:i+2] * (257 - length))
+            i += 2
+    return ''.join(out)
+
+registerFilter(flateDecode, 'FlateDecode', 'Fl')
+registerFilter(lzwDecode, 'LZWDecode', 'LZW')
+registerFilter(asciiHexDecode, 'ASCIIHexDecode', 'AHx')
+registerFilter(ascii85Decode, 'ASCII85Decode', 'A85')
+registerFilter(runLengthDecode, 'RunLengthDecode', 'RL')
@@ -5,7 +5,7 @@ from __future__ import with_statement
 __license__ = 'GPL v3'
 
 # Standard Python modules.
-import os, sys, re, hashlib
+import os, sys, re, hashlib, time
 import json
 import traceback
 
@@ -88,6 +88,45 @@ class DeDRM_Prefs():
         return False
 
 
+# Records which keys have opened which kind of book, so they can be tried
+# in order of past success. Stored next to the plugin's preferences.
+#
+# kind is the book format and key type (e.g. u"epub_adept"), and group is
+# an optional finer grouping of books such as the publisher or ASIN prefix.
+class DeDRM_KeyStats():
+    def __init__(self):
+        JSON_PATH = os.path.join(u"plugins", PLUGIN_NAME.strip().lower().replace(' ', '_') + '_keystats.json')
+        self.keystats = JSONConfig(JSON_PATH)
+
+    def rankkeys(self, kind, keys, group = None):
+        # keys is a list of key names, or of (key name, key value) pairs
+        stats = self.keystats.get(kind, {})
+        def score(key):
+            if isinstance(key, tuple):
+                key = key[0]
+            entry = stats.get(key, {})
+            grouphits = 0
+            if group is not None:
+                grouphits = entry.get('groups', {}).get(group, 0)
+            return (grouphits, entry.get('hits', 0), entry.get('last', 0))
+        # sorting is stable, so keys that have never succeeded keep their order
+        return sorted(keys, key=score, reverse=True)
+
+    def addsuccess(self, kind, keyname, group = None):
+        try:
+            stats = self.keystats.get(kind, {})
+            entry = stats.setdefault(keyname, {})
+            entry['hits'] = entry.get('hits', 0) + 1
+            entry['last'] = time.time()
+            if group is not None:
+                groups = entry.setdefault('groups', {})
+                groups[group] = groups.get(group, 0) + 1
+            # assign the whole entry back so the json gets written
+            self.keystats[kind] = stats
+        except:
+            traceback.print_exc()
+
+
 def convertprefs(always = False):
 
     def parseIgnobleString(keystuff):
@@ -11,11 +11,16 @@ import re
 from struct import pack
 from struct import unpack
 
+if 'calibre' in sys.modules:
+    from calibre_plugins.dedrm import flatxmldoc
+else:
+    import flatxmldoc
+
 debug = False
 
 class DocParser(object):
     def __init__(self, flatxml, fontsize, ph, pw):
-        self.flatdoc = flatxml.split('\n')
+        self.doc = flatxmldoc.FlatXMLDoc(flatxml)
         self.fontsize = int(fontsize)
         self.ph = int(ph) * 1.0
         self.pw = int(pw) * 1.0
@@ -50,53 +55,26 @@ class DocParser(object):
 
     # find tag if within pos to end inclusive
     def findinDoc(self, tagpath, pos, end) :
-        result = None
-        docList = self.flatdoc
-        cnt = len(docList)
-        if end == -1 :
-            end = cnt
-        else:
-            end = min(cnt,end)
-        foundat = -1
-        for j in xrange(pos, end):
-            item = docList[j]
-            if item.find('=') >= 0:
-                (name, argres) = item.split('=',1)
-            else :
-                name = item
-                argres = ''
-            if name.endswith(tagpath) :
-                result = argres
-                foundat = j
-                break
-        return foundat, result
+        return self.doc.findinDoc(tagpath, pos, end)
 
 
     # return list of start positions for the tagpath
     def posinDoc(self, tagpath):
-        startpos = []
-        pos = 0
-        res = ""
-        while res != None :
-            (foundpos, res) = self.findinDoc(tagpath, pos, -1)
-            if res != None :
-                startpos.append(foundpos)
-            pos = foundpos + 1
-        return startpos
+        return self.doc.posinDoc(tagpath)
 
     # returns a vector of integers for the tagpath
     def getData(self, tagpath, pos, end, clean=False):
-        if clean:
-            digits_only = re.compile(r'''([0-9]+)''')
+        if not clean:
+            return self.doc.getData(tagpath, pos, end)
+        digits_only = re.compile(r'''([0-9]+)''')
         argres=[]
         (foundat, argt) = self.findinDoc(tagpath, pos, end)
         if (argt != None) and (len(argt) > 0) :
             argList = argt.split('|')
             for strval in argList:
-                if clean:
-                    m = re.search(digits_only, strval)
-                    if m != None:
-                        strval = m.group()
+                m = re.search(digits_only, strval)
+                if m != None:
+                    strval = m.group()
                 argres.append(int(strval))
         return argres
 
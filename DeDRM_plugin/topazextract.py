@@ -7,9 +7,14 @@
 # Changelog
 #  4.9  - moved unicode_argv call inside main for Windows DeDRM compatibility
 #  5.0  - Fixed potential unicode problem with command line interface
+#  5.1  - Probe PIDs with the shared key probe, parsing the dkey records once
+#  5.2  - Convert the book straight from the .tpz records, without unpacking them to disk
+#  5.3  - Added -w option to convert pages with several worker processes
+#  5.4  - Read the book records with the same workers, each opening the book itself
+#  5.5  - Only make the svg pages when getSVGZip asks for them
 
 from __future__ import print_function
-__version__ = '5.0'
+__version__ = '5.5'
 
 import sys
 import os, csv, getopt
@@ -80,9 +85,13 @@ debug = False
 if 'calibre' in sys.modules:
     inCalibre = True
     from calibre_plugins.dedrm import kgenpids
+    from calibre_plugins.dedrm import keyprobe
+    from calibre_plugins.dedrm import workerpool
 else:
     inCalibre = False
     import kgenpids
+    import keyprobe
+    import workerpool
 
 
 class DrmException(Exception):
@@ -165,8 +174,11 @@ def decryptRecord(data,PID):
     return topazCryptoDecrypt(data, ctx)
 
 # Try to decrypt a dkey record (contains the bookPID)
-def decryptDkeyRecord(data,PID):
-    record = decryptRecord(data,PID)
+def decryptDkeyRecord(data,PID,ctx=None):
+    if ctx is None:
+        record = decryptRecord(data,PID)
+    else:
+        record = topazCryptoDecrypt(data,ctx)
     fields = unpack('3sB8sB8s3s',record)
     if fields[0] != 'PID' or fields[5] != 'pid' :
         raise DrmException(u"Didn't find PID magic numbers in record")
@@ -176,26 +188,158 @@ def decryptDkeyRecord(data,PID):
         raise DrmException(u"Record didn't contain PID")
     return fields[4]
 
-# Decrypt all dkey records (contain the book PID)
-def decryptDkeyRecords(data,PID):
+# Split the dkey payload into its (still encrypted) key records
+def splitDkeyRecords(data):
     nbKeyRecords = ord(data[0])
     records = []
-    data = data[1:]
+    pos = 1
     for i in range (0,nbKeyRecords):
-        length = ord(data[0])
+        length = ord(data[pos])
+        records.append(data[pos+1:pos+1+length])
+        pos += 1+length
+    return records
+
+# Decrypt all dkey records (contain the book PID)
+def decryptDkeyRecords(data,PID):
+    records = []
+    for record in splitDkeyRecords(data):
         try:
-            key = decryptDkeyRecord(data[1:length+1],PID)
+            key = decryptDkeyRecord(record,PID)
             records.append(key)
         except DrmException:
             pass
-        data = data[1+length:]
     if len(records) == 0:
         raise DrmException(u"BookKey Not Found")
     return records
 
+# Find the book key among the dkey records, trying each PID in turn
+def findBookKey(data,pidlst):
+    dkeys = splitDkeyRecords(data)
+
+    def derive(pid):
+        # use 8 digit pids here
+        pid = pid[0:8]
+        return pid, topazCryptoInit(pid)
+
+    def quickcheck(key):
+        # a decrypted key record starts with 'PID'
+        pid, ctx = key
+        return [record for record in dkeys if topazCryptoDecrypt(record[0:3],ctx) == 'PID']
+
+    def fullcheck(key, records):
+        pid, ctx = key
+        for record in records:
+            try:
+                return decryptDkeyRecord(record,pid,ctx)
+            except DrmException:
+                pass
+        return None
+
+    probe = keyprobe.KeyProbe(derive, quickcheck, fullcheck)
+    pid, bookKey = probe.find(pidlst)
+    print(u"Tried {0:d} PIDs".format(probe.tried))
+    return pid, bookKey
+
+# Read one record's data at (offset, length, encrypted, compressed) in the
+# open book, decrypted and decompressed if necessary
+def readPayloadRecord(fo, location, bookKey):
+    offset, length, encrypted, compressed = location
+    fo.seek(offset)
+    record = fo.read(length)
+
+    if encrypted:
+        if bookKey:
+            ctx = topazCryptoInit(bookKey)
+            record = topazCryptoDecrypt(record,ctx)
+        else :
+            raise DrmException("Error: Attempt to decrypt without bookKey")
+
+    if compressed:
+        record = zlib.decompress(record)
+
+    return record
+
+# Is the Topaz cipher provided by the native alfcrypto library?
+def nativeTopaz():
+    return getattr(Topaz_Cipher, 'native', False)
+
+# most records handed to a worker at once
+RECORD_BATCH = 16
+
+# Read a batch of records for a worker. Each batch opens the book itself,
+# so workers never share a file position.
+def readRecordBatch(book, locations):
+    filename, bookKey = book
+    fo = file(filename, 'rb')
+    try:
+        return [readPayloadRecord(fo, location, bookKey) for location in locations]
+    finally:
+        fo.close()
+
+
+# The records of a Topaz book as a read-only mapping, named as they would be
+# when unpacked to a directory: 'dict0000.dat', 'page/page0000.dat',
+# 'img/img0000.jpg' and so on. Records are read, decrypted and decompressed
+# from the open book each time they are asked for, never kept. A color image
+# stands in for the plain image with the same number.
+class TopazRecords(object):
+    def __init__(self, book):
+        self.book = book
+        self.index = {}
+        self.dirs = {}
+        names = self.book.bookHeaderRecords.keys()
+        # color images are indexed last so they replace the plain ones
+        names.sort(key=lambda name: name == 'color')
+        for name in names:
+            if name == 'dkey':
+                continue
+            if name in ('img', 'color'):
+                dirname, ext = u"img", u".jpg"
+            elif name in ('page', 'glyphs'):
+                dirname, ext = name, u".dat"
+            else:
+                dirname, ext = u"", u".dat"
+            prefix = name
+            if name == 'color':
+                prefix = 'img'
+            for index, values in enumerate(self.book.bookHeaderRecords[name]):
+                if values[1] <= 0 and values[2] <= 0:
+                    # empty records were never extracted
+                    continue
+                fname = u"{0}{1:04d}{2}".format(prefix,index,ext)
+                self.index[self.join(dirname, fname)] = (name, index)
+                self.dirs.setdefault(dirname, set()).add(fname)
+
+    def join(self, dirname, fname):
+        if dirname:
+            return dirname + u"/" + fname
+        return fname
+
+    def __contains__(self, key):
+        return key in self.index
+
+    def __getitem__(self, key):
+        name, index = self.index[key]
+        return self.book.getBookPayloadRecord(name, index)
+
+    def fetch(self, keys, workers=1):
+        # yields the records for keys, in order, read by workers
+        return self.book.readRecords([self.index[key] for key in keys], workers)
+
+    def __len__(self):
+        return len(self.index)
+
+    def keys(self):
+        return sorted(self.index)
+
+    def listdir(self, dirname):
+        # sorted names of the records in dirname
+        return sorted(self.dirs.get(dirname, ()))
+
 
 class TopazBook:
     def __init__(self, filename):
+        self.filename = filename
         self.fo = file(filename, 'rb')
         self.outdir = tempfile.mkdtemp()
         # self.outdir = 'rawdat'
@@ -203,6 +347,9 @@ class TopazBook:
         self.bookHeaderRecords = {}
         self.bookMetadata = {}
         self.bookKey = None
+        self.foundpid = None
+        self.records = None
+        self.workers = 1
         magic = unpack('4s',self.fo.read(4))[0]
         if magic != 'TPZ0':
             raise DrmException(u"Parse Error : Invalid Header, not a Topaz file")
@@ -272,9 +419,9 @@ class TopazBook:
     def setBookKey(self, key):
         self.bookKey = key
 
-    def getBookPayloadRecord(self, name, index):
-        # Get a record in the book payload, given its name and index.
-        # decrypted and decompressed if necessary
+    def locateRecord(self, name, index):
+        # Find a record in the book payload, given its name and index.
+        # returns (offset, length, encrypted, compressed) of its data
         encrypted = False
         compressed = False
         try:
@@ -298,121 +445,66 @@ class TopazBook:
 
         if (self.bookHeaderRecords[name][index][2] > 0):
             compressed = True
-            record = self.fo.read(self.bookHeaderRecords[name][index][2])
+            length = self.bookHeaderRecords[name][index][2]
         else:
-            record = self.fo.read(self.bookHeaderRecords[name][index][1])
-
-        if encrypted:
-            if self.bookKey:
-                ctx = topazCryptoInit(self.bookKey)
-                record = topazCryptoDecrypt(record,ctx)
-            else :
-                raise DrmException("Error: Attempt to decrypt without bookKey")
+            length = self.bookHeaderRecords[name][index][1]
 
-        if compressed:
-            record = zlib.decompress(record)
+        return self.fo.tell(), length, encrypted, compressed
 
-        return record
-
-    def processBook(self, pidlst):
-        raw = 0
-        fixedimage=True
+    def getBookPayloadRecord(self, name, index):
+        # Get a record in the book payload, given its name and index.
+        # decrypted and decompressed if necessary
+        return readPayloadRecord(self.fo, self.locateRecord(name, index), self.bookKey)
+
+    def readRecords(self, records, workers=1):
+        # yields the payload records for a list of (name, index), in order
+        if workers <= 1 or len(records) <= 1:
+            for (name, index) in records:
+                yield self.getBookPayloadRecord(name, index)
+            return
+        locations = [self.locateRecord(name, index) for (name, index) in records]
+        book = (self.filename, self.bookKey)
+        for record in workerpool.mapBatches(readRecordBatch, book, locations, len(locations), workers, nativeTopaz(), RECORD_BATCH):
+            yield record
+
+    def processBook(self, pidlst, workers=1):
+        self.workers = workers
         try:
             keydata = self.getBookPayloadRecord('dkey', 0)
         except DrmException, e:
             print(u"no dkey record found, book may not be encrypted")
             print(u"attempting to extrct files without a book key")
-            self.createBookDirectory()
-            self.extractFiles()
-            print(u"Successfully Extracted Topaz contents")
-            if inCalibre:
-                from calibre_plugins.dedrm import genbook
-            else:
-                import genbook
-
-            rv = genbook.generateBook(self.outdir, raw, fixedimage)
+            self.records = TopazRecords(self)
+            rv = self.generateBook(set(['html']))
             if rv == 0:
                 print(u"Book Successfully generated.")
             return rv
 
         # try each pid to decode the file
-        bookKey = None
-        for pid in pidlst:
-            # use 8 digit pids here
-            pid = pid[0:8]
-            print(u"Trying: {0}".format(pid))
-            bookKeys = []
-            data = keydata
-            try:
-                bookKeys+=decryptDkeyRecords(data,pid)
-            except DrmException, e:
-                pass
-            else:
-                bookKey = bookKeys[0]
-                print(u"Book Key Found! ({0})".format(bookKey.encode('hex')))
-                break
+        self.foundpid, bookKey = findBookKey(keydata,pidlst)
+        if bookKey:
+            print(u"Book Key Found! ({0})".format(bookKey.encode('hex')))
 
         if not bookKey:
             raise DrmException(u"No key found in {0:d} keys tried. Read the FAQs at Harper's repository: https://github.com/apprenticeharper/DeDRM_tools/blob/master/FAQs.md".format(len(pidlst)))
 
         self.setBookKey(bookKey)
-        self.createBookDirectory()
-        self.extractFiles() 
-        print(u"Successfully Extracted Topaz contents")
+        self.records = TopazRecords(self)
+        rv = self.generateBook(set(['html']))
+        if rv == 0:
+            print(u"Book Successfully generated")
+        return rv
+
+    def generateBook(self, renditions):
+        # converts the book to the given renditions in outdir
         if inCalibre:
             from calibre_plugins.dedrm import genbook
         else:
             import genbook
 
-        rv = genbook.generateBook(self.outdir, raw, fixedimage)
-        if rv == 0:
-            print(u"Book Successfully generated")
-        return rv
-
-    def createBookDirectory(self):
-        outdir = self.outdir
-        # create output directory structure
-        if not os.path.exists(outdir):
-            os.makedirs(outdir)
-        destdir =  os.path.join(outdir,u"img")
-        if not os.path.exists(destdir):
-            os.makedirs(destdir)
-        destdir =  os.path.join(outdir,u"color_img")
-        if not os.path.exists(destdir):
-            os.makedirs(destdir)
-        destdir =  os.path.join(outdir,u"page")
-        if not os.path.exists(destdir):
-            os.makedirs(destdir)
-        destdir =  os.path.join(outdir,u"glyphs")
-        if not os.path.exists(destdir):
-            os.makedirs(destdir)
-
-    def extractFiles(self):
-        outdir = self.outdir
-        for headerRecord in self.bookHeaderRecords:
-            name = headerRecord
-            if name != 'dkey':
-                ext = u".dat"
-                if name == 'img': ext = u".jpg"
-                if name == 'color' : ext = u".jpg"
-                print(u"Processing Section: {0}\n. . .".format(name), end=' ')
-                for index in range (0,len(self.bookHeaderRecords[name])) :
-                    fname = u"{0}{1:04d}{2}".format(name,index,ext)
-                    destdir = outdir
-                    if name == 'img':
-                        destdir =  os.path.join(outdir,u"img")
-                    if name == 'color':
-                        destdir =  os.path.join(outdir,u"color_img")
-                    if name == 'page':
-                        destdir =  os.path.join(outdir,u"page")
-                    if name == 'glyphs':
-                        destdir =  os.path.join(outdir,u"glyphs")
-                    outputFile = os.path.join(destdir,fname)
-                    print(u".", end=' ')
-                    record = self.getBookPayloadRecord(name,index)
-                    if record != '':
-                        file(outputFile, 'wb').write(record)
-                print(u" ")
+        raw = 0
+        fixedimage=True
+        return genbook.generateBook(self.outdir, raw, fixedimage, self.records, self.workers, renditions)
 
     def getFile(self, zipname):
         htmlzip = zipfile.ZipFile(zipname,'w',zipfile.ZIP_DEFLATED, False)
@@ -421,9 +513,22 @@ class TopazBook:
         if os.path.isfile(os.path.join(self.outdir,u"cover.jpg")):
             htmlzip.write(os.path.join(self.outdir,u"cover.jpg"),u"cover.jpg")
         htmlzip.write(os.path.join(self.outdir,u"style.css"),u"style.css")
-        zipUpDir(htmlzip, self.outdir, u"img")
+        self.zipImages(htmlzip)
         htmlzip.close()
 
+    def zipImages(self, myzip):
+        # the book's own images come straight from the book,
+        # the generated ones from the output directory
+        if self.records is not None:
+            keys = [u"img/" + fname for fname in self.records.listdir(u"img")]
+            for (i, record) in enumerate(self.records.fetch(keys, self.workers)):
+                myzip.writestr(keys[i], record)
+        if os.path.isdir(os.path.join(self.outdir,u"img")):
+            zipUpDir(myzip, self.outdir, u"img")
+
+    def getFoundPID(self):
+        return self.foundpid
+
     def getBookType(self):
         return u"Topaz"
 
@@ -431,10 +536,14 @@ class TopazBook:
         return u".htmlz"
 
     def getSVGZip(self, zipname):
+        # the svg pages are only made when they are asked for
+        if not os.path.isfile(os.path.join(self.outdir,u"index_svg.xhtml")):
+            if self.generateBook(set(['svg'])) != 0:
+                raise DrmException(u"Could not generate the svg pages")
         svgzip = zipfile.ZipFile(zipname,'w',zipfile.ZIP_DEFLATED, False)
         svgzip.write(os.path.join(self.outdir,u"index_svg.xhtml"),u"index_svg.xhtml")
         zipUpDir(svgzip, self.outdir, u"svg")
-        zipUpDir(svgzip, self.outdir, u"img")
+        self.zipImages(svgzip)
         svgzip.close()
 
     def cleanup(self):
@@ -444,7 +553,7 @@ class TopazBook:
 def usage(progname):
     print(u"Removes DRM protection from Topaz ebooks and extracts the contents")
     print(u"Usage:")
-    print(u"    {0} [-k <kindle.k4i>] [-p <comma separated PIDs>] [-s <comma separated Kindle serial numbers>] <infile> <outdir>".format(progname))
+    print(u"    {0} [-k <kindle.k4i>] [-p <comma separated PIDs>] [-s <comma separated Kindle serial numbers>] [-w <number of workers>] <infile> <outdir>".format(progname))
 
 # Main
 def cli_main():
@@ -453,7 +562,7 @@ def cli_main():
     print(u"TopazExtract v{0}.".format(__version__))
 
     try:
-        opts, args = getopt.getopt(argv[1:], "k:p:s:x")
+        opts, args = getopt.getopt(argv[1:], "k:p:s:w:x")
     except getopt.GetoptError, err:
         print(u"Error in options or arguments: {0}".format(err.args[0]))
         usage(progname)
@@ -475,6 +584,7 @@ def cli_main():
     kDatabaseFiles = []
     serials = []
     pids = []
+    workers = 1
 
     for o, a in opts:
         if o == '-k':
@@ -489,6 +599,8 @@ def cli_main():
             if a == None :
                 raise DrmException("Invalid parameter for -s")
             serials = [serial.replace(" ","") for serial in a.split(',')]
+        if o == '-w':
+            workers = int(a)
 
     bookname = os.path.splitext(os.path.basename(infile))[0]
 
@@ -500,7 +612,7 @@ def cli_main():
 
     try:
         print(u"Decrypting Book")
-        tb.processBook(pids)
+        tb.processBook(pids, workers)
 
         print(u"   Creating HTML ZIP Archive")
         zipname = os.path.join(outdir, bookname + u"_nodrm.htmlz")
@@ -0,0 +1,85 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# workerpool.py
+
+__license__ = 'GPL v3'
+__version__ = '1.0'
+
+# Runs a function over a sequence of items with a pool of workers, giving
+# back the results in order. Used by mobidedrm.py, topazextract.py and
+# genbook.py.
+#
+# The items are handed out in batches, func(arg, batch) returning the list
+# of results for a batch. Only a couple of batches per worker are out at a
+# time, so the items may come from a generator, and neither they nor the
+# results are ever all in memory.
+#
+# Work done by the native alfcrypto library runs in threads, as its ctypes
+# calls release the GIL. Anything else needs worker processes.
+
+import itertools
+from collections import deque
+
+
+class WorkerPool(object):
+    # initializer(*initargs) is run once in each worker as it starts, or
+    # here when there is only one worker and no pool.
+    def __init__(self, workers, native=False, initializer=None, initargs=()):
+        self.workers = workers
+        self.pool = None
+        if workers > 1:
+            if native:
+                from multiprocessing.pool import ThreadPool as Pool
+            else:
+                from multiprocessing import Pool
+            self.pool = Pool(workers, initializer, initargs)
+        elif initializer is not None:
+            initializer(*initargs)
+
+    def map(self, func, arg, items, count, maxbatch=None):
+        # yields the result for each of the count items, in order
+        items = iter(items)
+        # a few batches per worker keeps them all busy until the end
+        batchsize = max(1, (count + self.workers*4 - 1) // (self.workers*4))
+        if maxbatch is not None:
+            batchsize = min(batchsize, maxbatch)
+        pending = deque()
+        while True:
+            while len(pending) < self.workers*2:
+                batch = list(itertools.islice(items, batchsize))
+                if not batch:
+                    break
+                if self.pool is None:
+                    pending.append(func(arg, batch))
+                else:
+                    pending.append(self.pool.apply_async(func, (arg, batch)))
+            if not pending:
+                return
+            results = pending.popleft()
+            if self.pool is not None:
+                results = results.get()
+            for result in results:
+                yield result
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.close()
+            self.pool.join()
+
+    def terminate(self):
+        if self.pool is not None:
+            self.pool.terminate()
+            self.pool.join()
+
+
+def mapBatches(func, arg, items, count, workers, native=False, maxbatch=None):
+    # WorkerPool.map with a pool of its own, shut down when done
+    pool = WorkerPool(workers, native)
+    try:
+        for result in pool.map(func, arg, items, count, maxbatch):
+            yield result
+        pool.close()
+    except:
+        pool.terminate()
+        raise